@@ -1,5 +1,6 @@
 import sys
 import time
+import multiprocessing
 import obspy
 import pyasdf
 import os, glob
@@ -19,7 +20,8 @@ This script:
     1) downloads sesimic data located in a broad region defined by user or using a pre-compiled station list;
     2) cleans up raw traces by removing gaps, instrumental response, downsampling and trimming to a day length;
     3) saves data into ASDF format (see Krischer et al., 2016 for more details on the data structure);
-    4) parallelize the downloading processes with MPI.
+    4) parallelize the downloading processes with MPI (over time chunks), concurrent requests to the data center and
+    a process pool to pre-process the stations of a chunk.
     5) avoids downloading data for stations that already have 1 or 3 channels
 
 Authors: Chengxin Jiang (chengxin_jiang@fas.harvard.edu) 
@@ -28,8 +30,8 @@ Authors: Chengxin Jiang (chengxin_jiang@fas.harvard.edu)
 NOTE: 
     0. MOST occasions you just need to change parameters followed with detailed explanations to run the script. 
     1. to avoid segmentation fault later in cross-correlation calculations due to too large data in memory,
-    a rough estimation of the memory needs is made in the beginning of the code. you can reduce the value of
-    inc_hours if memory on your machine is not enough to load proposed (x) hours of noise data all at once;
+    the memory needs of all steps are predicted in the beginning of the code and inc_hours is reduced
+    (see plan_chunks in noise_module) if memory on your machine is not enough to load proposed (x) hours of noise data all at once;
     2. if choose to download stations from an existing CSV files, stations with the same name but different
     channel is regarded as different stations (same format as those generated by the S0A);
     3. for unknow reasons, including station location code during feteching process sometime result in no-data.
@@ -48,14 +50,24 @@ tt0=time.time()
 rootpath = '/Users/chengxin/Documents/NoisePy_example/AZ'       # roothpath for the project
 direc  = os.path.join(rootpath,'RAW_DATA')                      # where to store the downloaded data
 dlist  = os.path.join(direc,'station.txt')                      # CSV file for station location info
+invdir = os.path.join(rootpath,'stationxml')                    # where to cache the StationXML of each channel epoch (None to turn off)
 
 # download parameters
-client    = Client('SCEDC')                                     # client/data center. see https://docs.obspy.org/packages/obspy.clients.fdsn.html for a list
+req_timeout = 120                                               # timeout (s) of each request to the data center
+client    = Client('SCEDC',timeout=req_timeout)                 # client/data center. see https://docs.obspy.org/packages/obspy.clients.fdsn.html for a list
 down_list = True                                                # download stations from a pre-compiled list or not
 flag      = False                                               # print progress when running the script; recommend to use it at the begining
+nworker   = 1                                                   # number of processes per rank to pre-process stations of the same chunk (1 for serial)
+max_inflight = 8                                                # number of concurrent requests to the data center per rank (1 for serial)
+bulk_size = 0                                                   # max number of station channels per bulk station/waveform request (0 for one request per station)
+nretry    = 3                                                   # number of retries for a failed request
+backoff   = 2.                                                  # waiting time (s) before the first retry, doubled at each retry
 samp_freq = 20                                                  # targeted sampling rate at X samples per seconds 
+raw_freq  = None                                                # sampling rate of the raw data to plan the memory of S0 (None to get it from the inventory or the channel band code)
+resample  = 'poly'                                              # downsampling with a polyphase filter for rational ratios ('poly') or always with obspy interpolate ('interpolate')
 rm_resp   = 'no'                                                # select 'no' to not remove response and use 'inv','spectrum','RESP', or 'polozeros' to remove response
 respdir   = os.path.join(rootpath,'resp')                       # directory where resp files are located (required if rm_resp is neither 'no' nor 'inv')
+resp_cache_mb = 500                                             # memory (MB) per process to cache the inverse response of each channel epoch
 freqmin   = 0.05                                                # pre filtering frequency bandwidth
 freqmax   = 2                                                   # note this cannot exceed Nquist freq                         
 
@@ -69,9 +81,10 @@ end_date   = ["2014_01_21_0_0_0"]                               # end date of do
 inc_hours  = 24                                                 # length of data for each request (in hour)
 ncomp      = len(chan_list)
 
-# get rough estimate of memory needs to ensure it now below up in S1
+# plan the chunk length so that the memory needs of S0-S2 stay below MAX_MEM
 cc_len    = 1800                                                # basic unit of data length for fft (s)
 step      = 450                                                 # overlapping between each cc_len (s)
+maxlag    = 200                                                 # lags of cross-correlation to save in S1 (s)
 MAX_MEM   = 5.0                                                 # maximum memory allowed per core in GB
 
 ##################################################
@@ -84,9 +97,10 @@ if flag:
     print('station.list selected [%s] for data from %s to %s with %sh interval'%(down_list,starttime,endtime,inc_hours))
 
 # assemble parameters used for pre-processing
-prepro_para = {'rm_resp':rm_resp,'respdir':respdir,'freqmin':freqmin,'freqmax':freqmax,'samp_freq':samp_freq,'start_date':\
+prepro_para = {'rm_resp':rm_resp,'respdir':respdir,'freqmin':freqmin,'freqmax':freqmax,'samp_freq':samp_freq,'resample':resample,'start_date':\
     start_date,'end_date':end_date,'inc_hours':inc_hours,'cc_len':cc_len,'step':step,'MAX_MEM':MAX_MEM,'lamin':lamin,\
-    'lamax':lamax,'lomin':lomin,'lomax':lomax,'ncomp':ncomp}
+    'lamax':lamax,'lomin':lomin,'lomax':lomax,'ncomp':ncomp,'nworker':nworker,'max_inflight':max_inflight,'nretry':nretry,\
+    'backoff':backoff,'bulk_size':bulk_size,'invdir':invdir,'resp_cache_mb':resp_cache_mb}
 metadata = os.path.join(direc,'download_info.txt') 
 
 # prepare station info (existing station list vs. fetching from client)
@@ -112,7 +126,7 @@ if down_list:
 else:
 
     # calculate the total number of channels to download
-    sta=[];net=[];chan=[];location=[];lon=[];lat=[];elev=[]
+    sta=[];net=[];chan=[];location=[];lon=[];lat=[];elev=[];srate=[]
     nsta=0
 
     # loop through specified network, station and channel lists
@@ -136,6 +150,7 @@ else:
                         lon.append(tsta.longitude)
                         lat.append(tsta.latitude)
                         elev.append(tsta.elevation)
+                        if len(tsta.channels):srate.append(max([tcha.sample_rate for tcha in tsta.channels]))
                         # sometimes one station has many locations and here we only get the first location
                         if tsta[0].location_code:
                             location.append(tsta[0].location_code)
@@ -143,14 +158,6 @@ else:
                         nsta+=1
     prepro_para['nsta'] = nsta
 
-# rough estimation on memory needs (assume float32 dtype)
-nsec_chunk = inc_hours/24*86400
-nseg_chunk = int(np.floor((nsec_chunk-cc_len)/step))+1
-npts_chunk = int(nseg_chunk*cc_len*samp_freq)
-memory_size = nsta*npts_chunk*4/1024**3
-if memory_size > MAX_MEM:
-    raise ValueError('Require %5.3fG memory but only %5.3fG provided)! Reduce inc_hours to avoid this issue!' % (memory_size,MAX_MEM))
-
 
 ########################################################
 #################DOWNLOAD SECTION#######################
@@ -161,6 +168,19 @@ comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 size = comm.Get_size()
 
+# raw sampling rate for the memory plan of S0: from the inventory or the highest one allowed by the band code
+if raw_freq is None:
+    if not down_list and len(srate): raw_freq = max(srate)
+    else: raw_freq = noise_module.band_code_freq(chan)
+
+# memory/work plan: the chunk length is reduced if needed
+plan = noise_module.plan_chunks({'nsta':nsta,'ncomp':1,'samp_freq':samp_freq,'cc_len':cc_len,'step':step,'maxlag':maxlag,\
+    'substack':False,'substack_len':cc_len,'MAX_MEM':MAX_MEM,'inc_hours':inc_hours,'nworker':nworker,'raw_freq':raw_freq},\
+    verbose=(rank==0))
+inc_hours = plan['inc_hours']
+prepro_para['inc_hours'] = inc_hours
+prepro_para['raw_freq']  = raw_freq
+
 if rank==0:
     if not os.path.isdir(rootpath):os.mkdir(rootpath)
     if not os.path.isdir(direc):os.mkdir(direc)
@@ -188,6 +208,16 @@ splits = comm.bcast(splits,root=0)
 all_chunk  = comm.bcast(all_chunk,root=0)
 extra = splits % size
 
+# process pool to pre-process stations of the same chunk in parallel
+if nworker > 1:
+    pool = multiprocessing.Pool(nworker)
+else: pool = None
+
+# inventories of each channel epoch are downloaded once and shared by all chunks of the rank
+if invdir is not None:
+    inv_cache = noise_module.make_inv_cache(invdir)
+else: inv_cache = None
+
 tp = 0
 # MPI: loop through each time chunk 
 for ick in range(rank,splits,size):
@@ -212,54 +242,69 @@ for ick in range(rank,splits,size):
                 if tname in alist:
                     num_records[ista] = len(rds.waveforms[tname].get_waveform_tags())
 
+    # collect the channels still to be downloaded in this chunk
+    jobs = []
+    for ista in range(nsta):
+
+        # continue when there are alreay data for sta A at day X
+        if num_records[ista] == ncomp:
+            continue
+
+        if location[ista] == '*':
+            tlocation = str('00')
+        else:
+            tlocation = location[ista]
+        new_tags = '{0:s}_{1:s}'.format(chan[ista].lower(),tlocation.lower())
+        jobs.append((client,net[ista],sta[ista],chan[ista],location[ista],prepro_para,date_info,new_tags))
+
+    # requests (grouped in bulk when bulk_size>0) are sent concurrently by threads and the stations
+    # are pre-processed (by the pool) as they arrive
+    fetched = noise_module.fetch_concurrent(jobs,max_inflight,bulk_size,inv_cache)
+    if pool is not None:
+        results = pool.imap_unordered(noise_module.preprocess_downloaded,fetched)
+    else:
+        results = map(noise_module.preprocess_downloaded,fetched)
+
     # appending when file exists
+    reqlogs = [];inv_added = set()
     with pyasdf.ASDFDataSet(ff,mpi=False,compression="gzip-3",mode='a') as ds:
 
-        # loop through each channel
-        for ista in range(nsta):
-
-            # continue when there are alreay data for sta A at day X
-            if num_records[ista] == ncomp:
-                continue
-
-            # get inventory for specific station
-            try:
-                sta_inv = client.get_stations(network=net[ista],station=sta[ista],\
-                    location=location[ista],starttime=s1,endtime=s2,level="response")
-            except Exception as e:
-                print(e);continue
-
-            # add the inventory for all components + all time of this tation         
-            try:
-                ds.add_stationxml(sta_inv) 
-            except Exception: 
-                pass   
-
-            try:
-                # get data
-                t0=time.time()
-                tr = client.get_waveforms(network=net[ista],station=sta[ista],\
-                    channel=chan[ista],location=location[ista],starttime=s1,endtime=s2)
-                t1=time.time()
-            except Exception as e:
-                print(e,'for',sta[ista]);continue
-                
-            # preprocess to clean data  
-            print(sta[ista])
-            tr = noise_module.preprocess_raw(tr,sta_inv,prepro_para,date_info)
-            t2 = time.time()
-            tp += t2-t1
+        for res in results:
+            if res is None:continue
+            tr,sta_inv,new_tags,tdown,tprep,tlogs = res
+            tp += tprep
+            reqlogs.extend(tlogs)
+
+            # add the inventory for all components + all time of this tation (once per channel)
+            cids = set(sta_inv.get_contents()['channels'])
+            if not cids.issubset(inv_added):
+                try:
+                    ds.add_stationxml(sta_inv) 
+                    inv_added.update(cids)
+                except Exception: 
+                    pass   
 
             if len(tr):
-                if location[ista] == '*':
-                    tlocation = str('00')
-                else:
-                    tlocation = location[ista]
-                new_tags = '{0:s}_{1:s}'.format(chan[ista].lower(),tlocation.lower())
                 ds.add_waveforms(tr,tag=new_tags)
+                noise_module.add_gap_mask(ds,tr[0],new_tags)
 
             #if flag:
-            print(ds,new_tags);print('downloading data %6.2f s; pre-process %6.2f s' % ((t1-t0),(t2-t1)))
+            print(ds,new_tags);print('downloading data %6.2f s; pre-process %6.2f s' % (tdown,tprep))
+
+    # summary of the requests sent for this chunk
+    if len(reqlogs):
+        treq = np.array([log['time'] for log in reqlogs])
+        nfail = len([log for log in reqlogs if log['status']!='ok'])
+        print('chunk %s: %d requests (%d failed) with %d retries; request time mean %6.2f s and max %6.2f s' % (all_chunk[ick],\
+            len(reqlogs),nfail,sum([log['ntry']-1 for log in reqlogs]),np.mean(treq),np.max(treq)))
+    if inv_cache is not None:
+        print('inventory cache: %d hits and %d misses' % (inv_cache['hits'],inv_cache['misses']))
+    # the response operators are cached in the process pre-processing the data
+    if pool is None and rm_resp in ['inv','spectrum']:
+        print(noise_module.resp_cache_info())
+
+if pool is not None:
+    pool.close();pool.join()
 
 tt1=time.time()
 print('downloading step takes %6.2f s with %6.2f for preprocess' %(tt1-tt0, tp))
@@ -1,6 +1,7 @@
 import sys
 import glob
 import os,gc
+import multiprocessing
 import obspy
 import time
 import pyasdf
@@ -49,26 +50,33 @@ nsta = len(locs)
 # useful parameters for cleaning the data
 input_fmt = 'asdf'                                                      # input file format between 'sac' and 'mseed' 
 samp_freq = 10                                                          # targeted sampling rate
+raw_freq  = None                                                        # sampling rate of the raw data to plan the memory of S0 (None to read it from the file headers)
+resample  = 'poly'                                                      # downsampling with a polyphase filter for rational ratios ('poly') or always with obspy interpolate ('interpolate')
 stationxml= False                                                       # station.XML file exists or not
 rm_resp   = 'no'                                                        # select 'no' to not remove response and use 'inv','spectrum','RESP', or 'polozeros' to remove response
 respdir   = os.path.join(rootpath,'resp')                               # directory where resp files are located (required if rm_resp is neither 'no' nor 'inv')
+resp_cache_mb = 500                                                     # memory (MB) per process to cache the inverse response of each channel epoch
 freqmin   = 0.02                                                        # pre filtering frequency bandwidth
 freqmax   = 4                                                           # note this cannot exceed Nquist freq
 flag      = False                                                       # print intermediate variables and computing time
+nworker   = 1                                                           # number of processes per rank to pre-process stations of the same chunk (1 for serial)
+cache_mb  = 1000                                                        # memory (MB) per rank to cache decoded raw files shared by adjacent chunks (0 to turn off)
 
 # having this file saves a tons of time: see L95-126 for why
 wiki_file = os.path.join(rootpath,'allfiles_time.txt')                  # file containing the path+name for all sac/mseed files and its start-end time      
 allfiles_path = os.path.join(DATADIR,'*/*'+input_fmt)                   # make sure all sac/mseed files can be found through this format
 messydata = False                                                       # set this to False when daily noise data is well sorted 
+ncore     = 8                                                           # number of processes to scan the file headers when messydata is True
 
 # targeted time range
 start_date = ['2010_12_06_0_0_0']                                       # start date of local data
 end_date   = ['2010_12_16_0_0_0']                                       # end date of local data
 inc_hours  = 8                                                          # sac/mseed file length for a continous recording
 
-# get rough estimate of memory needs to ensure it now below up in S1
+# plan the chunk length so that the memory needs of S0-S2 stay below MAX_MEM
 cc_len    = 1800                                                        # basic unit of data length for fft (s)
 step      = 450                                                         # overlapping between each cc_len (s)
+maxlag    = 200                                                         # lags of cross-correlation to save in S1 (s)
 MAX_MEM   = 4.0                                                         # maximum memory allowed per core in GB
 
 ##################################################
@@ -76,8 +84,9 @@ MAX_MEM   = 4.0                                                         # maximu
 
 # assemble parameters for data pre-processing
 prepro_para = {'RAWDATA':RAWDATA,'wiki_file':wiki_file,'messydata':messydata,'input_fmt':input_fmt,'stationxml':stationxml,\
-    'rm_resp':rm_resp,'respdir':respdir,'freqmin':freqmin,'freqmax':freqmax,'samp_freq':samp_freq,'inc_hours':inc_hours,\
-    'start_date':start_date,'end_date':end_date,'allfiles_path':allfiles_path,'cc_len':cc_len,'step':step,'MAX_MEM':MAX_MEM}
+    'rm_resp':rm_resp,'respdir':respdir,'freqmin':freqmin,'freqmax':freqmax,'samp_freq':samp_freq,'resample':resample,'inc_hours':inc_hours,\
+    'start_date':start_date,'end_date':end_date,'allfiles_path':allfiles_path,'cc_len':cc_len,'step':step,'MAX_MEM':MAX_MEM,\
+    'ncore':ncore,'nworker':nworker,'resp_cache_mb':resp_cache_mb,'cache_mb':cache_mb}
 metadata = os.path.join(DATADIR,'download_info.txt') 
 
 ##########################################################
@@ -95,37 +104,58 @@ if rank == 0:
     if not os.path.isdir(DATADIR):os.mkdir(DATADIR)
     if not os.path.isdir(RAWDATA):raise ValueError('Abort! no path of %s exists for RAWDATA'%RAWDATA)
 
+    # assemble timestamp info: only new or changed files are scanned when wiki_file exists
+    allfiles,all_stimes,all_ids = noise_module.make_timestamps(prepro_para)
+
+    # index of sorted file intervals for each station/channel in the list
+    findex = noise_module.make_file_index(allfiles,all_stimes,all_ids,locs)
+
+    # raw sampling rate for the memory plan of S0: the highest one in the file headers
+    if raw_freq is None: raw_freq = noise_module.raw_sampling_rate(findex)
+else:
+    findex = None
+
+findex   = comm.bcast(findex,root=0)
+raw_freq = comm.bcast(raw_freq,root=0)
+if raw_freq is None: raise ValueError('Abort! cannot read the sampling rate of the raw data: please set raw_freq')
+
+# memory/work plan: the chunk length is reduced if needed
+plan = noise_module.plan_chunks({'nsta':nsta,'ncomp':1,'samp_freq':samp_freq,'cc_len':cc_len,'step':step,'maxlag':maxlag,\
+    'substack':False,'substack_len':cc_len,'MAX_MEM':MAX_MEM,'inc_hours':inc_hours,'nworker':nworker,'raw_freq':raw_freq},\
+    verbose=(rank==0))
+inc_hours = plan['inc_hours']
+prepro_para['inc_hours'] = inc_hours
+prepro_para['raw_freq']  = raw_freq
+
+if rank == 0:
     # output parameter info
     fout = open(metadata,'w')
     fout.write(str(prepro_para));fout.close()
 
-    # assemble timestamp info
-    allfiles = glob.glob(allfiles_path)
-    all_stimes = noise_module.make_timestamps(prepro_para)
-
     # all time chunk for output: loop for MPI
     all_chunk = noise_module.get_event_list(start_date[0],end_date[0],inc_hours)   
     splits     = len(all_chunk)-1
     if splits<1:raise ValueError('Abort! no chunk found between %s-%s with inc %s'%(start_date[0],end_date[0],inc_hours))
-
-    # rough estimation on memory needs needed in S1 (assume float32 dtype)
-    nsec_chunk = inc_hours/24*86400
-    nseg_chunk = int(np.floor((nsec_chunk-cc_len)/step))+1
-    npts_chunk = int(nseg_chunk*cc_len*samp_freq)
-    memory_size = nsta*npts_chunk*4/1024**3
-    if memory_size > MAX_MEM:
-        raise ValueError('Require %5.3fG memory but only %5.3fG provided)! Reduce inc_hours to avoid this issue!' % (memory_size,MAX_MEM))
 else:
-    splits,all_chunk,all_stimes,allfiles = [None for _ in range(4)]
+    splits,all_chunk = [None for _ in range(2)]
 
 # broadcast the variables
 splits     = comm.bcast(splits,root=0)
 all_chunk = comm.bcast(all_chunk,root=0)
-all_stimes = comm.bcast(all_stimes,root=0)
-allfiles   = comm.bcast(allfiles,root=0)
+
+# process pool to pre-process stations of the same chunk in parallel
+if nworker > 1:
+    pool = multiprocessing.Pool(nworker)
+else: pool = None
+
+# LRU cache of decoded raw files: chunks are given to each rank in contiguous blocks of time
+# so that files spanning several chunks are read only once
+if cache_mb > 0:
+    raw_cache = noise_module.make_raw_cache(cache_mb)
+else: raw_cache = None
 
 # MPI: loop through each time-chunk
-for ick in range(rank,splits,size):
+for ick in range(rank*splits//size,(rank+1)*splits//size):
     t0=time.time()
 
     # time window defining the time-chunk
@@ -135,75 +165,67 @@ for ick in range(rank,splits,size):
     time1=s1-obspy.UTCDateTime(1970,1,1)
     time2=s2-obspy.UTCDateTime(1970,1,1) 
 
-    # find all data pieces having data of the time-chunk
-    indx1 = np.where((time1>=all_stimes[:,0]) & (time1<all_stimes[:,1]))[0]
-    indx2 = np.where((time2>all_stimes[:,0]) & (time2<=all_stimes[:,1]))[0]
-    indx3 = np.where((time1<=all_stimes[:,0]) & (time2>=all_stimes[:,1]))[0]
-    indx4 = np.concatenate((indx1,indx2,indx3))
-    indx  = np.unique(indx4)
-    if not len(indx): print('continue! no data found between %s-%s'%(s1,s2));continue
-
-    # trim down the sac/mseed file list with time in time-chunk
-    tfiles = []
-    for ii in indx:
-        tfiles.append(allfiles[ii])
-
-    # loop through station
-    nsta = len(locs)
-    for ista in range(nsta):
-
-        # the station info:
-        station = locs.iloc[ista]['station']
-        network = locs.iloc[ista]['network']
-        comp    = locs.iloc[ista]['channel']
-        if flag: print("working on station %s channel %s" % (station,comp)) 
-
-        # norrow down file list by using sta/net info in the file name
-        ttfiles  = [ifile for ifile in tfiles if station in ifile] 
-        if not len(ttfiles): continue 
-        tttfiles = [ifile for ifile in ttfiles if comp in ifile]
-        if not len(tttfiles): continue
-
-        source = obspy.Stream()
-        for ifile in tttfiles:
-            try:
-                tr = obspy.read(ifile)
-                for ttr in tr:
-                    source.append(ttr)
-            except Exception as inst:
-                print(inst);continue
-        
-        # jump if no good data left
-        if not len(source):continue
-
-        # make inventory to save into ASDF file
-        t1=time.time()
-        inv1   = noise_module.stats2inv(source[0].stats,prepro_para,locs=locs)      
-        tr = noise_module.preprocess_raw(source,inv1,prepro_para,date_info)
-        if np.all(tr[0].data==0):continue
-        t2 = time.time()
-        if flag:print('pre-processing takes %6.2fs'%(t2-t1))
-
-        # jump if no good data left
-        if not len(tr):continue
+    # the work of each station in the time-chunk: the raw files are only read when the job is taken
+    # so that about one station per process is held in memory besides the cache
+    def station_jobs():
+        for ista in range(len(locs)):
 
-        # ready for output
-        ff=os.path.join(DATADIR,all_chunk[ick]+'T'+all_chunk[ick+1]+'.h5')
-        if not os.path.isfile(ff):
-            with pyasdf.ASDFDataSet(ff,mpi=False,compression="gzip-3",mode='w') as ds:
-                pass
+            # the station info:
+            station = locs.iloc[ista]['station']
+            network = locs.iloc[ista]['network']
+            comp    = locs.iloc[ista]['channel']
+            if flag: print("working on station %s channel %s" % (station,comp)) 
 
-        with pyasdf.ASDFDataSet(ff,mpi=False,compression="gzip-3",mode='a') as ds:
-            # add the inventory for all components + all time of this tation         
-            try:ds.add_stationxml(inv1) 
-            except Exception: pass 
+            # find all data pieces of this channel having data in the time-chunk
+            tttfiles = noise_module.query_file_index(findex,(str(network),str(station),str(comp)),time1,time2)
+            if not len(tttfiles): continue
 
             tlocation = str('00')        
             new_tags = '{0:s}_{1:s}'.format(comp.lower(),tlocation.lower())
-            ds.add_waveforms(tr,tag=new_tags)     
+            # files are read here when cached so that the cache is shared by all stations
+            if raw_cache is not None:
+                source = noise_module.read_raw_files(tttfiles,raw_cache)
+                if not len(source): continue
+            else: source = None
+            yield (tttfiles,source,prepro_para,locs[locs['station']==station],date_info,new_tags)
+
+    # stations are pre-processed by the pool (or serially) and written here as they finish
+    if pool is not None:
+        results = noise_module.pool_imap_bounded(pool,noise_module.preprocess_local_station,station_jobs(),2*nworker)
+    else:
+        results = map(noise_module.preprocess_local_station,station_jobs())
+
+    # the output file is opened only once for the whole chunk
+    ff=os.path.join(DATADIR,all_chunk[ick]+'T'+all_chunk[ick+1]+'.h5')
+    ds = None
+    for res in results:
+        # jump if no good data left
+        if res is None:continue
+        tr,inv1,new_tags = res
+
+        if ds is None:
+            ds = pyasdf.ASDFDataSet(ff,mpi=False,compression="gzip-3",mode='a')
+
+        # add the inventory for all components + all time of this tation         
+        try:ds.add_stationxml(inv1) 
+        except Exception: pass 
+        ds.add_waveforms(tr,tag=new_tags)     
+        noise_module.add_gap_mask(ds,tr[0],new_tags)
+    if ds is not None: del ds
+    else: print('continue! no data found between %s-%s'%(s1,s2))
     
     t3=time.time()
     print('it takes '+str(t3-t0)+' s to process '+str(inc_hours)+'h length in step 0B')
+    if raw_cache is not None:
+        nread = raw_cache['hits']+raw_cache['misses']
+        print('raw file cache: %d hits and %d misses (hit rate %5.1f%%), %6.1f MB in use' % (raw_cache['hits'],\
+            raw_cache['misses'],100*raw_cache['hits']/max(nread,1),raw_cache['nbytes']/1024**2))
+    # the response operators are cached in the process pre-processing the data
+    if pool is None and rm_resp in ['inv','spectrum']:
+        print(noise_module.resp_cache_info())
+
+if pool is not None:
+    pool.close();pool.join()
 
 tt1=time.time()
 print('step0B takes '+str(tt1-tt0)+' s')
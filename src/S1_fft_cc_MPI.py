@@ -3,6 +3,7 @@ import sys
 import time
 import scipy
 import obspy
+import h5py
 import pyasdf
 import datetime
 import os, glob
@@ -61,6 +62,7 @@ flag        = False                                                         # pr
 acorr_only  = False                                                         # only perform auto-correlation 
 xcorr_only  = True                                                          # only perform cross-correlation or not
 ncomp       = 1                                                             # 1 or 3 component data (needed to decide whether do rotation)
+fast_read   = True                                                          # read ASDF waveforms directly from HDF5 instead of building obspy streams (input_fmt='asdf' only)
 
 # station/instrument info for input_fmt=='sac' or 'mseed'
 stationxml = False                                                          # station.XML file used to remove instrument response for SAC/miniseed data
@@ -71,6 +73,7 @@ if input_fmt != 'asdf':
     if not os.path.isfile(locations): 
         raise ValueError('Abort! station info is needed for this script')   
     locs = pd.read_csv(locations)
+else: locs = None
 
 # pre-processing parameters 
 cc_len    = 1800                                                            # basic unit of data length for fft (sec)
@@ -119,7 +122,7 @@ fc_para={'samp_freq':samp_freq,'dt':dt,'cc_len':cc_len,'step':step,'freqmin':fre
     input_fmt,'rootpath':rootpath,'CCFDIR':CCFDIR,'start_date':start_date[0],'end_date':end_date[0],\
     'inc_hours':inc_hours,'substack':substack,'substack_len':substack_len,'smoothspect_N':smoothspect_N,\
     'maxlag':maxlag,'max_over_std':max_over_std,'max_kurtosis':max_kurtosis,'MAX_MEM':MAX_MEM,'ncomp':ncomp,\
-    'stationxml':stationxml,'rm_resp':rm_resp,'respdir':respdir,'input_fmt':input_fmt}
+    'stationxml':stationxml,'rm_resp':rm_resp,'respdir':respdir,'input_fmt':input_fmt,'fast_read':fast_read,'flag':flag}
 # save fft metadata for future reference
 fc_metadata  = os.path.join(CCFDIR,'fft_cc_data.txt')       
 
@@ -189,170 +192,136 @@ for ick in range (rank,splits,size):
     
     # retrive station information
     if input_fmt == 'asdf':
-        ds=pyasdf.ASDFDataSet(tdir[ick],mpi=False,mode='r') 
-        sta_list = ds.waveforms.list()
+        if fast_read:
+            # station info of all stations parsed once for the file
+            ds=h5py.File(tdir[ick],'r')
+            sta_info = noise_module.asdf_station_info(ds)
+            sta_list = sorted(ds['Waveforms'].keys())
+        else:
+            ds=pyasdf.ASDFDataSet(tdir[ick],mpi=False,mode='r') 
+            sta_list = ds.waveforms.list()
         nsta=ncomp*len(sta_list)
         print('found %d stations in total'%nsta)
     else:
+        ds = None
         sta_list = sorted(glob.glob(os.path.join(tdir[ick],'*'+input_fmt)))
     if (len(sta_list)==0):
         print('continue! no data in %s'%tdir[ick]);continue
 
-    # crude estimation on memory needs (assume float32)
+    # memory plan: stations are loaded in blocks when the spectra of all channels do not fit in memory
+    plan = noise_module.plan_chunks({'nsta':len(sta_list),'ncomp':ncomp,'samp_freq':samp_freq,'cc_len':cc_len,'step':step,\
+        'maxlag':maxlag,'substack':substack,'substack_len':substack_len,'MAX_MEM':MAX_MEM,'inc_hours':inc_hours,\
+        'fix_inc':True},verbose=flag)
+    nblk_sta = max(plan['nblock']//ncomp,1)
+    blocks   = [sta_list[ii:ii+nblk_sta] for ii in range(0,len(sta_list),nblk_sta)]
+    if len(blocks)>1:
+        print('%d stations are processed in %d blocks of %d stations'%(len(sta_list),len(blocks),nblk_sta))
+
     nsec_chunk = inc_hours/24*86400
     nseg_chunk = int(np.floor((nsec_chunk-cc_len)/step))
-    npts_chunk = int(nseg_chunk*cc_len*samp_freq)
-    memory_size = nsta*npts_chunk*4/1024**3
-    if memory_size > MAX_MEM:
-        raise ValueError('Require %5.3fG memory but only %5.3fG provided)! Reduce inc_hours to avoid this issue!' % (memory_size,MAX_MEM))
-
     nnfft = int(next_fast_len(int(cc_len*samp_freq)))
-    # open array to store fft data/info in memory
-    fft_array = np.zeros((nsta,nseg_chunk*(nnfft//2)),dtype=np.complex64)
-    fft_std   = np.zeros((nsta,nseg_chunk),dtype=np.float32)
-    fft_flag  = np.zeros(nsta,dtype=np.int16)
-    fft_time  = np.zeros((nsta,nseg_chunk),dtype=np.float64) 
-    # station information (for every channel)
-    station=[];network=[];channel=[];clon=[];clat=[];location=[];elevation=[]     
-
-    # loop through all stations
-    iii = 0
-    for ista in range(len(sta_list)):
-        tmps = sta_list[ista]
-
-        if input_fmt == 'asdf':
-            # get station and inventory
-            try:
-                inv1 = ds.waveforms[tmps]['StationXML']
-            except Exception as e:
-                print('abort! no stationxml for %s in file %s'%(tmps,tdir[ick]))
-                continue
-            sta,net,lon,lat,elv,loc = noise_module.sta_info_from_inv(inv1)
-
-            # get days information: works better than just list the tags 
-            all_tags = ds.waveforms[tmps].get_waveform_tags()
-            if len(all_tags)==0:continue
-            
-        else: # get station information
-            all_tags = [1]
-            sta = tmps.split('/')[-1]
-
-        #----loop through each stream----
-        for itag in range(len(all_tags)):
-            if flag:print("working on station %s and trace %s" % (sta,all_tags[itag]))
-
-            # read waveform data
-            if input_fmt == 'asdf':
-                source = ds.waveforms[tmps][all_tags[itag]]
+    # buffer reused to read the waveform of every channel
+    if input_fmt == 'asdf' and fast_read:
+        wbuf = np.zeros(int(inc_hours*3600*samp_freq)+1,dtype=np.float32)
+    else:
+        sta_info = None;wbuf = None
+
+    #############PERFORM CROSS-CORRELATION##################
+    ftmp = open(tmpfile,'w')
+    nloaded = 0
+    # loop through source blocks and receiver blocks (the same when all stations fit in memory)
+    for iblk in range(len(blocks)):
+        src = noise_module.load_fft_block(ds,blocks[iblk],fc_para,nseg_chunk,nnfft,sta_info,locs,wbuf)
+        nloaded += src['n']
+
+        for jblk in range(iblk,len(blocks)):
+            if acorr_only and jblk>iblk: break
+            if jblk == iblk:
+                rec = src
             else:
-                source = obspy.read(tmps)
-                inv1   = noise_module.stats2inv(source[0].stats,fc_para,locs)
-                sta,net,lon,lat,elv,loc = noise_module.sta_info_from_inv(inv1)
-
-            # channel info 
-            comp = source[0].stats.channel
-            if comp[-1] =='U': comp.replace('U','Z')
-            if len(source)==0:continue
-
-            # cut daily-long data into smaller segments (dataS always in 2D)
-            trace_stdS,dataS_t,dataS = noise_module.cut_trace_make_statis(fc_para,source)        # optimized version:3-4 times faster
-            if not len(dataS): continue
-            N = dataS.shape[0]
-
-            # do normalization if needed
-            source_white = noise_module.noise_processing(fc_para,dataS)
-            Nfft = source_white.shape[1];Nfft2 = Nfft//2
-            if flag:print('N and Nfft are %d (proposed %d),%d (proposed %d)' %(N,nseg_chunk,Nfft,nnfft))
-
-            # keep track of station info to write into parameter section of ASDF files
-            station.append(sta);network.append(net);channel.append(comp),clon.append(lon)
-            clat.append(lat);location.append(loc);elevation.append(elv)
-
-            # load fft data in memory for cross-correlations
-            data = source_white[:,:Nfft2]
-            fft_array[iii] = data.reshape(data.size)
-            fft_std[iii]   = trace_stdS
-            fft_flag[iii]  = 1
-            fft_time[iii]  = dataS_t
-            iii+=1
-            del trace_stdS,dataS_t,dataS,source_white,data
-    
-    if input_fmt == 'asdf': del ds
+                rec = noise_module.load_fft_block(ds,blocks[jblk],fc_para,nseg_chunk,nnfft,sta_info,locs,wbuf)
+            N = src['N'];Nfft = src['Nfft'];Nfft2 = Nfft//2
+
+            # make cross-correlations 
+            for iiS in range(src['n']):
+                fft1 = src['fft'][iiS]
+                source_std = src['std'][iiS]
+                sou_ind = np.where((source_std<fc_para['max_over_std'])&(source_std>0)&(np.isnan(source_std)==0))[0]
+                if not src['flag'][iiS] or not len(sou_ind): continue
+                        
+                t0=time.time()
+                #-----------get the smoothed source spectrum for decon later----------
+                sfft1 = noise_module.smooth_source_spect(fc_para,fft1)
+                sfft1 = sfft1.reshape(N,Nfft2)
+                t1=time.time()
+                if flag: 
+                    print('smoothing source takes %6.4fs' % (t1-t0))
+
+                # get index right for auto/cross correlation
+                if jblk == iblk:
+                    istart=iiS;iend=src['n']
+                    if acorr_only:iend=np.minimum(iiS+ncomp,src['n'])
+                    if xcorr_only:istart=np.minimum(iiS+ncomp,src['n'])
+                else:
+                    istart=0;iend=rec['n']
+
+                #-----------now loop III for each receiver B----------
+                for iiR in range(istart,iend):
+                    if flag:print('receiver: %s %s' % (rec['station'][iiR],rec['network'][iiR]))
+                    if not rec['flag'][iiR]: continue
+                        
+                    fft2 = rec['fft'][iiR];sfft2 = fft2.reshape(N,Nfft2)
+                    receiver_std = rec['std'][iiR]
+
+                    #---------- check the existence of earthquakes ----------
+                    rec_ind = np.where((receiver_std<fc_para['max_over_std'])&(receiver_std>0)&(np.isnan(receiver_std)==0))[0]
+                    bb=np.intersect1d(sou_ind,rec_ind)
+                    if len(bb)==0:continue
+
+                    t2=time.time()
+                    corr,tcorr,ncorr=noise_module.correlate(sfft1[bb,:],sfft2[bb,:],fc_para,Nfft,rec['time'][iiR][bb])
+                    t3=time.time()
+
+                    #---------------keep daily cross-correlation into a hdf5 file--------------
+                    if input_fmt == 'asdf':
+                        tname = tdir[ick].split('/')[-1]
+                    else: 
+                        tname = tdir[ick].split('/')[-1]+'.h5'
+                    cc_h5 = os.path.join(CCFDIR,tname)
+                    crap  = np.zeros(corr.shape,dtype=corr.dtype)
+
+                    with pyasdf.ASDFDataSet(cc_h5,mpi=False) as ccf_ds:
+                        coor = {'lonS':src['lon'][iiS],'latS':src['lat'][iiS],'lonR':rec['lon'][iiR],'latR':rec['lat'][iiR]}
+                        comp = src['channel'][iiS][-1]+rec['channel'][iiR][-1]
+                        parameters = noise_module.cc_parameters(fc_para,coor,tcorr,ncorr,comp)
+
+                        # source-receiver pair
+                        data_type = src['network'][iiS]+'.'+src['station'][iiS]+'_'+rec['network'][iiR]+'.'+rec['station'][iiR]
+                        path = src['channel'][iiS]+'_'+rec['channel'][iiR]
+                        crap[:] = corr[:]
+                        ccf_ds.add_auxiliary_data(data=crap, data_type=data_type, path=path, parameters=parameters)
+                        ftmp.write(src['network'][iiS]+'.'+src['station'][iiS]+'.'+src['channel'][iiS]+'_'+rec['network'][iiR]+'.'+\
+                            rec['station'][iiR]+'.'+rec['channel'][iiR]+'\n')
+
+                    t4=time.time()
+                    if flag:print('read S %6.4fs, cc %6.4fs, write cc %6.4fs'% ((t1-t0),(t3-t2),(t4-t3)))
+                    
+                    del fft2,sfft2,receiver_std
+                del fft1,sfft1,source_std
+            del rec
+        del src
+
+    if input_fmt == 'asdf' and fast_read: ds.close()
+    elif input_fmt == 'asdf': del ds
 
     # check whether array size is enough
-    if iii!=nsta:
+    if nloaded!=nsta:
         print('it seems some stations miss data in download step, but it is OKAY!')
 
-    #############PERFORM CROSS-CORRELATION##################
-    ftmp = open(tmpfile,'w')
-    # make cross-correlations 
-    for iiS in range(iii):
-        fft1 = fft_array[iiS]
-        source_std = fft_std[iiS]
-        sou_ind = np.where((source_std<fc_para['max_over_std'])&(source_std>0)&(np.isnan(source_std)==0))[0]
-        if not fft_flag[iiS] or not len(sou_ind): continue
-                
-        t0=time.time()
-        #-----------get the smoothed source spectrum for decon later----------
-        sfft1 = noise_module.smooth_source_spect(fc_para,fft1)
-        sfft1 = sfft1.reshape(N,Nfft2)
-        t1=time.time()
-        if flag: 
-            print('smoothing source takes %6.4fs' % (t1-t0))
-
-        # get index right for auto/cross correlation
-        istart=iiS;iend=iii
-        if acorr_only:iend=np.minimum(iiS+ncomp,iii)
-        if xcorr_only:istart=np.minimum(iiS+ncomp,iii)
-
-        #-----------now loop III for each receiver B----------
-        for iiR in range(istart,iend):
-            if flag:print('receiver: %s %s' % (station[iiR],network[iiR]))
-            if not fft_flag[iiR]: continue
-                
-            fft2 = fft_array[iiR];sfft2 = fft2.reshape(N,Nfft2)
-            receiver_std = fft_std[iiR]
-
-            #---------- check the existence of earthquakes ----------
-            rec_ind = np.where((receiver_std<fc_para['max_over_std'])&(receiver_std>0)&(np.isnan(receiver_std)==0))[0]
-            bb=np.intersect1d(sou_ind,rec_ind)
-            if len(bb)==0:continue
-
-            t2=time.time()
-            corr,tcorr,ncorr=noise_module.correlate(sfft1[bb,:],sfft2[bb,:],fc_para,Nfft,fft_time[iiR][bb])
-            t3=time.time()
-
-            #---------------keep daily cross-correlation into a hdf5 file--------------
-            if input_fmt == 'asdf':
-                tname = tdir[ick].split('/')[-1]
-            else: 
-                tname = tdir[ick].split('/')[-1]+'.h5'
-            cc_h5 = os.path.join(CCFDIR,tname)
-            crap  = np.zeros(corr.shape,dtype=corr.dtype)
-
-            with pyasdf.ASDFDataSet(cc_h5,mpi=False) as ccf_ds:
-                coor = {'lonS':clon[iiS],'latS':clat[iiS],'lonR':clon[iiR],'latR':clat[iiR]}
-                comp = channel[iiS][-1]+channel[iiR][-1]
-                parameters = noise_module.cc_parameters(fc_para,coor,tcorr,ncorr,comp)
-
-                # source-receiver pair
-                data_type = network[iiS]+'.'+station[iiS]+'_'+network[iiR]+'.'+station[iiR]
-                path = channel[iiS]+'_'+channel[iiR]
-                crap[:] = corr[:]
-                ccf_ds.add_auxiliary_data(data=crap, data_type=data_type, path=path, parameters=parameters)
-                ftmp.write(network[iiS]+'.'+station[iiS]+'.'+channel[iiS]+'_'+network[iiR]+'.'+station[iiR]+'.'+channel[iiR]+'\n')
-
-            t4=time.time()
-            if flag:print('read S %6.4fs, cc %6.4fs, write cc %6.4fs'% ((t1-t0),(t3-t2),(t4-t3)))
-            
-            del fft2,sfft2,receiver_std
-        del fft1,sfft1,source_std
-
     # create a stamp to show time chunk being done
     ftmp.write('done')
     ftmp.close()
 
-    fft_array=[];fft_std=[];fft_flag=[];fft_time=[]
     n = gc.collect();print('unreadable garbarge',n)
 
     t11 = time.time()
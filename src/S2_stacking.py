@@ -38,7 +38,7 @@ tt0=time.time()
 ########################################
 
 # absolute path parameters
-rootpath  = '/Volumes/Chengxin/TA'.                                 # root path for this data processing
+rootpath  = '/Volumes/Chengxin/TA'                                  # root path for this data processing
 CCFDIR    = os.path.join(rootpath,'CCF')                            # dir where CC data is stored
 STACKDIR  = os.path.join(rootpath,'STACK')                          # dir where stacked data is going to
 locations = os.path.join(rootpath,'station.txt')                    # station info including network,station,channel,latitude,longitude,elevation
@@ -47,16 +47,22 @@ if not os.path.isfile(locations):
 
 # define new stacking para
 keep_substack= True                                                 # keep all sub-stacks in final ASDF file
+substack_2d  = False                                                # store the sub-stacks of each component as one 2D dataset (Substack) instead of one T<timestamp> group each
 flag         = False                                                # output intermediate args for debugging
-stack_method = 'all'                                                # linear, pws, robust or all
+stack_method = 'all'                                                # linear, pws, robust, acf (adaptive covariance filter), selective or all
+stream       = True                                                 # accumulate stacks file by file (linear or pws) so that memory does not depend on record length
+append       = False                                                # add the new CCF files to the stacks of a former stream run (former CCF files are only read again to move outliers)
 
 # new rotation para
 rotation     = True                                                 # rotation from E-N-Z to R-T-Z 
 correction   = False                                                # angle correction due to mis-orientation
+rotate_substack = False                                             # rotate the sub-stacks to R-T-Z as well (needs keep_substack)
 if rotation and correction:
     corrfile = os.path.join(rootpath,'meso_angles.txt')             # csv file containing angle info to be corrected
     locs     = pd.read_csv(corrfile)
 else: locs = []
+# lookup table of the angles to be corrected for each station
+rot_locs = noise_module.rotation_lookup(locs)
 
 # maximum memory allowed per core in GB
 MAX_MEM = 4.0
@@ -83,11 +89,16 @@ if ncomp==1:enz_system = ['ZZ']
 else: enz_system = ['EE','EN','EZ','NE','NN','NZ','ZE','ZN','ZZ']
 rtz_components = ['ZR','ZT','ZZ','RR','RT','RZ','TR','TT','TZ']
 
+# stacking methods that can be accumulated file by file
+stream_methods = ['linear','pws']
+if append and not (stream and stack_method in stream_methods):
+    raise ValueError('Abort! append only works with stream and stack_method of %s'%stream_methods)
+
 # make a dictionary to store all variables: also for later cc
 stack_para={'samp_freq':samp_freq,'cc_len':cc_len,'step':step,'rootpath':rootpath,'STACKDIR':\
     STACKDIR,'start_date':start_date[0],'end_date':end_date[0],'inc_hours':inc_hours,'substack':substack,\
-    'substack_len':substack_len,'maxlag':maxlag,'MAX_MEM':MAX_MEM,'keep_substack':keep_substack,\
-    'stack_method':stack_method,'rotation':rotation,'correction':correction}
+    'substack_len':substack_len,'maxlag':maxlag,'MAX_MEM':MAX_MEM,'keep_substack':keep_substack,'substack_2d':substack_2d,\
+    'stack_method':stack_method,'stream':stream,'append':append,'rotation':rotation,'correction':correction,'rotate_substack':rotate_substack,'stack_timing':flag}
 # save fft metadata for future reference
 stack_metadata  = os.path.join(STACKDIR,'stack_data.txt') 
 
@@ -112,30 +123,47 @@ if rank == 0:
     # load station info
     tlocs = pd.read_csv(locations)
     sta = sorted(np.unique(tlocs['network']+'.'+tlocs['station']))
-    for ii in range(len(sta)):
-        tmp = os.path.join(STACKDIR,sta[ii])
-        if not os.path.isdir(tmp):os.mkdir(tmp)
 
-    # station-pairs
+    # station-pairs having cross-correlation data and the size of their data
+    pair_files,pair_size = noise_module.ccf_index(ccfiles)
     pairs_all = []
-    for ii in range(len(sta)-1):
-        for jj in range(ii,len(sta)):
-            pairs_all.append(sta[ii]+'_'+sta[jj])
+    for tpair in sorted(pair_files.keys()):
+        ttr = tpair.split('_')
+        if len(ttr)==2 and ttr[0] in sta and ttr[1] in sta:
+            pairs_all.append(tpair)
+    for tsta in np.unique([tpair.split('_')[0] for tpair in pairs_all]):
+        tmp = os.path.join(STACKDIR,tsta)
+        if not os.path.isdir(tmp):os.mkdir(tmp)
 
     splits  = len(pairs_all)
     if len(ccfiles)==0 or splits==0:
         raise IOError('Abort! no available CCF data for stacking')
 
+    # schedule the station-pairs to the ranks by the size of their data
+    jobs,loads = noise_module.schedule_pairs([pair_size[tpair] for tpair in pairs_all],size)
+    print('%d station-pairs found in %d CCF files: %5.1f%% imbalance in data size between ranks' % \
+        (splits,len(ccfiles),100*(np.max(loads)/max(np.mean(loads),1)-1)))
+    pair_files = {tpair:pair_files[tpair] for tpair in pairs_all}
+
 else:
-    splits,ccfiles,pairs_all = [None for _ in range(3)]
+    splits,ccfiles,pairs_all,sta,pair_files,jobs = [None for _ in range(6)]
 
 # broadcast the variables
 splits    = comm.bcast(splits,root=0)
 ccfiles   = comm.bcast(ccfiles,root=0)
 pairs_all = comm.bcast(pairs_all,root=0)
-
-# MPI loop: loop through each user-defined time chunck
-for ipair in range (rank,splits,size):
+sta       = comm.bcast(sta,root=0)
+pair_files= comm.bcast(pair_files,root=0)
+jobs      = comm.bcast(jobs,root=0)
+
+# memory plan: number of CCF files that can be loaded at once for each station pair
+nfile = max([len(pair_files[tpair]) for tpair in pairs_all])
+plan = noise_module.plan_chunks({'nsta':len(sta),'ncomp':ncomp,'samp_freq':samp_freq,'cc_len':cc_len,'step':step,\
+    'maxlag':maxlag,'substack':substack,'substack_len':substack_len,'MAX_MEM':MAX_MEM,'inc_hours':inc_hours,'fix_inc':True,\
+    'nfile':nfile},verbose=(rank==0))
+
+# MPI loop: loop through the station-pairs scheduled to this rank
+for ipair in jobs[rank]:
     t0=time.time()
 
     if flag:print('%dth path for station-pair %s'%(ipair,pairs_all[ipair]))
@@ -145,13 +173,16 @@ for ipair in range (rank,splits,size):
     rnet,rsta = ttr[1].split('.')
     idir  = ttr[0]
 
-    # continue when file is done
+    # continue when file is done (append runs check for new CCF files below)
     toutfn = os.path.join(STACKDIR,idir+'/'+pairs_all[ipair]+'.tmp')   
-    if os.path.isfile(toutfn):continue        
+    if os.path.isfile(toutfn) and not append:continue        
+
+    # CCF files having data of the station pair
+    pfiles = pair_files[pairs_all[ipair]]
 
-    # crude estimation on memory needs (assume float32)
+    # size of the cc data of the station pair (see plan_chunks for the memory needs)
     nccomp     = ncomp*ncomp
-    num_chunck = len(ccfiles)*nccomp
+    num_chunck = len(pfiles)*nccomp
     num_segmts = 1
     if substack:    # things are difference when do substack
         if substack_len==cc_len:
@@ -159,153 +190,288 @@ for ipair in range (rank,splits,size):
         else:
             num_segmts = int(inc_hours/(substack_len/3600))
     npts_segmt  = int(2*maxlag*samp_freq)+1
-    memory_size = num_chunck*num_segmts*npts_segmt*4/1024**3
 
-    if memory_size > MAX_MEM:
-        raise ValueError('Require %5.3fG memory but only %5.3fG provided)! Cannot load cc data all once!' % (memory_size,MAX_MEM))
-    if flag:
-        print('Good on memory (need %5.2f G and %s G provided)!' % (memory_size,MAX_MEM))
-        
-    # allocate array to store fft data/info
-    cc_array = np.zeros((num_chunck*num_segmts,npts_segmt),dtype=np.float32)
-    cc_time  = np.zeros(num_chunck*num_segmts,dtype=np.float)
-    cc_ngood = np.zeros(num_chunck*num_segmts,dtype=np.int16)
-    cc_comp  = np.chararray(num_chunck*num_segmts,itemsize=2,unicode=True)
-
-    # loop through all time-chuncks
-    iseg = 0
-    dtype = pairs_all[ipair] 
-    for ifile in ccfiles:
-
-        # load the data from daily compilation
-        ds=pyasdf.ASDFDataSet(ifile,mpi=False,mode='r')
-        try:
-            path_list   = ds.auxiliary_data[dtype].list()
-            tparameters = ds.auxiliary_data[dtype][path_list[0]].parameters 
-        except Exception: 
-            if flag:print('continue! no pair of %s in %s'%(dtype,ifile))
+    stack_h5 = os.path.join(STACKDIR,idir+'/'+pairs_all[ipair]+'.h5')
+
+    # outputs of the station pair are assembled here and written at once at the end
+    outputs = []        # (data,data_type,path,parameters) of the stacks
+    subs    = []        # (comp,data,times,ngood,parameters) of the sub-stacks
+    tbads   = []        # (comp,times) of the sub-stacks written but not kept
+
+    # matrix used for rotation: the stacks of all methods are rotated at once
+    rmethods = ['linear','pws','robust'] if stack_method=='all' else [stack_method]
+    if rotation:bigstack=np.zeros(shape=(len(rmethods),9,npts_segmt),dtype=np.float32)
+    rsubs = rotation and keep_substack and rotate_substack and ncomp==3
+
+    # streaming: stacks of each cross-component are accumulated while reading the files 
+    # and the sub-stacks are written as they go
+    if stream and stack_method in stream_methods:
+        accs  = [noise_module.stack_accum_init(npts_segmt,pws=(stack_method=='pws')) for _ in range(nccomp)]
+
+        # append: start from the accumulators of the former run and read the new CCF files only
+        done  = set()
+        if append and os.path.isfile(stack_h5):
+            with pyasdf.ASDFDataSet(stack_h5,mpi=False,mode='r') as ds:
+                for icomp in range(nccomp):
+                    acc = noise_module.read_stack_state(ds,enz_system[icomp],stack_method)
+                    if acc is not None: accs[icomp] = acc
+            done  = set([index[0][0] for acc in accs for index in acc['index']])
+            if len(done):
+                pfiles = [ifile for ifile in pfiles if os.path.basename(ifile) not in done]
+                if not len(pfiles):
+                    if flag:print('continue! no new CCF files for %s'%pairs_all[ipair])
+                    continue
+            else: os.remove(stack_h5)           # no accumulators stored: stack all files again
+        iseg  = sum([len(acc['time']) for acc in accs])
+        nnew  = 0
+        dtype = pairs_all[ipair]
+        for ifile in pfiles:
+            ds=pyasdf.ASDFDataSet(ifile,mpi=False,mode='r')
+            try:
+                path_list   = ds.auxiliary_data[dtype].list()
+                tparameters = ds.auxiliary_data[dtype][path_list[0]].parameters 
+            except Exception: 
+                if flag:print('continue! no pair of %s in %s'%(dtype,ifile))
+                continue
+            if ncomp==3 and len(path_list)<9:
+                if flag:print('continue! not enough cross components for %s in %s'%(dtype,ifile))
+                continue
+            if len(path_list) >9:
+                raise ValueError('more than 9 cross-component exists for %s %s! please double check'%(ifile,dtype))
+            nnew += 1
+
+            if keep_substack: ds2 = pyasdf.ASDFDataSet(stack_h5,mpi=False)
+            fsubs = {}
+            for tpath in path_list:
+                comp = tpath.split('_')[0][-1]+tpath.split('_')[1][-1]
+                if comp not in enz_system: continue
+                tdata = ds.auxiliary_data[dtype][tpath].data[:]
+                ttime = ds.auxiliary_data[dtype][tpath].parameters['time']
+                tgood = ds.auxiliary_data[dtype][tpath].parameters['ngood']
+                ampmax = noise_module.stack_accum_add(accs[enz_system.index(comp)],tdata,ttime,tgood,(os.path.basename(ifile),tpath))
+                iseg += len(ampmax)
+
+                # keep a track of all sub-stacked data from S1
+                if keep_substack:
+                    tindx = np.where(ampmax>0)[0]
+                    fsubs[comp] = (np.atleast_2d(tdata)[tindx],np.atleast_1d(ttime)[tindx],np.atleast_1d(tgood)[tindx])
+                    noise_module.write_substacks(ds2,comp,*fsubs[comp],tparameters,substack_2d)
+            if rsubs:
+                rparameters = dict(tparameters,station_source=ssta,station_receiver=rsta)
+                for comp,tdata,ttime,tgood in noise_module.rotate_substacks(fsubs,enz_system,rtz_components,rparameters,rot_locs):
+                    noise_module.write_substacks(ds2,comp,tdata,ttime,tgood,rparameters,substack_2d)
+            if keep_substack: del ds2
+            del ds
+
+        t1=time.time()
+        if flag:print('loading and accumulating CCF data takes %6.2fs'%(t1-t0))
+
+        # append: the former stacks are kept when none of the new files has the pair
+        if len(done) and not nnew:
+            if flag:print('continue! no new CCF data for %s'%pairs_all[ipair])
             continue
-        
-        if ncomp==3 and len(path_list)<9:
-            if flag:print('continue! not enough cross components for %s in %s'%(dtype,ifile))
+
+        # continue when there is no data
+        if iseg <= 1:
+            if os.path.isfile(stack_h5):os.remove(stack_h5)
             continue
 
-        if len(path_list) >9:
-            raise ValueError('more than 9 cross-component exists for %s %s! please double check'%(ifile,dtype))
+        iflag=1
+        for icomp in range(nccomp):
+            comp = enz_system[icomp]
+            acc  = accs[icomp]
+
+            # jump if there are not enough data
+            if len(acc['time'])<2:
+                for tcomp in range(icomp,nccomp):
+                    tbads.append((enz_system[tcomp],accs[tcomp]['time']))
+                iflag=0;break
+
+            # (sub-)stacks of abnormal amplitudes are read again to be removed from the stacks
+            # (with append, former ones that are good again are put back in the sub-stacks)
+            redo = noise_module.stack_accum_outliers(acc)
+            for (fname,tpath),rows in redo.items():
+                with pyasdf.ASDFDataSet(os.path.join(CCFDIR,fname),mpi=False,mode='r') as ds:
+                    tdata = np.atleast_2d(ds.auxiliary_data[dtype][tpath].data[:])
+                noise_module.stack_accum_fix(acc,(fname,tpath),rows,tdata[rows])
+                if keep_substack:
+                    pos  = [acc['lookup'][((fname,tpath),irow)] for irow in rows]
+                    back = [ii for ii in range(len(rows)) if acc['insum'][pos[ii]]]
+                    if len(back):
+                        subs.append((comp,tdata[rows][back],np.array(acc['time'])[pos][back],\
+                            np.array(acc['ngood'])[pos][back],dict(tparameters)))
+            allstacks1,nstacks,tstart,tbad = noise_module.stack_accum_final(acc,stack_method)
+            tbads.append((comp,tbad))
+            if not len(allstacks1):continue
+            if rotation:bigstack[0,icomp] = allstacks1
+
+            # stacked data to write into ASDF file
+            tparameters['time']  = tstart
+            tparameters['ngood'] = nstacks
+            outputs.append((allstacks1,'Allstack_'+stack_method,comp,dict(tparameters)))
+
+        # rotated sub-stacks are removed with any of their E-N-Z components
+        if rsubs and len(tbads):
+            tbad = np.unique(np.concatenate([np.atleast_1d(tbad) for comp,tbad in tbads]))
+            for comp in rtz_components:
+                if comp not in enz_system:tbads.append((comp,tbad))
+
+        t3 = time.time()
+        if flag:print('takes %6.2fs to stack all components with %s stacking method' %(t3-t1,stack_method))
+
+    else:
+        if plan['nbatch'] < len(pfiles):
+            raise ValueError('Require %5.3fG memory but only %5.3fG provided)! Cannot load cc data all once!' % \
+                (plan['mem']['file']*len(pfiles),MAX_MEM))
+        
+        # allocate array to store fft data/info
+        cc_array = np.zeros((num_chunck*num_segmts,npts_segmt),dtype=np.float32)
+        cc_time  = np.zeros(num_chunck*num_segmts,dtype=np.float64)
+        cc_ngood = np.zeros(num_chunck*num_segmts,dtype=np.int16)
+        cc_comp  = np.chararray(num_chunck*num_segmts,itemsize=2,unicode=True)
+
+        # loop through all time-chuncks
+        iseg = 0
+        dtype = pairs_all[ipair] 
+        for ifile in pfiles:
+
+            # load the data from daily compilation
+            ds=pyasdf.ASDFDataSet(ifile,mpi=False,mode='r')
+            try:
+                path_list   = ds.auxiliary_data[dtype].list()
+                tparameters = ds.auxiliary_data[dtype][path_list[0]].parameters 
+            except Exception: 
+                if flag:print('continue! no pair of %s in %s'%(dtype,ifile))
+                continue
+        
+            if ncomp==3 and len(path_list)<9:
+                if flag:print('continue! not enough cross components for %s in %s'%(dtype,ifile))
+                continue
+
+            if len(path_list) >9:
+                raise ValueError('more than 9 cross-component exists for %s %s! please double check'%(ifile,dtype))
                    
-        # load the 9-component data, which is in order in the ASDF
-        for tpath in path_list:
-            cmp1 = tpath.split('_')[0]
-            cmp2 = tpath.split('_')[1]
-            tcmp1 = cmp1[-1];tcmp2 = cmp2[-1]
-
-            # read data and parameter matrix
-            tdata = ds.auxiliary_data[dtype][tpath].data[:]
-            ttime = ds.auxiliary_data[dtype][tpath].parameters['time']
-            tgood = ds.auxiliary_data[dtype][tpath].parameters['ngood']
-            if substack:
-                for ii in range(tdata.shape[0]):
-                    cc_array[iseg] = tdata[ii]
-                    cc_time[iseg]  = ttime[ii]
-                    cc_ngood[iseg] = tgood[ii]
+            # load the 9-component data, which is in order in the ASDF
+            for tpath in path_list:
+                cmp1 = tpath.split('_')[0]
+                cmp2 = tpath.split('_')[1]
+                tcmp1 = cmp1[-1];tcmp2 = cmp2[-1]
+
+                # read data and parameter matrix
+                tdata = ds.auxiliary_data[dtype][tpath].data[:]
+                ttime = ds.auxiliary_data[dtype][tpath].parameters['time']
+                tgood = ds.auxiliary_data[dtype][tpath].parameters['ngood']
+                if substack:
+                    for ii in range(tdata.shape[0]):
+                        cc_array[iseg] = tdata[ii]
+                        cc_time[iseg]  = ttime[ii]
+                        cc_ngood[iseg] = tgood[ii]
+                        cc_comp[iseg]  = tcmp1+tcmp2
+                        iseg+=1
+                else:
+                    cc_array[iseg] = tdata
+                    cc_time[iseg]  = ttime
+                    cc_ngood[iseg] = tgood
                     cc_comp[iseg]  = tcmp1+tcmp2
                     iseg+=1
-            else:
-                cc_array[iseg] = tdata
-                cc_time[iseg]  = ttime
-                cc_ngood[iseg] = tgood
-                cc_comp[iseg]  = tcmp1+tcmp2
-                iseg+=1
-
-    t1=time.time()
-    if flag:print('loading CCF data takes %6.2fs'%(t1-t0))
-
-    # continue when there is no data
-    if iseg <= 1: continue
-    outfn = pairs_all[ipair]+'.h5'         
-    if flag:print('ready to output to %s'%(outfn))                     
-
-    # matrix used for rotation
-    if rotation:bigstack=np.zeros(shape=(9,npts_segmt),dtype=np.float32)
-    if stack_method =='all':
-        bigstack1=np.zeros(shape=(9,npts_segmt),dtype=np.float32)
-        bigstack2=np.zeros(shape=(9,npts_segmt),dtype=np.float32)
-
-    # loop through cross-component for stacking
-    iflag=1
-    for icomp in range(nccomp):
-        comp = enz_system[icomp]
-        indx = np.where(cc_comp==comp)[0]
-
-        # jump if there are not enough data
-        if len(indx)<2: 
-            iflag=0;break
-
-        t2=time.time()
-        stack_h5 = os.path.join(STACKDIR,idir+'/'+outfn)
-        # output stacked data
-        cc_final,ngood_final,stamps_final,allstacks1,allstacks2,allstacks3,nstacks = noise_module.stacking(cc_array[indx],cc_time[indx],cc_ngood[indx],stack_para)
-        if not len(allstacks1):continue
-        if rotation:
-            bigstack[icomp] =allstacks1
-            if stack_method == 'all':
-                bigstack1[icomp]=allstacks2
-                bigstack2[icomp]=allstacks3
-
-        # write stacked data into ASDF file
-        with pyasdf.ASDFDataSet(stack_h5,mpi=False) as ds:
-            tparameters['time']  = stamps_final[0]
+
+        t1=time.time()
+        if flag:print('loading CCF data takes %6.2fs'%(t1-t0))
+
+        # continue when there is no data
+        if iseg <= 1: continue
+        outfn = pairs_all[ipair]+'.h5'         
+        if flag:print('ready to output to %s'%(outfn))                     
+
+        # loop through cross-component for stacking
+        iflag=1
+        results = []
+        for icomp in range(nccomp):
+            comp = enz_system[icomp]
+            indx = np.where(cc_comp==comp)[0]
+
+            # jump if there are not enough data
+            if len(indx)<2: 
+                iflag=0;break
+
+            # output stacked data: the robust stacks of all cross-components are done at once below
+            res = list(noise_module.stacking(cc_array[indx],cc_time[indx],cc_ngood[indx],stack_para,robust=False))
+            if not len(res[3]):continue
+            results.append((icomp,res))
+
+        if stack_method in ['robust','all'] and len(results):
+            t2=time.time()
+            rstacks = noise_module.robust_stack_groups([res[0] for icomp,res in results],0.001)
+            for ii in range(len(results)):
+                results[ii][1][3 if stack_method=='robust' else 5] = rstacks[ii]
+            if flag:print('takes %6.2fs to robust stack %d components' %(time.time()-t2,len(results)))
+
+        for icomp,res in results:
+            comp = enz_system[icomp]
+            cc_final,ngood_final,stamps_final,allstacks1,allstacks2,allstacks3,nstacks = res
+            tstart = stamps_final[0]
+            if rotation:
+                bigstack[0,icomp] = allstacks1
+                if stack_method == 'all':
+                    bigstack[1,icomp] = allstacks2
+                    bigstack[2,icomp] = allstacks3
+
+            # stacked data to write into ASDF file
+            tparameters['time']  = tstart
             tparameters['ngood'] = nstacks
             if stack_method != 'all':
-                data_type = 'Allstack_'+stack_method
-                ds.add_auxiliary_data(data=allstacks1, data_type=data_type, path=comp, parameters=tparameters)
+                outputs.append((allstacks1,'Allstack_'+stack_method,comp,dict(tparameters)))
             else:
-                ds.add_auxiliary_data(data=allstacks1, data_type='Allstack_linear', path=comp, parameters=tparameters)
-                ds.add_auxiliary_data(data=allstacks2, data_type='Allstack_pws', path=comp, parameters=tparameters)
-                ds.add_auxiliary_data(data=allstacks3, data_type='Allstack_robust', path=comp, parameters=tparameters)
-
-        # keep a track of all sub-stacked data from S1
-        if keep_substack:
-            for ii in range(cc_final.shape[0]):
-                with pyasdf.ASDFDataSet(stack_h5,mpi=False) as ds:
-                    tparameters['time']  = stamps_final[ii]
-                    tparameters['ngood'] = ngood_final[ii]
-                    data_type = 'T'+str(int(stamps_final[ii]))
-                    ds.add_auxiliary_data(data=cc_final[ii], data_type=data_type, path=comp, parameters=tparameters)            
+                outputs.append((allstacks1,'Allstack_linear',comp,dict(tparameters)))
+                outputs.append((allstacks2,'Allstack_pws',comp,dict(tparameters)))
+                outputs.append((allstacks3,'Allstack_robust',comp,dict(tparameters)))
+
+            # keep a track of all sub-stacked data from S1
+            if keep_substack:
+                subs.append((comp,cc_final,stamps_final,ngood_final,dict(tparameters)))
+
+        # all sub-stacks rotated at once
+        if rsubs and iflag:
+            rparameters = dict(tparameters,station_source=ssta,station_receiver=rsta)
+            fsubs = {comp:(tdata,ttime,tgood) for comp,tdata,ttime,tgood,tpara in subs}
+            for comp,tdata,ttime,tgood in noise_module.rotate_substacks(fsubs,enz_system,rtz_components,rparameters,rot_locs):
+                subs.append((comp,tdata,ttime,tgood,dict(rparameters)))
         
         t3 = time.time()
-        if flag:print('takes %6.2fs to stack one component with %s stacking method' %(t3-t1,stack_method))
+        if flag:print('takes %6.2fs to stack all components with %s stacking method' %(t3-t1,stack_method))
 
     # do rotation if needed
-    if rotation and iflag:
-        if np.all(bigstack==0):continue
+    if rotation and iflag and not np.all(bigstack[0]==0):
         tparameters['station_source'] = ssta
         tparameters['station_receiver'] = rsta
-        if stack_method!='all':
-            bigstack_rotated = noise_module.rotation(bigstack,tparameters,locs,flag)
-
-            # write to file
-            for icomp in range(nccomp):
-                comp  = rtz_components[icomp]
-                tparameters['time']  = stamps_final[0]
-                tparameters['ngood'] = nstacks
-                data_type = 'Allstack_'+stack_method
-                with pyasdf.ASDFDataSet(stack_h5,mpi=False) as ds2:
-                    ds2.add_auxiliary_data(data=bigstack_rotated[icomp], data_type=data_type, path=comp, parameters=tparameters)
-        else:
-            bigstack_rotated  = noise_module.rotation(bigstack,tparameters,locs,flag)
-            bigstack_rotated1 = noise_module.rotation(bigstack1,tparameters,locs,flag)
-            bigstack_rotated2 = noise_module.rotation(bigstack2,tparameters,locs,flag)
-
-            # write to file
-            for icomp in range(nccomp):
-                comp=rtz_components[icomp]
-                tparameters['time']  = stamps_final[0]
-                tparameters['ngood'] = nstacks
-                with pyasdf.ASDFDataSet(stack_h5,mpi=False) as ds2:
-                    ds2.add_auxiliary_data(data=bigstack_rotated[icomp], data_type='Allstack_linear', path=comp, parameters=tparameters)    
-                    ds2.add_auxiliary_data(data=bigstack_rotated1[icomp], data_type='Allstack_pws', path=comp, parameters=tparameters)
-                    ds2.add_auxiliary_data(data=bigstack_rotated2[icomp], data_type='Allstack_robust', path=comp, parameters=tparameters)
+        tparameters['time']  = tstart
+        tparameters['ngood'] = nstacks
+        bigstack_rotated = noise_module.rotation(bigstack,tparameters,rot_locs,flag)
+        for icomp in range(nccomp):
+            for imethod in range(len(rmethods)):
+                outputs.append((bigstack_rotated[imethod,icomp],'Allstack_'+rmethods[imethod],rtz_components[icomp],dict(tparameters)))
+
+    # write all outputs of the station pair at once
+    if len(outputs) or len(subs) or (keep_substack and len(tbads)):
+        with pyasdf.ASDFDataSet(stack_h5,mpi=False) as ds:
+            if keep_substack:
+                for comp,tbad in tbads:noise_module.remove_substacks(ds,comp,tbad)
+            for comp,tdata,ttime,tgood,tpara in subs:
+                noise_module.write_substacks(ds,comp,tdata,ttime,tgood,tpara,substack_2d)
+            # the stacks of a former run are replaced (once, as the first output of a path is the one kept)
+            replaced = set()
+            for tdata,data_type,path,tpara in outputs:
+                if append and (data_type,path) not in replaced:
+                    replaced.add((data_type,path))
+                    if data_type in ds.auxiliary_data.list() and path in ds.auxiliary_data[data_type].list():
+                        del ds.auxiliary_data[data_type][path]
+                ds.add_auxiliary_data(data=tdata, data_type=data_type, path=path, parameters=tpara)
+
+            # accumulators kept for append runs
+            if stream and stack_method in stream_methods:
+                for icomp in range(nccomp):
+                    noise_module.write_stack_state(ds,enz_system[icomp],accs[icomp],stack_method)
+    if rotation and iflag and np.all(bigstack[0]==0):continue
 
     t4 = time.time()
     if flag:print('takes %6.2fs to stack/rotate all station pairs %s' %(t4-t1,pairs_all[ipair]))
@@ -983,6 +983,81 @@ def stacking_rma(cc_array,cc_time,cc_ngood,stack_para):
     # good to return
     return cc_array,cc_ngood,cc_time,allstacks1,allstacks2,allstacks3,nstacks
 
+def read_substacks(ds,comp,tmin=None,tmax=None,lag=None):
+    '''
+    this function reads the sub-stacks of a cross-component from the ASDF file of S2 within a time range
+    and a lag window. the 2D layout of write_substacks (sorted in time) is read with a single slice while
+    the sub-stacks stored as T<timestamp> groups are read one by one (used in monitoring)
+    PARAMETERS:
+    ----------------------
+    ds:   pyasdf dataset of the stacks
+    comp: cross-component (e.g., 'ZZ')
+    tmin, tmax: time range of the sub-stacks (UTCDateTime or timestamps; None for no limit)
+    lag:  maximum lag (s) or [minlag,maxlag] of the lag window (None for all lags)
+    RETURNS:
+    ----------------------
+    data:  2D matrix of the sub-stacks (time x lag)
+    times: timestamps of the sub-stacks
+    ngood: number of segments of each sub-stack
+    tvec:  lag times (s) of the columns of data
+    '''
+    tmin = -np.inf if tmin is None else obspy.UTCDateTime(tmin).timestamp
+    tmax = np.inf if tmax is None else obspy.UTCDateTime(tmax).timestamp
+    grp  = ds._auxiliary_data_group
+
+    if 'Substack' in grp.keys() and comp in grp['Substack'].keys():
+        dset  = grp['Substack'][comp]
+        ttime = grp['Substack_time'][comp][:]
+        dt    = dset.attrs['dt']
+        npts  = dset.shape[1]
+    else:
+        # sub-stacks of one T<timestamp> group each
+        tlist = [tname for tname in grp.keys() if tname[0]=='T' and tname[1:].isdigit() and comp in grp[tname].keys()]
+        if not len(tlist):
+            raise ValueError('no sub-stacks of %s found'%comp)
+        ttime = np.array([[grp[tname][comp].attrs['time'],grp[tname][comp].attrs['ngood']] for tname in tlist],dtype=np.float64)
+        tindx = np.argsort(ttime[:,0],kind='stable')
+        tlist = [tlist[ii] for ii in tindx]
+        ttime = ttime[tindx]
+        dt    = grp[tlist[0]][comp].attrs['dt']
+        npts  = grp[tlist[0]][comp].shape[0]
+
+    # lag window
+    tvec = (np.arange(npts)-npts//2)*dt
+    if lag is None:
+        lag = [tvec[0],tvec[-1]]
+    elif np.isscalar(lag):
+        lag = [-lag,lag]
+    jindx = np.where((tvec>=lag[0]-dt/2)&(tvec<=lag[1]+dt/2))[0]
+    j0,j1 = (jindx[0],jindx[-1]+1) if len(jindx) else (0,0)
+
+    # time range: a single slice for sorted rows
+    if np.all(np.diff(ttime[:,0])>=0):
+        i0 = np.searchsorted(ttime[:,0],tmin,side='left')
+        i1 = np.searchsorted(ttime[:,0],tmax,side='right')
+        iindx = np.arange(i0,i1)
+    else:
+        iindx = np.where((ttime[:,0]>=tmin)&(ttime[:,0]<=tmax))[0]
+
+    if 'Substack' in grp.keys() and comp in grp['Substack'].keys():
+        if len(iindx) and iindx[-1]-iindx[0]+1 == len(iindx):
+            data = dset[iindx[0]:iindx[-1]+1,j0:j1]
+        elif len(iindx):
+            data = dset[iindx,j0:j1]
+        else: data = np.zeros((0,j1-j0),dtype=dset.dtype)
+    else:
+        data = np.zeros((len(iindx),j1-j0),dtype=np.float32)
+        for ii,irow in enumerate(iindx):
+            data[ii] = grp[tlist[irow]][comp][j0:j1]
+
+    # rows appended out of order (e.g., by an append run of S2) are returned in time order
+    tindx = np.argsort(ttime[iindx,0],kind='stable')
+    if np.any(np.diff(tindx)<0):
+        data,iindx = data[tindx],iindx[tindx]
+
+    return data,ttime[iindx,0],ttime[iindx,1],tvec[j0:j1]
+
+
 def rotation(bigstack,parameters,locs,flag):
     '''
     this function transfers the Green's tensor from a E-N-Z system into a R-T-Z one
@@ -1,23 +1,33 @@
 import os
+import re
 import glob
 import copy
+import fnmatch
+import fractions
+import collections
+import concurrent.futures
 import obspy
 import scipy
 import time
 import pycwt
+import h5py
 import pyasdf
 import datetime
+import threading
+import multiprocessing
 import numpy as np
 import pandas as pd
 from numba import jit
+from lxml import etree
 from scipy.signal import hilbert
 from obspy.signal.util import _npts2nfft
-from obspy.signal.invsim import cosine_taper
+from obspy.signal.invsim import cosine_taper, cosine_sac_taper, invert_spectrum
 from scipy.fftpack import fft,ifft,next_fast_len
 from obspy.signal.filter import bandpass,lowpass
 from obspy.signal.regression import linear_regression
 from obspy.core.util.base import _get_function_from_entry_point
 from obspy.core.inventory import Inventory, Network, Station, Channel, Site
+from obspy.clients.fdsn.header import FDSNNoDataException
 
 
 '''
@@ -35,6 +45,16 @@ by: Chengxin Jiang (chengxin_jiang@fas.harvard.edu)
 several utility functions are modified based on https://github.com/tclements/noise
 '''
 
+# inverse response operators (and response spectrum files) already evaluated in this process, shared by all
+# calls of preprocess_raw: see inverse_resp_operator and resp_spectrum
+resp_cache = {'ops':collections.OrderedDict(),'files':{},'max_bytes':500*1024**2,'nbytes':0,'hits':0,'misses':0}
+
+# second-order sections of the butterworth filters already designed in this process: see bandpass_sos
+sos_cache = {}
+
+# polyphase filters of each resampling ratio and shift: see resample_poly_shift
+resample_cache = {}
+
 ####################################################
 ############## CORE FUNCTIONS ######################
 ####################################################
@@ -71,51 +91,254 @@ def get_event_list(str1,str2,inc_hours):
 
     return event
 
+def stage_memory(plan_para,inc_hours,nblock=None,nbatch=1):
+    '''
+    this function predicts the memory (in GB) needed per process by each step of NoisePy for a given
+    chunk length, receiver block size of S1 and loading batch of S2 (assuming float32/complex64 data)
+    (used in S0A, S0B, S1 & S2)
+    PARAMETERS:
+    ----------------------
+    plan_para: dict of the parameters needed, see plan_chunks
+    inc_hours: length of the time chunk (in hours)
+    nblock:    number of channels of each block in S1 (None for all channels at once)
+    nbatch:    number of CCF files loaded at once in S2
+    RETURNS:
+    ----------------------
+    mem: dict of the memory of each step (S0, S1 and S2) and of the spectra of one channel in S1 (row)
+    '''
+    sps    = plan_para['samp_freq']
+    cc_len = plan_para['cc_len']
+    step   = plan_para['step']
+    ncomp  = plan_para['ncomp']
+    nchan  = plan_para['nsta']*ncomp
+    if 'raw_freq' in plan_para.keys():
+        raw_freq = plan_para['raw_freq']
+    else: raw_freq = sps
+    if 'nworker' in plan_para.keys():
+        nworker  = plan_para['nworker']
+    else: nworker = 1
+
+    nseg  = max(int(np.floor((inc_hours*3600-cc_len)/step)),1)
+    npts  = int(cc_len*sps)
+    nnfft = int(next_fast_len(npts))
+    nlag  = int(2*plan_para['maxlag']*sps)+1
+
+    # S0: raw data of one chunk and its float64 copies while filtering and removing response
+    mem_s0 = nworker*inc_hours*3600*raw_freq*8*3
+
+    # S1: spectra of each channel + reading/whitening one channel + correlating one pair
+    row  = nseg*(nnfft//2)*8+nseg*12
+    work = inc_hours*3600*sps*4+nseg*npts*8+nseg*nnfft*8+nseg*(nnfft//2)*8+nseg*nlag*8
+    if nblock is None or nblock >= nchan:
+        mem_s1 = nchan*row+work
+    else:
+        mem_s1 = 2*nblock*row+work
+
+    # S2: (sub-)stacks of all cross-components in each CCF file + the final stacks
+    nsub = 1
+    if plan_para['substack']:
+        if plan_para['substack_len']==cc_len:
+            nsub = nseg
+        else:
+            nsub = max(int(inc_hours/(plan_para['substack_len']/3600)),1)
+    mem_s2 = nbatch*ncomp*ncomp*nsub*(nlag*4+10)+9*nlag*4*4
+
+    return {'S0':mem_s0/1024**3,'S1':mem_s1/1024**3,'S2':mem_s2/1024**3,'row':row/1024**3,'work':work/1024**3,\
+        'file':(mem_s2-9*nlag*16)/nbatch/1024**3}
+
+
+def plan_chunks(plan_para,verbose=True):
+    '''
+    this function plans the chunk length (inc_hours), the receiver block size of S1 and the number of CCF
+    files loaded at once in S2 so that every step stays below MAX_MEM, and prints the predicted memory and
+    work load. it replaces the separate memory checks of each step. (used in S0A, S0B, S1 & S2)
+    PARAMETERS:
+    ----------------------
+    plan_para: dict containing
+        nsta:      number of stations (channels when ncomp is 1)
+        ncomp:     number of components of each station
+        samp_freq, cc_len, step, maxlag: parameters of the cross-correlations (samp_freq after downsampling)
+        substack, substack_len: sub-stacking parameters of S1
+        MAX_MEM:   maximum memory allowed per process in GB
+        inc_hours: proposed length of the time chunks (in hours)
+        fix_inc:   (optional) True when the chunks already exist (S1, S2) and inc_hours cannot be changed
+        nfile:     (optional) number of CCF files to be stacked in S2
+        raw_freq, nworker: (optional) raw sampling rate and processes per rank in S0 (needed by S0A and
+                   S0B; samp_freq is used as the raw sampling rate otherwise)
+    verbose: print the plan or not
+    RETURNS:
+    ----------------------
+    plan: dict of inc_hours, nblock (channels per block in S1), nbatch (CCF files per load in S2) and
+        the predicted memory of each step
+    '''
+    MAX_MEM   = plan_para['MAX_MEM']
+    inc_hours = plan_para['inc_hours']
+    cc_len    = plan_para['cc_len']
+    nchan     = plan_para['nsta']*plan_para['ncomp']
+    if 'nfile' in plan_para.keys():
+        nfile = plan_para['nfile']
+    else: nfile = 1
+
+    # candidate chunk length: the proposed one or shorter chunks dividing a day
+    if 'fix_inc' in plan_para.keys() and plan_para['fix_inc']:
+        candidates = [inc_hours]
+    else:
+        candidates = [inc_hours]+[hh for hh in [24,12,8,6,4,3,2,1] if hh<inc_hours and hh*3600>cc_len]
+
+    # keep the longest chunk for which S0 and S1 (with all channels in memory if possible) fit
+    plan = None
+    for tinc in candidates:
+        mem = stage_memory(plan_para,tinc)
+        if mem['S0'] > MAX_MEM: continue
+        if mem['S1'] <= MAX_MEM:
+            plan = {'inc_hours':tinc,'nblock':nchan};break
+        nblock = int((MAX_MEM-mem['work'])/(2*mem['row']))
+        if plan is None and nblock >= 1:
+            plan = {'inc_hours':tinc,'nblock':nblock}
+    if plan is None:
+        raise ValueError('Abort! no chunk length between %sh and %sh fits in %5.3fG memory'%(candidates[-1],candidates[0],MAX_MEM))
+
+    # number of CCF files loaded at once in S2
+    mem = stage_memory(plan_para,plan['inc_hours'])
+    nbatch = int((MAX_MEM-(mem['S2']-mem['file']))/mem['file'])
+    if nbatch < 1:
+        raise ValueError('Abort! the sub-stacks of one CCF file need more than %5.3fG memory'%MAX_MEM)
+    plan['nbatch'] = min(nbatch,nfile)
+    plan['mem'] = stage_memory(plan_para,plan['inc_hours'],plan['nblock'],plan['nbatch'])
+
+    # predicted work load
+    nblk = int(np.ceil(nchan/plan['nblock']))
+    if not verbose: return plan
+    print('chunk plan: %sh chunks (%sh proposed) with %5.3fG memory allowed per process' % (plan['inc_hours'],inc_hours,MAX_MEM))
+    if 'raw_freq' in plan_para.keys():
+        print('  S0: %6.3fG per rank for raw data at %sHz' % (plan['mem']['S0'],plan_para['raw_freq']))
+    else:
+        print('  S0: %6.3fG per rank' % plan['mem']['S0'])
+    print('  S1: %6.3fG for %d channels in %d block(s) of %d (%d block loads per chunk)' % (plan['mem']['S1'],nchan,\
+        nblk,plan['nblock'],nblk*(nblk+1)//2))
+    print('  S2: %6.3fG loading %d of %d CCF file(s) at once (%d batches per pair)' % (plan['mem']['S2'],plan['nbatch'],\
+        nfile,int(np.ceil(nfile/plan['nbatch']))))
+
+    return plan
+
+
+
+def band_code_freq(channels):
+    '''
+    this function gives the highest sampling rate allowed by the SEED band code (first letter) of the
+    channels. it is used to plan the memory of S0A when the raw sampling rate is not known before the
+    download: unknown band codes are taken as broadband channels (used in S0A)
+    PARAMETERS:
+    ----------------------
+    channels: list of channel names (e.g., ['HHZ','BHZ'])
+    RETURNS:
+    ----------------------
+    raw_freq: upper bound of the sampling rate (Hz) of all channels
+    '''
+    band_freq = {'F':5000,'G':5000,'D':1000,'C':1000,'E':250,'H':250,'S':80,'B':80,'M':10,'L':1,'V':0.1,'U':0.01}
+    return max([band_freq.get(str(chan)[:1].upper(),250) for chan in channels])
+
+
+def raw_sampling_rate(findex):
+    '''
+    this function reads the header of the first SAC/mseed file of each channel in the file index to get the
+    highest raw sampling rate, which is used to plan the memory of S0B (used in S0B)
+    PARAMETERS:
+    ----------------------
+    findex: file index made by make_file_index
+    RETURNS:
+    ----------------------
+    raw_freq: highest sampling rate (Hz) of the raw data (None if no header can be read)
+    '''
+    raw_freq = None
+    for key in findex.keys():
+        if not len(findex[key]['files']): continue
+        try:
+            tr = obspy.read(findex[key]['files'][0],headonly=True)
+        except Exception as e:
+            print(e);continue
+        tfreq = max([ttr.stats.sampling_rate for ttr in tr])
+        if raw_freq is None or tfreq > raw_freq: raw_freq = tfreq
+    return raw_freq
+
 def make_timestamps(prepro_para):
     '''
     this function prepares the timestamps of both the starting and ending time of each mseed/sac file that
     is stored on local machine. this time info is used to search all stations in specific time chunck
-    when preparing noise data in ASDF format. it creates a csv file containing all timestamp info if the
-    file does not exist (used in S0B)f
+    when preparing noise data in ASDF format. the timestamps are cached in a csv file together with the
+    size and modification time of each file, so that only new or changed files are scanned again when the
+    script is re-run. for messy data, only the headers are read and the scan is spread over a process pool
+    (used in S0B)
     PARAMETERS:
     -----------------------
     prepro_para: a dic containing all pre-processing parameters used in S0B
     RETURNS:
     -----------------------
+    allfiles:   list of all SAC/mseed files found in allfiles_path
     all_stimes: numpy float array containing startting and ending time for all SAC/mseed files
+    all_ids:    list of 'network.station.channel' read from the header of each file ('' if header is not read)
     '''
     # load parameters from para dic
     wiki_file = prepro_para['wiki_file']
     messydata = prepro_para['messydata']
     RAWDATA   = prepro_para['RAWDATA']
     allfiles_path = prepro_para['allfiles_path']
-
+    if 'ncore' in prepro_para.keys():
+        ncore = prepro_para['ncore']
+    else:
+        ncore = multiprocessing.cpu_count()
+
+    allfiles = sorted(glob.glob(allfiles_path))
+    nfiles   = len(allfiles)
+    if not nfiles: raise ValueError('Abort! no data found in subdirectory of %s'%RAWDATA)
+    all_stimes = np.zeros(shape=(nfiles,2),dtype=np.float64)
+    all_ids    = ['']*nfiles
+
+    # size and modification time are used to tell whether a file has changed since last scan
+    fsize  = np.zeros(nfiles,dtype=np.int64)
+    fmtime = np.zeros(nfiles,dtype=np.int64)
+    for ii in range(nfiles):
+        fstat = os.stat(allfiles[ii])
+        fsize[ii]  = fstat.st_size
+        fmtime[ii] = fstat.st_mtime_ns
+
+    # reuse the timestamps of files that are unchanged since the last scan
+    rescan = np.ones(nfiles,dtype=bool)
     if os.path.isfile(wiki_file):
         tmp = pd.read_csv(wiki_file)
-        allfiles = tmp['names']
-        all_stimes = np.zeros(shape=(len(allfiles),2),dtype=np.float)
-        all_stimes[:,0] = tmp['starttime']
-        all_stimes[:,1] = tmp['endtime']
-
-    # have to read each sac/mseed data one by one
-    else:
-        allfiles = glob.glob(allfiles_path)
-        nfiles   = len(allfiles)
-        if not nfiles: raise ValueError('Abort! no data found in subdirectory of %s'%RAWDATA)
-        all_stimes = np.zeros(shape=(nfiles,2),dtype=np.float)
-
+        indx = {name:ii for ii,name in enumerate(tmp['names'].to_numpy())}
+        jindx = np.array([indx.get(name,-1) for name in allfiles],dtype=np.int64)
+        found = np.where(jindx>=0)[0]
+        # old wiki files have no size/mtime info: trust them as they are
+        if 'size' in tmp.columns and 'mtime' in tmp.columns:
+            same  = (tmp['size'].to_numpy()[jindx[found]]==fsize[found])&(tmp['mtime'].to_numpy()[jindx[found]]==fmtime[found])
+            found = found[same]
+        all_stimes[found,0] = tmp['starttime'].to_numpy()[jindx[found]]
+        all_stimes[found,1] = tmp['endtime'].to_numpy()[jindx[found]]
+        if 'id' in tmp.columns:
+            tids = tmp['id'].fillna('').astype(str).to_numpy()[jindx[found]]
+            for ii,tid in zip(found,tids): all_ids[ii] = tid
+        rescan[found] = False
+    sindx = np.where(rescan)[0]
+    print('%d files in total and %d of them are new or changed'%(nfiles,len(sindx)))
+
+    if len(sindx):
         if messydata:
             # get VERY precise trace-time from the header
-            for ii in range(nfiles):
-                try:
-                    tr = obspy.read(allfiles[ii])
-                    all_stimes[ii,0] = tr[0].stats.starttime-obspy.UTCDateTime(1970,1,1)
-                    all_stimes[ii,1] = tr[0].stats.endtime-obspy.UTCDateTime(1970,1,1)
-                except Exception as e:
-                    print(e);continue
+            sfiles = [allfiles[ii] for ii in sindx]
+            if ncore > 1:
+                with multiprocessing.Pool(ncore) as pool:
+                    sinfo = pool.map(header_timestamps,sfiles,chunksize=max(1,len(sfiles)//(ncore*16)))
+            else:
+                sinfo = [header_timestamps(ifile) for ifile in sfiles]
+            for ii,tinfo in zip(sindx,sinfo):
+                all_stimes[ii] = tinfo[:2]
+                all_ids[ii]    = tinfo[2]
+                # failed reads (e.g., temporary I/O errors) are saved with a size of -1 to be scanned again
+                if not len(tinfo[2]): fsize[ii] = -1
         else:
             # get rough estimates of the time based on the folder: need modified to accommodate your data
-            for ii in range(nfiles):
+            for ii in sindx:
                 year  = int(allfiles[ii].split('/')[-2].split('_')[1])
                 #julia = int(allfiles[ii].split('/')[-2].split('_')[2])
                 #all_stimes[ii,0] = obspy.UTCDateTime(year=year,julday=julia)-obspy.UTCDateTime(year=1970,month=1,day=1)
@@ -124,12 +347,80 @@ def make_timestamps(prepro_para):
                 all_stimes[ii,0] = obspy.UTCDateTime(year=year,month=month,day=day)-obspy.UTCDateTime(year=1970,month=1,day=1)
                 all_stimes[ii,1] = all_stimes[ii,0]+86400
 
-        # save name and time info for later use if the file not exist
-        if not os.path.isfile(wiki_file):
-            wiki_info = {'names':allfiles,'starttime':all_stimes[:,0],'endtime':all_stimes[:,1]}
-            df = pd.DataFrame(wiki_info,columns=['names','starttime','endtime'])
-            df.to_csv(wiki_file)
-    return all_stimes
+    # save name and time info for later use when anything changes
+    if len(sindx) or not os.path.isfile(wiki_file):
+        wiki_info = {'names':allfiles,'starttime':all_stimes[:,0],'endtime':all_stimes[:,1],'size':fsize,'mtime':fmtime,'id':all_ids}
+        df = pd.DataFrame(wiki_info,columns=['names','starttime','endtime','size','mtime','id'])
+        df.to_csv(wiki_file,index=False)
+    return allfiles,all_stimes,all_ids
+
+def make_file_index(allfiles,all_stimes,all_ids,locs):
+    '''
+    this function builds an index from each (network,station,channel) in the station list to the time
+    intervals of the SAC/mseed files recording it, sorted by their starting time. the channel is matched
+    exactly using the header id when available and otherwise using the tokens of the file path, so that
+    stations whose names are substrings of others are not mixed up (used in S0B)
+    PARAMETERS:
+    -----------------------
+    allfiles:   list of all SAC/mseed files
+    all_stimes: numpy float array containing startting and ending time for all SAC/mseed files
+    all_ids:    list of 'network.station.channel' of all files ('' if unknown)
+    locs:       panda data frame of the station list
+    RETURNS:
+    -----------------------
+    findex: dict of (network,station,channel) -> dict of 'starttime','endtime','maxend' and 'files',
+        where maxend is the running maximum of endtime used to bound interval-overlap queries
+    '''
+    # group the file indexes by their channel id
+    by_id = {};by_token = {}
+    for ii in range(len(allfiles)):
+        if all_ids[ii]:
+            by_id.setdefault(all_ids[ii],[]).append(ii)
+        else:
+            # 'station in ifile' matches substrings: use exact tokens of the file path instead
+            for token in set(re.split('[^A-Za-z0-9]+',allfiles[ii])):
+                by_token.setdefault(token,[]).append(ii)
+
+    findex = {}
+    for ista in range(len(locs)):
+        network = str(locs.iloc[ista]['network'])
+        station = str(locs.iloc[ista]['station'])
+        comp    = str(locs.iloc[ista]['channel'])
+        indx = by_id.get(network+'.'+station+'.'+comp,[])
+        if station in by_token and comp in by_token:
+            indx = indx+sorted(set(by_token[station])&set(by_token[comp]))
+        if not len(indx): continue
+
+        indx  = np.array(indx)
+        order = np.argsort(all_stimes[indx,0],kind='stable')
+        indx  = indx[order]
+        findex[(network,station,comp)] = {'starttime':all_stimes[indx,0],'endtime':all_stimes[indx,1],\
+            'maxend':np.maximum.accumulate(all_stimes[indx,1]),'files':[allfiles[ii] for ii in indx]}
+    return findex
+
+
+def query_file_index(findex,key,time1,time2):
+    '''
+    this function finds all files of a channel in the index that overlap with the time window [time1,time2]
+    by two binary searches on the sorted starting times and the running maximum of ending times (used in S0B)
+    PARAMETERS:
+    -----------------------
+    findex: file index created by make_file_index
+    key:    tuple of (network,station,channel)
+    time1,time2: starting and ending time of the window in seconds since 1970
+    RETURNS:
+    -----------------------
+    tfiles: list of files having data in the time window
+    '''
+    if key not in findex: return []
+    tindex = findex[key]
+
+    # files starting before time2 and whose running max ending time passes time1
+    ihigh = np.searchsorted(tindex['starttime'],time2,side='left')
+    ilow  = np.searchsorted(tindex['maxend'],time1,side='right')
+    if ilow >= ihigh: return []
+    tindx = ilow+np.where(tindex['endtime'][ilow:ihigh]>time1)[0]
+    return [tindex['files'][ii] for ii in tindx]
 
 def preprocess_raw(st,inv,prepro_para,date_info):
     '''
@@ -164,6 +455,12 @@ def preprocess_raw(st,inv,prepro_para,date_info):
     freqmin       = prepro_para['freqmin']
     freqmax       = prepro_para['freqmax']
     samp_freq     = prepro_para['samp_freq']
+    if 'resample' in prepro_para.keys():
+        resample  = prepro_para['resample']
+    else:
+        resample  = 'interpolate'
+    if 'resp_cache_mb' in prepro_para.keys():
+        resp_cache['max_bytes'] = prepro_para['resp_cache_mb']*1024**2
 
     # parameters for butterworth filter
     f1 = 0.9*freqmin;f2=freqmin
@@ -182,36 +479,50 @@ def preprocess_raw(st,inv,prepro_para,date_info):
     sps = int(st[0].stats.sampling_rate)
     station = st[0].stats.station
 
-    # remove nan/inf, mean and trend of each trace before merging
-    for ii in range(len(st)):
-
-        #-----set nan/inf values to zeros (it does happens!)-----
-        tttindx = np.where(np.isnan(st[ii].data))
-        if len(tttindx) >0:st[ii].data[tttindx]=0
-        tttindx = np.where(np.isinf(st[ii].data))
-        if len(tttindx) >0:st[ii].data[tttindx]=0
+    # time covered by data: the rest is zero-filled when merging/trimming
+    intervals = [[tr.stats.starttime,tr.stats.endtime] for tr in st]
 
-        st[ii].data = np.float32(st[ii].data)
-        st[ii].data = scipy.signal.detrend(st[ii].data,type='constant')
-        st[ii].data = scipy.signal.detrend(st[ii].data,type='linear')
+    # remove nan/inf (it does happens!), mean and trend of each trace before merging in one fused pass
+    for ii in range(len(st)):
+        st[ii].data = np.require(st[ii].data,dtype=np.float32,requirements=['C','W'])
+        if len(st)==1:
+            wlen = taper_length(st[0].stats.npts,sps)
+        else: wlen = 0
+        clean_detrend_taper(st[ii].data,wlen)
 
     # merge, taper and filter the data
-    if len(st)>1:st.merge(method=1,fill_value=0)
-    st[0].taper(max_percentage=0.05,max_length=50)	# taper window
-    st[0].data = np.float32(bandpass(st[0].data,pre_filt[0],pre_filt[-1],df=sps,corners=4,zerophase=True))
+    if len(st)>1:
+        st.merge(method=1,fill_value=0)
+        st[0].taper(max_percentage=0.05,max_length=50)	# taper window
+    st[0].data = bandpass_sos(st[0].data,pre_filt[0],pre_filt[-1],sps,corners=4)
 
     # make downsampling if needed
     if abs(samp_freq-sps) > 1E-4:
-        # downsampling here
-        st.interpolate(samp_freq,method='weighted_average_slopes')
-        delta = st[0].stats.delta
+        if resample == 'poly':
+            ratio = resample_ratio(st[0].stats.sampling_rate,samp_freq)
+        else: ratio = None
+
+        if ratio is not None:
+            # polyphase filter for rational ratios, moving the first sample to the next sampling point at once
+            delta = 1/samp_freq
+            fric  = st[0].stats.starttime.microsecond%(delta*1E6)
+            if fric>1E-4:
+                shift = 1-fric/(delta*1E6)
+            else: shift = 0.
+            st[0].data = resample_poly_shift(st[0].data,ratio[0],ratio[1],shift)
+            st[0].stats.sampling_rate = samp_freq
+            st[0].stats.starttime += shift*delta
+        else:
+            # downsampling here
+            st.interpolate(samp_freq,method='weighted_average_slopes')
+            delta = st[0].stats.delta
 
-        # when starttimes are between sampling points
-        fric = st[0].stats.starttime.microsecond%(delta*1E6)
-        if fric>1E-4:
-            st[0].data = segment_interpolate(np.float32(st[0].data),float(fric/(delta*1E6)))
-            #--reset the time to remove the discrepancy---
-            st[0].stats.starttime-=(fric*1E-6)
+            # when starttimes are between sampling points
+            fric = st[0].stats.starttime.microsecond%(delta*1E6)
+            if fric>1E-4:
+                st[0].data = segment_interpolate(np.float32(st[0].data),float(fric/(delta*1E6)))
+                #--reset the time to remove the discrepancy---
+                st[0].stats.starttime-=(fric*1E-6)
 
     # remove traces of too small length
 
@@ -228,15 +539,16 @@ def preprocess_raw(st,inv,prepro_para,date_info):
             else:
                 try:
                     print('removing response for %s using inv'%st[0])
-                    st[0].attach_response(inv)
-                    st[0].remove_response(output=rm_resp_out,pre_filt=pre_filt,water_level=60)
+                    remove_resp_cached(st[0],inv,pre_filt,output=rm_resp_out,water_level=60)
                 except Exception:
                     st = []
                     return st
 
         elif rm_resp == 'spectrum':
             print('remove response using spectrum')
-            specfile = glob.glob(os.path.join(respdir,'*'+station+'*'))
+            if station not in resp_cache['files'].keys():
+                resp_cache['files'][station] = glob.glob(os.path.join(respdir,'*'+station+'*'))
+            specfile = resp_cache['files'][station]
             if len(specfile)==0:
                 raise ValueError('no response sepctrum found for %s' % station)
             st = resp_spectrum(st,specfile[0],samp_freq,pre_filt)
@@ -262,6 +574,7 @@ def preprocess_raw(st,inv,prepro_para,date_info):
     ntr = obspy.Stream()
     # trim a continous segment into user-defined sequences
     st[0].trim(starttime=date_info['starttime'],endtime=date_info['endtime'],pad=True,fill_value=0)
+    st[0].stats.gap_mask = gap_mask(intervals,st[0].stats.starttime,st[0].stats.npts,st[0].stats.sampling_rate)
     ntr.append(st[0])
 
     return ntr
@@ -399,6 +712,567 @@ def sta_info_from_inv(inv):
     return sta,net,lon,lat,elv,location
 
 
+def asdf_station_info(h5file):
+    '''
+    this function parses the StationXML of all stations in an ASDF file once and keeps the station info
+    that is needed in S1, which avoids building the obspy inventory of every station through pyasdf.
+    (used in S1)
+    PARAMETERS:
+    ----------------------
+    h5file: h5py file object of the ASDF file
+    RETURNS:
+    ----------------------
+    sta_info: dict of 'network.station' -> (sta,net,lon,lat,elv,location), same as sta_info_from_inv
+    '''
+    sta_info = {}
+    for tmps in h5file['Waveforms'].keys():
+        if 'StationXML' not in h5file['Waveforms'][tmps]: continue
+        try:
+            root = etree.fromstring(h5file['Waveforms'][tmps]['StationXML'][()].tobytes())
+            inet = root.find('{*}Network')
+            ista = inet.find('{*}Station')
+            icha = ista.find('{*}Channel')
+        except Exception as e:
+            print(e);continue
+        lon = float(ista.findtext('{*}Longitude'))
+        lat = float(ista.findtext('{*}Latitude'))
+        elv = ista.findtext('{*}Elevation')
+        if elv: elv = float(elv)
+        else: elv = 0.
+        location = None
+        if icha is not None: location = icha.get('locationCode')
+        if not location: location = '00'
+        sta_info[tmps] = (ista.get('code'),inet.get('code'),lon,lat,elv,location)
+    return sta_info
+
+
+def asdf_waveform_tags(wgroup):
+    '''
+    this function lists the waveform tags of one station in an ASDF file (used in S1)
+    PARAMETERS:
+    ----------------------
+    wgroup: h5py group of the station under /Waveforms
+    RETURNS:
+    ----------------------
+    tags: dict of tag -> name of the first waveform dataset with that tag
+    '''
+    tags = {}
+    for name in sorted(wgroup.keys()):
+        if name == 'StationXML': continue
+        tag = name.split('__')[-1]
+        if tag not in tags: tags[tag] = name
+    return tags
+
+
+def read_asdf_waveform(dset,out=None):
+    '''
+    this function reads one waveform dataset of an ASDF file together with its starting time and sampling
+    rate directly from the HDF5 dataset, bypassing the obspy stream construction of pyasdf (used in S1)
+    PARAMETERS:
+    ----------------------
+    dset: h5py dataset of the waveform
+    out:  optional preallocated numpy array to read the data into (reused when large enough)
+    RETURNS:
+    ----------------------
+    data: 1D numpy array of the waveform data (a view of out if given)
+    starttime: starting time of the data in seconds since 1970
+    sps:  sampling rate of the data
+    comp: channel code of the waveform
+    '''
+    npts = dset.shape[0]
+    if out is not None and out.size >= npts and out.dtype == dset.dtype:
+        dset.read_direct(out,dest_sel=np.s_[:npts])
+        data = out[:npts]
+    else:
+        data = dset[()]
+    starttime = dset.attrs['starttime']*1E-9
+    sps  = dset.attrs['sampling_rate']
+    comp = dset.name.split('/')[-1].split('__')[0].split('.')[-1]
+    return data,starttime,sps,comp
+
+
+def add_gap_mask(ds,tr,tag):
+    '''
+    this function stores the gap mask of a pre-processed trace (tr.stats.gap_mask) as an attribute of its
+    waveform dataset in the ASDF file (used in S0A & S0B)
+    PARAMETERS:
+    ----------------------
+    ds:  pyasdf ASDFDataSet the trace has just been added to
+    tr:  obspy trace with the gap mask in its stats
+    tag: waveform tag of the trace
+    '''
+    if 'gap_mask' not in tr.stats: return
+    wgroup = ds._waveform_group[tr.stats.network+'.'+tr.stats.station]
+    tstart = tr.stats.starttime.strftime('%Y-%m-%dT%H:%M:%S')
+    for name in wgroup.keys():
+        tmp = name.split('__')
+        if tmp[0]==tr.id and tmp[1]==tstart and tmp[-1]==tag:
+            wgroup[name].attrs['gap_mask'] = tr.stats.gap_mask
+            break
+
+
+def read_gap_mask(dset):
+    '''
+    this function reads the gap mask stored with a waveform dataset (used in S1)
+    PARAMETERS:
+    ----------------------
+    dset: h5py dataset of the waveform
+    RETURNS:
+    ----------------------
+    gaps: 2D array of the [first sample, number of samples] of each gap (None if no mask is stored)
+    '''
+    if 'gap_mask' not in dset.attrs: return None
+    return np.array(dset.attrs['gap_mask']).reshape(-1,2)
+
+
+def make_raw_cache(max_mb):
+    '''
+    this function creates a bounded LRU cache of decoded SAC/mseed files, so that raw files spanning several
+    time chunks are only read and decoded once when the chunks are processed in time order (used in S0B)
+    PARAMETERS:
+    ----------------------
+    max_mb: maximum memory (in MB) of the decoded data kept in the cache
+    RETURNS:
+    ----------------------
+    raw_cache: dict holding the cached streams (ordered from least to most recently used) and hit statistics
+    '''
+    return {'streams':collections.OrderedDict(),'max_bytes':max_mb*1024**2,'nbytes':0,'hits':0,'misses':0}
+
+
+def read_raw_files(tfiles,raw_cache=None):
+    '''
+    this function reads all SAC/mseed pieces of one station channel into one stream, using the LRU cache
+    of decoded files if given. a copy of the cached traces is returned as pre-processing modifies them.
+    (used in S0B)
+    PARAMETERS:
+    ----------------------
+    tfiles:    list of SAC/mseed files
+    raw_cache: cache created by make_raw_cache (None to always read from disk)
+    RETURNS:
+    ----------------------
+    source: obspy stream object of all traces in the files
+    '''
+    source = obspy.Stream()
+    for ifile in tfiles:
+        if raw_cache is not None and ifile in raw_cache['streams']:
+            raw_cache['streams'].move_to_end(ifile)
+            raw_cache['hits'] += 1
+            tr = raw_cache['streams'][ifile]
+        else:
+            try:
+                tr = obspy.read(ifile)
+            except Exception as inst:
+                print(inst);continue
+            if raw_cache is not None:
+                raw_cache['misses'] += 1
+                raw_cache['streams'][ifile] = tr
+                raw_cache['nbytes'] += sum([ttr.data.nbytes for ttr in tr])
+                # drop the least recently used files when the cache is full
+                while raw_cache['nbytes'] > raw_cache['max_bytes'] and len(raw_cache['streams'])>1:
+                    _,otr = raw_cache['streams'].popitem(last=False)
+                    raw_cache['nbytes'] -= sum([ttr.data.nbytes for ttr in otr])
+        if raw_cache is not None: tr = tr.copy()
+        for ttr in tr:
+            source.append(ttr)
+    return source
+
+
+def preprocess_local_station(job):
+    '''
+    this function reads all SAC/mseed pieces of one station channel in a time chunk, makes the inventory
+    and pre-processes the data. it is the unit of work sent to the process pool in S0B so that stations
+    of the same chunk are cleaned in parallel while the main process writes the results. (used in S0B)
+    PARAMETERS:
+    ----------------------
+    job: tuple of (tfiles,source,prepro_para,locs,date_info,tag)
+        tfiles:    list of SAC/mseed files of the channel overlapping with the time chunk
+        source:    obspy stream of the files if already read (e.g. from the raw file cache), otherwise None
+        prepro_para: dict containing all pre-processing parameters
+        locs:      panda data frame of the station list (only the rows of this station are needed)
+        date_info: dict of start and end time of the chunk
+        tag:       waveform tag to be used in the ASDF file
+    RETURNS:
+    ----------------------
+    (tr,inv1,tag): pre-processed obspy stream, its inventory and tag; None if no good data is left
+    '''
+    tfiles,source,prepro_para,locs,date_info,tag = job
+    if source is None:
+        source = read_raw_files(tfiles)
+
+    # jump if no good data left
+    if not len(source):return None
+
+    # make inventory to save into ASDF file
+    inv1 = stats2inv(source[0].stats,prepro_para,locs=locs)
+    tr = preprocess_raw(source,inv1,prepro_para,date_info)
+    if not len(tr) or np.all(tr[0].data==0):return None
+
+    return tr,inv1,tag
+
+
+def pool_imap_bounded(pool,func,jobs,max_inflight):
+    '''
+    this function maps func over jobs with a process pool while keeping at most max_inflight jobs submitted
+    and not yet returned, so that jobs built lazily by a generator (e.g., reading the raw data) are only
+    built when there is room for them and the memory stays bounded (used in S0B)
+    PARAMETERS:
+    ----------------------
+    pool: multiprocessing pool
+    func: function applied to each job (needs to be at module level)
+    jobs: iterable of the jobs
+    max_inflight: maximum number of jobs submitted at the same time
+    RETURNS:
+    ----------------------
+    generator of the outputs of func in the order of jobs
+    '''
+    pending = collections.deque()
+    for job in jobs:
+        pending.append(pool.apply_async(func,(job,)))
+        if len(pending) >= max_inflight:
+            yield pending.popleft().get()
+    while len(pending):
+        yield pending.popleft().get()
+
+
+def fdsn_request(func,nretry=3,backoff=1.,**kwargs):
+    '''
+    this function sends one request to the data center and retries with exponentially increasing waiting
+    time when it fails for reasons other than no data being available (used in S0A)
+    PARAMETERS:
+    ----------------------
+    func:    bound method of the obspy fdsn client (e.g., client.get_waveforms)
+    nretry:  maximum number of retries after the first failure
+    backoff: waiting time (s) before the first retry, doubled at each retry
+    kwargs:  arguments passed to func
+    RETURNS:
+    ----------------------
+    res:    result of the request (None if it fails)
+    reqlog: dict of the request name, elapsed time, number of tries and status
+    '''
+    t0 = time.time()
+    res = None;status = 'ok'
+    for itry in range(nretry+1):
+        try:
+            res = func(**kwargs);status = 'ok'
+            break
+        except FDSNNoDataException as e:
+            status = 'nodata';break
+        except Exception as e:
+            status = str(e).split('\n')[0]
+            if itry < nretry: time.sleep(backoff*2**itry)
+    reqlog = {'request':func.__name__,'station':kwargs.get('station',''),'time':time.time()-t0,\
+        'ntry':itry+1,'status':status}
+    return res,reqlog
+
+
+def make_inv_cache(cachedir):
+    '''
+    this function creates the cache of station inventories: each channel epoch is stored on disk as one
+    StationXML file named by net.sta.loc.cha and the epoch, and is parsed only once per process. the channels
+    returned by requests with wildcards are listed in queries.txt so that such requests are only answered by
+    the cache when the same request was made before (used in S0A)
+    PARAMETERS:
+    ----------------------
+    cachedir: directory of the StationXML files
+    RETURNS:
+    ----------------------
+    inv_cache: dict of the directory, the epochs of all files on disk, the files returned by each wildcard
+        request, the parsed inventories, a lock for the download threads and the number of hits/misses
+    '''
+    if not os.path.isdir(cachedir):os.makedirs(cachedir,exist_ok=True)
+
+    # only the file names are read here
+    files = {}
+    for tfile in glob.glob(os.path.join(cachedir,'*.xml')):
+        tmp = os.path.basename(tfile)[:-4].split('__')
+        if len(tmp) != 3: continue
+        t1 = obspy.UTCDateTime(tmp[1])
+        if tmp[2] == 'open': t2 = None
+        else: t2 = obspy.UTCDateTime(tmp[2])
+        files[tfile] = (tmp[0],t1,t2)
+
+    # one line per wildcard request: the request followed by the files it returned
+    queries = {}
+    qfile = os.path.join(cachedir,'queries.txt')
+    if os.path.isfile(qfile):
+        with open(qfile) as f:
+            for line in f:
+                tmp = line.split()
+                if len(tmp) < 2: continue
+                queries[tmp[0]] = [os.path.join(cachedir,tname) for tname in tmp[1:]]
+
+    return {'dir':cachedir,'files':files,'queries':queries,'inv':{},'lock':threading.Lock(),'hits':0,'misses':0}
+
+
+def inv_cache_lookup(inv_cache,net,sta,chan,location,s1,s2):
+    '''
+    this function looks for the inventory of a station channel covering the whole time window in the cache.
+    requests with wildcards are only looked up among the channels returned by the same request before, so
+    that channels cached by other requests do not make a partial answer (used in S0A)
+    PARAMETERS:
+    ----------------------
+    inv_cache: dict of the cache made by make_inv_cache
+    net,sta,chan,location: network, station, channel and location codes (wildcards allowed)
+    s1,s2: start and end time of the time window
+    RETURNS:
+    ----------------------
+    inv: obspy inventory of all matching channel epochs or None if not all in the cache
+    '''
+    pattern = '.'.join([net,sta,location,chan])
+    with inv_cache['lock']:
+        if glob.has_magic(pattern):
+            if pattern not in inv_cache['queries'].keys():
+                inv_cache['misses'] += 1;return None
+            tfiles = [tfile for tfile in inv_cache['queries'][pattern] if tfile in inv_cache['files'].keys()]
+        else: tfiles = list(inv_cache['files'].keys())
+
+        # all channel epochs in the window have to cover it entirely
+        matched = [];partial = False
+        for tfile in tfiles:
+            cid,t1,t2 = inv_cache['files'][tfile]
+            if not fnmatch.fnmatch(cid,pattern) or t1>s2 or (t2 is not None and t2<s1): continue
+            if t1<=s1 and (t2 is None or t2>=s2): matched.append(tfile)
+            else: partial = True
+        if not len(matched) or (partial and glob.has_magic(pattern)):
+            inv_cache['misses'] += 1;return None
+
+        inv = Inventory(networks=[],source='')
+        for tfile in matched:
+            if tfile not in inv_cache['inv'].keys():
+                inv_cache['inv'][tfile] = obspy.read_inventory(tfile)
+            inv += inv_cache['inv'][tfile]
+        inv_cache['hits'] += 1
+
+    return inv
+
+
+def inv_cache_store(inv_cache,inv,query=None):
+    '''
+    this function splits a downloaded inventory into channel epochs and adds the new ones to the cache
+    (used in S0A)
+    PARAMETERS:
+    ----------------------
+    inv_cache: dict of the cache made by make_inv_cache
+    inv: obspy inventory to be added
+    query: tuple of (net,sta,chan,location) of the request that returned inv. requests with wildcards are
+        recorded with the channels they returned (None to only add the channels)
+    '''
+    tfiles = []
+    for tnet in inv:
+        for tsta in tnet:
+            for tcha in tsta:
+                cid = '.'.join([tnet.code,tsta.code,tcha.location_code,tcha.code])
+                t1 = tcha.start_date;t2 = tcha.end_date
+                if t2 is None: tend = 'open'
+                else: tend = t2.strftime('%Y%m%dT%H%M%S')
+                tfile = os.path.join(inv_cache['dir'],'%s__%s__%s.xml' % (cid,t1.strftime('%Y%m%dT%H%M%S'),tend))
+                tfiles.append(tfile)
+
+                # inventory of this channel epoch only
+                ssta = copy.copy(tsta);ssta.channels = [tcha]
+                snet = copy.copy(tnet);snet.stations = [ssta]
+                sinv = Inventory(networks=[snet],source=inv.source)
+                with inv_cache['lock']:
+                    if tfile in inv_cache['files'].keys(): continue
+                    # other ranks may share the directory
+                    tmpfile = tfile+'.%d.tmp' % os.getpid()
+                    sinv.write(tmpfile,format='STATIONXML')
+                    os.replace(tmpfile,tfile)
+                    inv_cache['inv'][tfile] = sinv
+                    inv_cache['files'][tfile] = (cid,t1,t2)
+
+    if query is None: return
+    net,sta,chan,location = query
+    pattern = '.'.join([net,sta,location,chan])
+    if not glob.has_magic(pattern) or not len(tfiles): return
+    with inv_cache['lock']:
+        inv_cache['queries'][pattern] = tfiles
+        with open(os.path.join(inv_cache['dir'],'queries.txt'),'a') as f:
+            f.write(' '.join([pattern]+[os.path.basename(tfile) for tfile in tfiles])+'\n')
+
+
+def fetch_station(job,inv_cache=None):
+    '''
+    this function downloads the inventory and raw waveforms of one station channel in a time chunk with
+    retries. it only waits on the data center and is the unit of work of the download threads. (used in S0A)
+    PARAMETERS:
+    ----------------------
+    job: tuple of (client,net,sta,chan,location,prepro_para,date_info,tag)
+        client:    obspy fdsn client of the data center
+        net,sta,chan,location: network, station, channel and location codes of the request
+        prepro_para: dict containing all pre-processing parameters (nretry and backoff are used here)
+        date_info: dict of start and end time of the chunk
+        tag:       waveform tag to be used in the ASDF file
+    inv_cache: dict of the inventory cache made by make_inv_cache (None to always download the inventory)
+    RETURNS:
+    ----------------------
+    (tr,sta_inv,job,reqlogs): raw obspy stream (None if the download failed), inventory (None if not
+        found), the job itself and the log of all requests sent
+    '''
+    client,net,sta,chan,location,prepro_para,date_info,tag = job
+    s1 = date_info['starttime'];s2 = date_info['endtime']
+    if 'nretry' in prepro_para.keys():
+        nretry  = prepro_para['nretry']
+        backoff = prepro_para['backoff']
+    else:
+        nretry  = 0;backoff = 0.
+
+    # get inventory for specific station: from the cache first
+    tr = None;reqlogs = []
+    if inv_cache is not None:
+        sta_inv = inv_cache_lookup(inv_cache,net,sta,chan,location,s1,s2)
+    else: sta_inv = None
+    if sta_inv is None:
+        sta_inv,log1 = fdsn_request(client.get_stations,nretry,backoff,network=net,station=sta,\
+            channel=chan,location=location,starttime=s1,endtime=s2,level="response")
+        reqlogs.append(log1)
+        if sta_inv is None:
+            print(log1['status'],'for',sta);return tr,sta_inv,job,reqlogs
+        if inv_cache is not None: inv_cache_store(inv_cache,sta_inv,(net,sta,chan,location))
+
+    # get data
+    tr,log2 = fdsn_request(client.get_waveforms,nretry,backoff,network=net,station=sta,\
+        channel=chan,location=location,starttime=s1,endtime=s2)
+    reqlogs.append(log2)
+    if tr is None: print(log2['status'],'for',sta)
+
+    return tr,sta_inv,job,reqlogs
+
+
+def preprocess_downloaded(res):
+    '''
+    this function pre-processes the waveforms downloaded by fetch_station (used in S0A)
+    PARAMETERS:
+    ----------------------
+    res: output of fetch_station
+    RETURNS:
+    ----------------------
+    (tr,sta_inv,tag,tdown,tprep,reqlogs): pre-processed obspy stream (empty if the download failed),
+        inventory, tag, the time spent on downloading/pre-processing and the request log; None if no
+        inventory can be found
+    '''
+    tr,sta_inv,job,reqlogs = res
+    prepro_para,date_info,tag = job[5:]
+    tdown = sum([log['time'] for log in reqlogs])
+    if sta_inv is None: return None
+    if tr is None: return [],sta_inv,tag,tdown,0.,reqlogs
+
+    # preprocess to clean data
+    t1 = time.time()
+    tr = preprocess_raw(tr,sta_inv,prepro_para,date_info)
+    t2 = time.time()
+
+    return tr,sta_inv,tag,tdown,t2-t1,reqlogs
+
+
+def fetch_bulk(jobs,inv_cache=None):
+    '''
+    this function downloads the inventories and raw waveforms of a group of station channels in a time
+    chunk with one batched station request and one bulk waveform request, and splits the returned data
+    into the outputs of the individual stations (used in S0A)
+    PARAMETERS:
+    ----------------------
+    jobs: list of jobs for fetch_station of the same chunk sharing the same client
+    inv_cache: dict of the inventory cache made by make_inv_cache (None to always download the inventory)
+    RETURNS:
+    ----------------------
+    list of (tr,sta_inv,job,reqlogs) for each job, same as the output of fetch_station. the log of the
+    bulk requests is only given with the first job so that the requests are counted once
+    '''
+    client,prepro_para,date_info = jobs[0][0],jobs[0][5],jobs[0][6]
+    s1 = date_info['starttime'];s2 = date_info['endtime']
+    if 'nretry' in prepro_para.keys():
+        nretry  = prepro_para['nretry']
+        backoff = prepro_para['backoff']
+    else:
+        nretry  = 0;backoff = 0.
+    bulk = [(job[1],job[2],job[4],job[3],s1,s2) for job in jobs]
+    label = '%d stations' % len(jobs)
+
+    # inventories from the cache first
+    if inv_cache is not None:
+        all_inv = [inv_cache_lookup(inv_cache,job[1],job[2],job[3],job[4],s1,s2) for job in jobs]
+    else: all_inv = [None]*len(jobs)
+
+    # one request for all missing inventories and one for all waveforms
+    reqlogs = [];st = None
+    indx = [ii for ii in range(len(jobs)) if all_inv[ii] is None]
+    if len(indx):
+        inv,log1 = fdsn_request(client.get_stations_bulk,nretry,backoff,bulk=[bulk[ii] for ii in indx],level='response')
+        log1['station'] = label
+        reqlogs.append(log1)
+        if inv is None:
+            print(log1['status'],'for',label)
+        else:
+            if inv_cache is not None: inv_cache_store(inv_cache,inv)
+            for ii in indx:
+                net,sta,chan,location = jobs[ii][1:5]
+                all_inv[ii] = inv.select(network=net,station=sta,channel=chan,location=location)
+                if not len(all_inv[ii]):all_inv[ii] = None
+                elif inv_cache is not None: inv_cache_store(inv_cache,all_inv[ii],(net,sta,chan,location))
+    indx = [ii for ii in range(len(jobs)) if all_inv[ii] is not None]
+    if len(indx):
+        st,log2 = fdsn_request(client.get_waveforms_bulk,nretry,backoff,bulk=[bulk[ii] for ii in indx])
+        log2['station'] = label
+        reqlogs.append(log2)
+        if st is None: print(log2['status'],'for',label)
+
+    # demultiplex to each station
+    output = []
+    for ii,job in enumerate(jobs):
+        net,sta,chan,location = job[1:5]
+        if st is None:
+            tr = None
+        else:
+            tr = st.select(network=net,station=sta,channel=chan,location=location)
+            if not len(tr):tr = None
+        if ii==0:output.append((tr,all_inv[ii],job,reqlogs))
+        else:output.append((tr,all_inv[ii],job,[]))
+
+    return output
+
+
+def fetch_concurrent(jobs,max_inflight,bulk_size=0,inv_cache=None):
+    '''
+    this function downloads the data of all jobs with a pool of threads so that up to max_inflight
+    requests are waiting on the data center at the same time. each thread works on its own copy of the
+    client. results are yielded as soon as they arrive. (used in S0A)
+    PARAMETERS:
+    ----------------------
+    jobs: list of jobs for fetch_station
+    max_inflight: number of concurrent requests
+    bulk_size: maximum number of station channels per bulk request (0 for one request per station)
+    inv_cache: dict of the inventory cache made by make_inv_cache shared by all threads (None to turn off)
+    RETURNS:
+    ----------------------
+    generator of the outputs of fetch_station
+    '''
+    local = threading.local()
+    if bulk_size > 0:
+        groups = [jobs[ii:ii+bulk_size] for ii in range(0,len(jobs),bulk_size)]
+    else: groups = jobs
+
+    def fetch(group):
+        if bulk_size > 0: job = group[0]
+        else: job = group
+        if getattr(local,'client',None) is None:
+            local.client = copy.deepcopy(job[0])
+        if bulk_size > 0:
+            return fetch_bulk([(local.client,)+tuple(job[1:]) for job in group],inv_cache)
+        return [fetch_station((local.client,)+tuple(job[1:]),inv_cache)]
+
+    # a new group is only submitted when one finishes so that no more than max_inflight are outstanding
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_inflight) as executor:
+        igroup = 0;futures = set()
+        while igroup < len(groups) or len(futures):
+            while igroup < len(groups) and len(futures) < max_inflight:
+                futures.add(executor.submit(fetch,groups[igroup]));igroup += 1
+            done,futures = concurrent.futures.wait(futures,return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                for res in future.result():
+                    yield res
+
+
 def cut_trace_make_statis(fc_para,source):
     '''
     this function cuts continous noise data into user-defined segments, estimate the statistics of
@@ -413,6 +1287,34 @@ def cut_trace_make_statis(fc_para,source):
     dataS_t:    timestamps of each segment
     dataS:      2D matrix of the segmented data
     '''
+    sps  = int(source[0].stats.sampling_rate)
+    starttime = source[0].stats.starttime-obspy.UTCDateTime(1970,1,1)
+    if 'gap_mask' in source[0].stats:
+        gaps = source[0].stats.gap_mask
+    else: gaps = None
+
+    return cut_data_make_statis(fc_para,source[0].data,sps,starttime,source[0].id,gaps)
+
+
+def cut_data_make_statis(fc_para,data,sps,starttime,sid='',gaps=None):
+    '''
+    same as cut_trace_make_statis but works on the bare data array and its header values, so that
+    data read directly from the ASDF file needs no obspy stream. (used in S1)
+    PARAMETERS:
+    ----------------------
+    fft_para: A dictionary containing all fft and cc parameters.
+    data: 1D numpy array of the continous noise data
+    sps:  sampling rate of the data
+    starttime: starting time of the data in seconds since 1970
+    sid:  id of the trace for printing purpose
+    gaps: run-length mask of the gaps in the data (see gap_mask). segments overlapping a gap are left
+          as zeros with trace_stdS of 0 so that they are neither whitened nor correlated
+    RETURNS:
+    ----------------------
+    trace_stdS: standard deviation of the noise amplitude of each segment
+    dataS_t:    timestamps of each segment
+    dataS:      2D matrix of the segmented data
+    '''
     # define return variables first
     source_params=[];dataS_t=[];dataS=[]
 
@@ -423,10 +1325,6 @@ def cut_trace_make_statis(fc_para,source):
 
     # useful parameters for trace sliding
     nseg = int(np.floor((inc_hours/24*86400-cc_len)/step))
-    sps  = int(source[0].stats.sampling_rate)
-    starttime = source[0].stats.starttime-obspy.UTCDateTime(1970,1,1)
-    # copy data into array
-    data = source[0].data
 
     # if the data is shorter than the tim chunck, return zero values
     if data.size < sps*inc_hours*3600:
@@ -436,7 +1334,7 @@ def cut_trace_make_statis(fc_para,source):
     all_madS = mad(data)	            # median absolute deviation over all noise window
     all_stdS = np.std(data)	        # standard deviation over all noise window
     if all_madS==0 or all_stdS==0 or np.isnan(all_madS) or np.isnan(all_stdS):
-        print("continue! madS or stdS equals to 0 for %s" % source)
+        print("continue! madS or stdS equals to 0 for %s" % sid)
         return source_params,dataS_t,dataS
 
     # initialize variables
@@ -444,15 +1342,23 @@ def cut_trace_make_statis(fc_para,source):
     #trace_madS = np.zeros(nseg,dtype=np.float32)
     trace_stdS = np.zeros(nseg,dtype=np.float32)
     dataS    = np.zeros(shape=(nseg,npts),dtype=np.float32)
-    dataS_t  = np.zeros(nseg,dtype=np.float)
+    dataS_t  = np.zeros(nseg,dtype=np.float64)
+
+    # segments overlapping any gap
+    isgap = np.zeros(nseg,dtype=bool)
+    if gaps is not None and len(gaps):
+        seg1 = np.arange(nseg)*step*sps
+        for g1,glen in gaps:
+            isgap |= (seg1<g1+glen)&(seg1+npts>g1)
 
     indx1 = 0
     for iseg in range(nseg):
         indx2 = indx1+npts
-        dataS[iseg] = data[indx1:indx2]
-        #trace_madS[iseg] = (np.max(np.abs(dataS[iseg]))/all_madS)
-        trace_stdS[iseg] = (np.max(np.abs(dataS[iseg]))/all_stdS)
         dataS_t[iseg]    = starttime+step*iseg
+        if not isgap[iseg]:
+            dataS[iseg] = data[indx1:indx2]
+            #trace_madS[iseg] = (np.max(np.abs(dataS[iseg]))/all_madS)
+            trace_stdS[iseg] = (np.max(np.abs(dataS[iseg]))/all_stdS)
         indx1 = indx1+step*sps
 
     # 2D array processing
@@ -463,6 +1369,142 @@ def cut_trace_make_statis(fc_para,source):
     return trace_stdS,dataS_t,dataS
 
 
+def load_fft_block(ds,sta_list,fc_para,nseg_chunk,nnfft,sta_info=None,locs=None,wbuf=None):
+    '''
+    this function reads the noise data of a block of stations in one time chunk, cuts them into segments,
+    does the normalization and FFT, and keeps the spectra in memory for the cross-correlations (used in S1)
+    PARAMETERS:
+    ----------------------
+    ds:       opened chunk file (h5py File when fast_read, pyasdf ASDFDataSet otherwise; None for sac/mseed)
+    sta_list: stations of the block (waveform group names for asdf or file names for sac/mseed)
+    fc_para:  dict containing all fft and cc parameters
+    nseg_chunk: proposed number of segments in the time chunk
+    nnfft:    proposed length of the fft
+    sta_info: station info of the chunk file from asdf_station_info (needed when fast_read)
+    locs:     station list (needed for sac/mseed input)
+    wbuf:     buffer reused to read the waveforms (used when fast_read)
+    RETURNS:
+    ----------------------
+    fblock: dict of the spectra ('fft'), segment statistics ('std'), flags, segment times, station info of
+        each channel, number of channels loaded ('n'), number of segments ('N') and fft length ('Nfft')
+    '''
+    input_fmt = fc_para['input_fmt']
+    ncomp     = fc_para['ncomp']
+    if 'fast_read' in fc_para.keys():
+        fast_read = fc_para['fast_read']
+    else: fast_read = False
+    if 'flag' in fc_para.keys():
+        flag = fc_para['flag']
+    else: flag = False
+
+    # open array to store fft data/info in memory
+    nsta = ncomp*len(sta_list)
+    fft_array = np.zeros((nsta,nseg_chunk*(nnfft//2)),dtype=np.complex64)
+    fft_std   = np.zeros((nsta,nseg_chunk),dtype=np.float32)
+    fft_flag  = np.zeros(nsta,dtype=np.int16)
+    fft_time  = np.zeros((nsta,nseg_chunk),dtype=np.float64) 
+    # station information (for every channel)
+    station=[];network=[];channel=[];clon=[];clat=[];location=[];elevation=[]     
+    N = nseg_chunk;Nfft = nnfft
+
+    # loop through all stations
+    iii = 0
+    for ista in range(len(sta_list)):
+        tmps = sta_list[ista]
+
+        if input_fmt == 'asdf' and fast_read:
+            if tmps not in sta_info:
+                print('abort! no stationxml for %s in file %s'%(tmps,ds.filename))
+                continue
+            sta,net,lon,lat,elv,loc = sta_info[tmps]
+
+            # tags and the matching waveform datasets
+            tag_names = asdf_waveform_tags(ds['Waveforms'][tmps])
+            all_tags  = sorted(tag_names.keys())
+            if len(all_tags)==0:continue
+
+        elif input_fmt == 'asdf':
+            # get station and inventory
+            try:
+                inv1 = ds.waveforms[tmps]['StationXML']
+            except Exception as e:
+                print('abort! no stationxml for %s in file %s'%(tmps,ds.filename))
+                continue
+            sta,net,lon,lat,elv,loc = sta_info_from_inv(inv1)
+
+            # get days information: works better than just list the tags 
+            all_tags = ds.waveforms[tmps].get_waveform_tags()
+            if len(all_tags)==0:continue
+            
+        else: # get station information
+            all_tags = [1]
+            sta = tmps.split('/')[-1]
+
+        #----loop through each stream----
+        for itag in range(len(all_tags)):
+            if flag:print("working on station %s and trace %s" % (sta,all_tags[itag]))
+
+            # read waveform data
+            if input_fmt == 'asdf' and fast_read:
+                dset = ds['Waveforms'][tmps][tag_names[all_tags[itag]]]
+                data,starttime,sps,comp = read_asdf_waveform(dset,out=wbuf)
+                gaps = read_gap_mask(dset)
+                if comp[-1] =='U': comp.replace('U','Z')
+
+                # cut daily-long data into smaller segments (dataS always in 2D)
+                trace_stdS,dataS_t,dataS = cut_data_make_statis(fc_para,data,int(sps),starttime,tmps+'.'+comp,gaps)
+            else:
+                if input_fmt == 'asdf':
+                    source = ds.waveforms[tmps][all_tags[itag]]
+                    # gap mask stored with the waveform by S0A/S0B
+                    wgroup = ds._waveform_group[tmps]
+                    gaps = read_gap_mask(wgroup[asdf_waveform_tags(wgroup)[all_tags[itag]]])
+                    if gaps is not None and len(source): source[0].stats.gap_mask = gaps
+                else:
+                    source = obspy.read(tmps)
+                    inv1   = stats2inv(source[0].stats,fc_para,locs)
+                    sta,net,lon,lat,elv,loc = sta_info_from_inv(inv1)
+
+                # channel info 
+                comp = source[0].stats.channel
+                if comp[-1] =='U': comp.replace('U','Z')
+                if len(source)==0:continue
+
+                # cut daily-long data into smaller segments (dataS always in 2D)
+                trace_stdS,dataS_t,dataS = cut_trace_make_statis(fc_para,source)        # optimized version:3-4 times faster
+            if not len(dataS): continue
+            N = dataS.shape[0]
+
+            # do normalization if needed: segments in data gaps (trace_stdS of 0) are not processed
+            igood = np.where(trace_stdS>0)[0]
+            if not len(igood): continue
+            if len(igood) < N:
+                white = noise_processing(fc_para,dataS[igood])
+                source_white = np.zeros((N,white.shape[1]),dtype=white.dtype)
+                source_white[igood] = white
+                del white
+            else:
+                source_white = noise_processing(fc_para,dataS)
+            Nfft = source_white.shape[1];Nfft2 = Nfft//2
+            if flag:print('N and Nfft are %d (proposed %d),%d (proposed %d)' %(N,nseg_chunk,Nfft,nnfft))
+
+            # keep track of station info to write into parameter section of ASDF files
+            station.append(sta);network.append(net);channel.append(comp),clon.append(lon)
+            clat.append(lat);location.append(loc);elevation.append(elv)
+
+            # load fft data in memory for cross-correlations
+            data = source_white[:,:Nfft2]
+            fft_array[iii] = data.reshape(data.size)
+            fft_std[iii]   = trace_stdS
+            fft_flag[iii]  = 1
+            fft_time[iii]  = dataS_t
+            iii+=1
+            del trace_stdS,dataS_t,dataS,source_white,data
+
+    return {'fft':fft_array,'std':fft_std,'flag':fft_flag,'time':fft_time,'station':station,'network':network,\
+        'channel':channel,'lon':clon,'lat':clat,'location':location,'elevation':elevation,'n':iii,'N':N,'Nfft':Nfft}
+
+
 def noise_processing(fft_para,dataS):
     '''
     this function performs time domain and frequency domain normalization if needed. in real case, we prefer use include
@@ -785,7 +1827,7 @@ def correlate_nonlinear_stack(fft1_smoothed_abs,fft2,D,Nfft,dataS_t):
             n_corr = len(tindx)
         elif stack_method == 'robust':
             print('do robust substacking')
-            s_corr = robust_stack(s_corr,0.001)
+            s_corr = robust_stack(s_corr,0.001)[0]
             t_corr = dataS_t[0]
             n_corr = nwin
       #  elif stack_method == 'selective':
@@ -844,26 +1886,80 @@ def cc_parameters(cc_para,coor,tcorr,ncorr,comp):
         'comp':comp}
     return parameters
 
-def stacking(cc_array,cc_time,cc_ngood,stack_para):
+def ccf_index(ccfiles):
     '''
-    this function stacks the cross correlation data according to the user-defined substack_len parameter
-
+    this function scans the CCF files of S1 for the station pairs they contain and the size of their
+    cross-correlation data, reading only the HDF5 metadata (used in S2)
     PARAMETERS:
     ----------------------
-    cc_array: 2D numpy float32 matrix containing all segmented cross-correlation data
-    cc_time:  1D numpy array of timestamps for each segment of cc_array
-    cc_ngood: 1D numpy int16 matrix showing the number of segments for each sub-stack and/or full stack
-    stack_para: a dict containing all stacking parameters
-
+    ccfiles: list of the CCF files (ASDF format) of S1
     RETURNS:
     ----------------------
-    cc_array, cc_ngood, cc_time: same to the input parameters but with abnormal cross-correaltions removed
-    allstacks1: 1D matrix of stacked cross-correlation functions over all the segments
-    nstacks:    number of overall segments for the final stacks
+    pair_files: dict of the CCF files containing each station pair
+    pair_size:  dict of the total size (number of points) of the cross-correlation data of each station pair
     '''
-    # load useful parameters from dict
-    samp_freq = stack_para['samp_freq']
-    smethod   = stack_para['stack_method']
+    pair_files = {}
+    pair_size  = {}
+    for ifile in ccfiles:
+        try:
+            with h5py.File(ifile,'r') as fp:
+                if 'AuxiliaryData' not in fp.keys(): continue
+                for dtype,grp in fp['AuxiliaryData'].items():
+                    npts = 0
+                    for tpath,dset in grp.items():
+                        if isinstance(dset,h5py.Dataset): npts += dset.size
+                    pair_files.setdefault(dtype,[]).append(ifile)
+                    pair_size[dtype] = pair_size.get(dtype,0)+npts
+        except OSError:
+            print('continue! cannot read %s'%ifile)
+    return pair_files,pair_size
+
+
+def schedule_pairs(costs,size):
+    '''
+    this function assigns the station pairs to the MPI ranks so that the ranks get similar work loads:
+    the pairs are given to the least loaded rank from the most to the least costly one (longest
+    processing time first) (used in S2)
+    PARAMETERS:
+    ----------------------
+    costs: list of the estimated cost of each station pair (e.g., size of its cross-correlation data)
+    size:  number of ranks
+    RETURNS:
+    ----------------------
+    jobs:  list of the indices of the station pairs of each rank (most costly first)
+    loads: estimated load of each rank
+    '''
+    jobs  = [[] for _ in range(size)]
+    loads = np.zeros(size,dtype=np.float64)
+    for ii in np.argsort(-np.asarray(costs,dtype=np.float64),kind='stable'):
+        irank = int(np.argmin(loads))
+        jobs[irank].append(int(ii))
+        loads[irank] += costs[ii]
+    return jobs,loads
+
+
+def stacking(cc_array,cc_time,cc_ngood,stack_para,robust=True):
+    '''
+    this function stacks the cross correlation data according to the user-defined substack_len parameter
+
+    PARAMETERS:
+    ----------------------
+    cc_array: 2D numpy float32 matrix containing all segmented cross-correlation data
+    cc_time:  1D numpy array of timestamps for each segment of cc_array
+    cc_ngood: 1D numpy int16 matrix showing the number of segments for each sub-stack and/or full stack
+    stack_para: a dict containing all stacking parameters
+    robust:   False to leave the robust stack as zeros, e.g., to compute the ones of all cross-components
+              at once with robust_stack_groups
+
+    RETURNS:
+    ----------------------
+    cc_array, cc_ngood, cc_time: same to the input parameters but with abnormal cross-correaltions removed
+    allstacks1: 1D matrix of stacked cross-correlation functions over all the segments
+    nstacks:    number of overall segments for the final stacks
+    '''
+    # load useful parameters from dict
+    samp_freq = stack_para['samp_freq']
+    smethod   = stack_para['stack_method']
     start_date   = stack_para['start_date']
     end_date     = stack_para['end_date']
     npts = cc_array.shape[1]
@@ -882,29 +1978,165 @@ def stacking(cc_array,cc_time,cc_ngood,stack_para):
         cc_time  = cc_time[tindx]
         cc_ngood = cc_ngood[tindx]
 
-        # do stacking
+        # do stacking: all methods of 'all' share the same pass through the data
         allstacks1 = np.zeros(npts,dtype=np.float32)
         allstacks2 = np.zeros(npts,dtype=np.float32)
         allstacks3 = np.zeros(npts,dtype=np.float32)
 
+        if smethod == 'all':
+            methods = ['linear','pws','robust']
+        else: methods = [smethod]
+        if not robust and 'robust' in methods: methods.remove('robust')
+        stacks,timing = multi_stack(cc_array,methods,samp_freq)
+        if 'stack_timing' in stack_para.keys() and stack_para['stack_timing']:
+            print('stacking takes '+', '.join(['%s %6.3fs'%(key,timing[key]) for key in timing.keys()]))
+
+        if smethod == 'all':
+            allstacks1 = stacks['linear']
+            allstacks2 = stacks['pws']
+            if robust: allstacks3 = stacks['robust']
+        elif smethod in stacks.keys():
+            allstacks1 = stacks[smethod]
+        nstacks = np.sum(cc_ngood)
+
+    # good to return
+    return cc_array,cc_ngood,cc_time,allstacks1,allstacks2,allstacks3,nstacks
+
+
+def multi_stack(cc_array,methods,samp_freq,cc_th=0.01):
+    '''
+    this function stacks the cross correlation data with several methods at once: the data is read once
+    and the intermediates shared by the methods (the linear stack used by pws, the norms and means of
+    the traces used by robust and selective stacking) are only computed once (used in S2)
+
+    PARAMETERS:
+    ----------------------
+    cc_array:  2D numpy float32 matrix of the cross-correlation data (with abnormal ones already removed)
+    methods:   list of the stacking methods among linear, pws, robust, acf, nroot and selective
+    samp_freq: sampling rate of the data
+    cc_th:     threshold of correlation coefficient for selective stacking
+    RETURNS:
+    ----------------------
+    stacks: dict of the 1D stack of each method (and of the weights of robust stacking in robust_weights)
+    timing: dict of the time (s) spent on each method and on the shared intermediates ('shared')
+    '''
+    stacks = {}
+    timing = {'shared':0.}
+    for smethod in methods:
+        if smethod not in ['linear','pws','robust','acf','nroot','selective']:
+            raise ValueError('stacking method %s is not supported'%smethod)
+
+    # shared intermediates
+    t0 = time.time()
+    if 'linear' in methods or 'pws' in methods:
+        mean = np.mean(cc_array,axis=0)
+    if 'robust' in methods or 'selective' in methods:
+        rnorm2 = np.einsum('nm,nm->n',cc_array,cc_array,dtype=np.float64)
+    if 'selective' in methods:
+        rmean = np.mean(cc_array,axis=1,dtype=np.float64)
+    timing['shared'] = time.time()-t0
+
+    for smethod in methods:
+        t0 = time.time()
         if smethod == 'linear':
-            allstacks1 = np.mean(cc_array,axis=0)
+            stacks[smethod] = mean
         elif smethod == 'pws':
-            allstacks1 = pws(cc_array,samp_freq)
+            stacks[smethod] = mean*pws_weights(cc_array)
         elif smethod == 'robust':
-            allstacks1,w,nstep = robust_stack(cc_array,0.001)
+            stacks[smethod],stacks['robust_weights'],nstep = robust_stack(cc_array,0.001,di_norm2=rnorm2)
         elif smethod == 'acf':
-            allstack1 = adaptive_filter(cc_array,1)
+            stacks[smethod] = adaptive_filter(cc_array,1)
         elif smethod == 'nroot':
-            allstack1 = nroot_stack(cc_array,2)
-        elif smethod == 'all':
-            allstacks1 = np.mean(cc_array,axis=0)
-            allstacks2 = pws(cc_array,samp_freq)
-            allstacks3,w,nstep = robust_stack(cc_array,0.001)
-        nstacks = np.sum(cc_ngood)
+            stacks[smethod] = nroot_stack(cc_array,2)
+        elif smethod == 'selective':
+            stacks[smethod],nstep = selective_stack(cc_array,0.001,cc_th,rstats=(rmean,rnorm2))
+        timing[smethod] = time.time()-t0
 
-    # good to return
-    return cc_array,cc_ngood,cc_time,allstacks1,allstacks2,allstacks3,nstacks
+    return stacks,timing
+
+
+def rolling_stack(cc_array,cc_time,cc_ngood,tstart,tend,twin,tstep,stack_method='linear',samp_freq=1):
+    '''
+    this function makes the rolling stacks of the cross-correlation data over windows of twin seconds starting
+    every tstep seconds from tstart to tend. the data are sorted in time once so that each window is a slice
+    found by searchsorted: the linear and pws stacks of all windows are differences of cumulative sums taken at
+    the window boundaries, and the other methods are computed once for consecutive windows of the same data
+    PARAMETERS:
+    ----------------------
+    cc_array: 2D matrix (nseg x npts) of the cross-correlation data, or 3D matrix (ncomp x nseg x npts) of all
+              the cross-components sharing the same timestamps
+    cc_time:  1D array of timestamps of the segments
+    cc_ngood: 1D array of the number of segments of each row
+    tstart,tend: timestamps of the start of the first window and of the end of the time range
+    twin,tstep:  length and step of the windows (s)
+    stack_method: linear, pws, robust, acf, nroot or selective
+    samp_freq:    sampling rate of the data
+    RETURNS:
+    ----------------------
+    ncc_array: rolling stacks of the windows having data (nwin x npts, or ncomp x nwin x npts)
+    ncc_time:  start time of each window
+    ncc_ngood: number of segments in each window
+    '''
+    arr = cc_array if cc_array.ndim==3 else cc_array[None]
+    ncomp,nseg,npts = arr.shape
+
+    # sort the segments in time once
+    ttime = np.asarray(cc_time,dtype=np.float64)
+    tgood = np.asarray(cc_ngood,dtype=np.int64)
+    if np.any(np.diff(ttime)<0):
+        order = np.argsort(ttime,kind='stable')
+        ttime,tgood,arr = ttime[order],tgood[order],arr[:,order]
+
+    # boundaries of all windows
+    nstack = int(np.round((tend-tstart)/tstep))
+    wtime  = tstart+np.arange(nstack)*tstep
+    indx1  = np.searchsorted(ttime,wtime,side='left')
+    indx2  = np.searchsorted(ttime,wtime+twin,side='left')
+    cgood  = np.concatenate(([0],np.cumsum(tgood)))
+    ngood  = cgood[indx2]-cgood[indx1]
+    tindx  = np.where((indx2>indx1)&(ngood>0))[0]
+    indx1,indx2 = indx1[tindx],indx2[tindx]
+    nwin   = len(tindx)
+
+    if stack_method in ['linear','pws'] and nwin:
+        # window means from the cumulative sums taken at the window boundaries only: each segment
+        # is summed once whatever the overlap of the windows
+        bound = np.unique(np.concatenate((indx1,indx2)))
+        pos1  = np.searchsorted(bound,indx1)
+        pos2  = np.searchsorted(bound,indx2)
+        nrow  = (indx2-indx1)[None,:,None]
+        def window_means(data):
+            dtype = np.complex128 if np.iscomplexobj(data) else np.float64
+            if 4*len(bound) > bound[-1]-bound[0]:
+                # few segments per window: plain cumulative sums
+                csum = np.zeros((ncomp,bound[-1]-bound[0]+1,npts),dtype=dtype)
+                np.cumsum(data[:,bound[0]:bound[-1]],axis=1,dtype=dtype,out=csum[:,1:])
+                csum = csum[:,bound-bound[0]]
+            else:
+                csum = np.zeros((ncomp,len(bound),npts),dtype=dtype)
+                for ii in range(1,len(bound)):
+                    csum[:,ii] = np.sum(data[:,bound[ii-1]:bound[ii]],axis=1,dtype=dtype)
+                csum = np.cumsum(csum,axis=1)
+            return (csum[:,pos2]-csum[:,pos1])/nrow
+        ncc_array = window_means(arr)
+        if stack_method == 'pws':
+            analytic  = hilbert(arr,axis=2,N=next_fast_len(npts))[:,:,:npts]
+            ncc_array = ncc_array*np.abs(window_means(np.exp(1j*np.angle(analytic))))**2
+        ncc_array = ncc_array.astype(np.float32)
+    else:
+        ncc_array = np.zeros((ncomp,nwin,npts),dtype=np.float32)
+        for iwin in range(nwin):
+            if iwin and indx1[iwin]==indx1[iwin-1] and indx2[iwin]==indx2[iwin-1]:
+                ncc_array[:,iwin] = ncc_array[:,iwin-1]
+            elif indx2[iwin]-indx1[iwin] == 1:
+                ncc_array[:,iwin] = arr[:,indx1[iwin]]
+            else:
+                for icomp in range(ncomp):
+                    stacks,timing = multi_stack(arr[icomp,indx1[iwin]:indx2[iwin]],[stack_method],samp_freq)
+                    ncc_array[icomp,iwin] = stacks[stack_method]
+
+    if cc_array.ndim == 2: ncc_array = ncc_array[0]
+    return ncc_array,wtime[tindx],ngood[tindx]
 
 
 def stacking_rma(cc_array,cc_time,cc_ngood,stack_para):
@@ -935,9 +2167,9 @@ def stacking_rma(cc_array,cc_time,cc_ngood,stack_para):
     ampmax = np.max(cc_array,axis=1)
     tindx  = np.where( (ampmax<20*np.median(ampmax)) & (ampmax>0))[0]
     if not len(tindx):
-        allstacks1=[];allstacks2=[];nstacks=0
+        allstacks1=[];allstacks2=[];allstacks3=[];allstacks4=[];nstacks=0
         cc_array=[];cc_ngood=[];cc_time=[]
-        return cc_array,cc_ngood,cc_time,allstacks1,allstacks2,nstacks
+        return cc_array,cc_ngood,cc_time,allstacks1,allstacks2,allstacks3,allstacks4,nstacks
     else:
 
         # remove ones with bad amplitude
@@ -945,32 +2177,12 @@ def stacking_rma(cc_array,cc_time,cc_ngood,stack_para):
         cc_time  = cc_time[tindx]
         cc_ngood = cc_ngood[tindx]
 
-        # do substacks
+        # do substacks: rolling linear stacks of rma_substack hours every rma_step hours
         if rma_substack:
             tstart = obspy.UTCDateTime(start_date)-obspy.UTCDateTime(1970,1,1)
             tend   = obspy.UTCDateTime(end_date)-obspy.UTCDateTime(1970,1,1)
-            ttime  = tstart
-            nstack = int(np.round((tend-tstart)/(rma_step*3600)))
-            ncc_array = np.zeros(shape=(nstack,npts),dtype=np.float32)
-            ncc_time  = np.zeros(nstack,dtype=np.float)
-            ncc_ngood = np.zeros(nstack,dtype=np.int)
-
-            # loop through each time
-            for ii in range(nstack):
-                sindx = np.where((cc_time>=ttime) & (cc_time<ttime+rma_substack*3600))[0]
-
-                # when there are data in the time window
-                if len(sindx):
-                    ncc_array[ii] = np.mean(cc_array[sindx],axis=0)
-                    ncc_time[ii]  = ttime
-                    ncc_ngood[ii] = np.sum(cc_ngood[sindx],axis=0)
-                ttime += rma_step*3600
-
-            # remove bad ones
-            tindx = np.where(ncc_ngood>0)[0]
-            ncc_array = ncc_array[tindx]
-            ncc_time  = ncc_time[tindx]
-            ncc_ngood  = ncc_ngood[tindx]
+            ncc_array,ncc_time,ncc_ngood = rolling_stack(cc_array,cc_time,cc_ngood,tstart,tend,\
+                rma_substack*3600,rma_step*3600,'linear',samp_freq)
 
         # do stacking
         allstacks1 = np.zeros(npts,dtype=np.float32)
@@ -978,19 +2190,15 @@ def stacking_rma(cc_array,cc_time,cc_ngood,stack_para):
         allstacks3 = np.zeros(npts,dtype=np.float32)
         allstacks4 = np.zeros(npts,dtype=np.float32)
 
-        if smethod == 'linear':
-            allstacks1 = np.mean(cc_array,axis=0)
-        elif smethod == 'pws':
-            allstacks1 = pws(cc_array,samp_freq)
-        elif smethod == 'robust':
-            allstacks1,w, = robust_stack(cc_array,0.001)
-        #elif smethod == 'selective':
-        #    allstacks1 = selective_stack(cc_array,0.001)
+        if smethod in ['linear','pws','robust']:
+            stacks,timing = multi_stack(cc_array,[smethod],samp_freq)
+            allstacks1 = stacks[smethod]
         elif smethod == 'all':
-            allstacks1 = np.mean(cc_array,axis=0)
-            allstacks2 = pws(cc_array,samp_freq)
-            allstacks3 = robust_stack(cc_array,0.001)
-            allstacks4 = selective_stack(cc_array,0.001)
+            stacks,timing = multi_stack(cc_array,['linear','pws','robust','selective'],samp_freq)
+            allstacks1 = stacks['linear']
+            allstacks2 = stacks['pws']
+            allstacks3 = stacks['robust']
+            allstacks4 = stacks['selective']
         nstacks = np.sum(cc_ngood)
 
     # replace the array for substacks
@@ -1002,24 +2210,467 @@ def stacking_rma(cc_array,cc_time,cc_ngood,stack_para):
     # good to return
     return cc_array,cc_ngood,cc_time,allstacks1,allstacks2,allstacks3,allstacks4,nstacks
 
+def stack_accum_init(npts,pws=False):
+    '''
+    this function creates the accumulator of a streaming stack for one cross-component of a station pair.
+    only the running sums of the (sub-)stacks and a few scalars per (sub-)stack are kept so that the memory
+    does not depend on the length of the record (used in S2)
+    PARAMETERS:
+    ----------------------
+    npts: number of points of the cross-correlation functions
+    pws:  also accumulate the unit phasors of the analytic signals for the phase-weighted stack
+    RETURNS:
+    ----------------------
+    acc: dict of the running sums (float64/complex128) and the amplitude, time, ngood, location and
+        status (in the sums or not) of each (sub-)stack
+    '''
+    acc = {'npts':npts,'sum':np.zeros(npts,dtype=np.float64),'nsum':0,'phase':None,\
+        'ampmax':[],'time':[],'ngood':[],'index':[],'insum':[],'lookup':{}}
+    if pws: acc['phase'] = np.zeros(npts,dtype=np.complex128)
+    return acc
+
+
+def accum_phasors(data):
+    '''
+    this function returns the sum of the unit phasors exp(i*phi(t)) of the analytic signals of the
+    rows of data, the same as used in pws (used in S2)
+    '''
+    M = data.shape[1]
+    analytic = hilbert(data,axis=1,N=next_fast_len(M))[:,:M]
+    return np.sum(np.exp(1j*np.angle(analytic)),axis=0)
+
+
+def stack_accum_add(acc,data,ttime,tgood,index):
+    '''
+    this function adds the (sub-)stacks of one CCF file to the streaming stack. the cross-correlations
+    with zero amplitude are skipped here while the ones with abnormal amplitudes are only known after
+    all files are read (see stack_accum_outliers) (used in S2)
+    PARAMETERS:
+    ----------------------
+    acc:   accumulator from stack_accum_init
+    data:  1D or 2D numpy matrix of the (sub-)stacks
+    ttime: timestamp(s) of the (sub-)stacks
+    tgood: number of segments of each (sub-)stack
+    index: tuple of strings locating the data (e.g., file and path) to read the rows again if needed
+    RETURNS:
+    ----------------------
+    ampmax: max amplitude of each row of data (rows with ampmax<=0 are not stacked)
+    '''
+    data   = np.atleast_2d(data)
+    ttime  = np.atleast_1d(ttime)
+    tgood  = np.atleast_1d(tgood)
+    ampmax = np.max(data,axis=1)
+    tindx  = np.where(ampmax>0)[0]
+    if len(tindx):
+        acc['sum']  += np.sum(data[tindx],axis=0,dtype=np.float64)
+        acc['nsum'] += len(tindx)
+        if acc['phase'] is not None:
+            acc['phase'] += accum_phasors(data[tindx])
+    for ii in range(data.shape[0]):
+        acc['lookup'][(index,ii)] = len(acc['time'])
+        acc['ampmax'].append(ampmax[ii])
+        acc['time'].append(ttime[ii])
+        acc['ngood'].append(tgood[ii])
+        acc['index'].append((index,ii))
+        acc['insum'].append(bool(ampmax[ii]>0))
+    return ampmax
+
+
+def stack_accum_good(acc):
+    '''
+    this function applies the amplitude criteria of stacking to all (sub-)stacks of the accumulator
+    (used in S2)
+    '''
+    ampmax = np.array(acc['ampmax'],dtype=np.float32)
+    return (ampmax<20*np.median(ampmax)) & (ampmax>0)
+
+
+def stack_accum_outliers(acc):
+    '''
+    this function finds the (sub-)stacks whose status has to change to meet the amplitude criteria of
+    stacking, i.e. the ones in the sums with abnormal amplitudes and, after new data are added to a
+    restored accumulator, the ones left out before that are good now (used in S2)
+    PARAMETERS:
+    ----------------------
+    acc: accumulator from stack_accum_init or stack_accum_restore
+    RETURNS:
+    ----------------------
+    redo: dict of the rows to read again for each index given to stack_accum_add
+    '''
+    good  = stack_accum_good(acc)
+    insum = np.array(acc['insum'],dtype=bool)
+    redo = {}
+    for ii in np.where(good!=insum)[0]:
+        index,irow = acc['index'][ii]
+        redo.setdefault(index,[]).append(irow)
+    return redo
+
+
+def stack_accum_fix(acc,index,rows,data):
+    '''
+    this function moves (sub-)stacks found by stack_accum_outliers out of (or back into) the running
+    sums (used in S2)
+    PARAMETERS:
+    ----------------------
+    acc:   accumulator from stack_accum_init
+    index: index of the rows given to stack_accum_add
+    rows:  rows of the index to move
+    data:  2D numpy matrix of the (sub-)stacks of rows
+    '''
+    data = np.atleast_2d(data)
+    for ii,irow in enumerate(rows):
+        pos  = acc['lookup'][(index,irow)]
+        sign = -1 if acc['insum'][pos] else 1
+        acc['sum']  += sign*data[ii].astype(np.float64)
+        acc['nsum'] += sign
+        if acc['phase'] is not None:
+            acc['phase'] += sign*accum_phasors(data[ii:ii+1])
+        acc['insum'][pos] = not acc['insum'][pos]
+
+
+def stack_accum_final(acc,stack_method='linear',power=2):
+    '''
+    this function gives the final stack of the accumulator, the same as the one of stacking with
+    stack_method of linear or pws (used in S2)
+    PARAMETERS:
+    ----------------------
+    acc: accumulator after stack_accum_outliers and stack_accum_fix
+    stack_method: linear or pws (needs the phasors of stack_accum_init)
+    power: exponent of the phase stack (see pws)
+    RETURNS:
+    ----------------------
+    allstacks1: 1D matrix of the stack ([] when no data is left)
+    nstacks:    number of overall segments for the final stack
+    tstart:     timestamp of the earliest (sub-)stack kept
+    tbad:       timestamps of the (sub-)stacks with ampmax>0 that are not in the stack
+    '''
+    insum = np.array(acc['insum'],dtype=bool)
+    ttime = np.array(acc['time'],dtype=np.float64)
+    tamp  = np.array(acc['ampmax'],dtype=np.float32)
+    tbad  = ttime[(~insum) & (tamp>0)]
+    if not np.sum(insum) or acc['nsum']<=0:
+        return [],0,0,tbad
+
+    allstacks1 = acc['sum']/acc['nsum']
+    if stack_method == 'pws':
+        if acc['phase'] is None:
+            raise ValueError('no phasors accumulated for the phase-weighted stack')
+        allstacks1 = allstacks1*np.abs(acc['phase']/acc['nsum'])**power
+    nstacks = np.sum(np.array(acc['ngood'])[insum])
+    return allstacks1.astype(np.float32),nstacks,np.min(ttime[insum]),tbad
+
+
+def stack_accum_state(acc):
+    '''
+    this function packs the accumulator into a data matrix and a dict of parameters so that it can be
+    stored (e.g., as auxiliary data in the ASDF file of the stacks) and restored to add new data later
+    (used in S2)
+    PARAMETERS:
+    ----------------------
+    acc: accumulator from stack_accum_init
+    RETURNS:
+    ----------------------
+    data: 2D float64 matrix of the running sum (and the real/imaginary parts of the phasor sum)
+    parameters: dict of the number of stacked rows and the amplitude, time, ngood, location and status of each row
+    '''
+    if acc['phase'] is not None:
+        data = np.vstack((acc['sum'],acc['phase'].real,acc['phase'].imag))
+    else: data = acc['sum'].reshape(1,-1)
+    index = ['|'.join(list(tindex)+[str(irow)]) for tindex,irow in acc['index']]
+    parameters = {'nsum':int(acc['nsum']),
+        'ampmax':np.array(acc['ampmax'],dtype=np.float32),
+        'time':np.array(acc['time'],dtype=np.float64),
+        'ngood':np.array(acc['ngood'],dtype=np.int64),
+        'insum':np.array(acc['insum'],dtype=np.int8),
+        'index':np.array(index,dtype='S')}
+    return data,parameters
+
+
+def stack_accum_restore(data,parameters):
+    '''
+    this function rebuilds the accumulator packed by stack_accum_state (used in S2)
+    PARAMETERS:
+    ----------------------
+    data, parameters: outputs of stack_accum_state
+    RETURNS:
+    ----------------------
+    acc: accumulator to add new data to
+    '''
+    data = np.atleast_2d(data)
+    acc  = stack_accum_init(data.shape[1],pws=(data.shape[0]==3))
+    acc['sum'][:] = data[0]
+    if acc['phase'] is not None:
+        acc['phase'][:] = data[1]+1j*data[2]
+    acc['nsum']   = int(parameters['nsum'])
+    acc['ampmax'] = list(np.atleast_1d(parameters['ampmax']))
+    acc['time']   = list(np.atleast_1d(parameters['time']))
+    acc['ngood']  = list(np.atleast_1d(parameters['ngood']))
+    acc['insum']  = [bool(tt) for tt in np.atleast_1d(parameters['insum'])]
+    for pos,tindex in enumerate(np.atleast_1d(parameters['index'])):
+        if isinstance(tindex,bytes): tindex = tindex.decode()
+        tindex = tindex.split('|')
+        index  = (tuple(tindex[:-1]),int(tindex[-1]))
+        acc['index'].append(index)
+        acc['lookup'][index] = pos
+    return acc
+
+
+def write_stack_state(ds,comp,acc,stack_method):
+    '''
+    this function stores the accumulator of a cross-component in the ASDF file of the stacks (group
+    Stackstate_<stack_method>/<comp>) so that an append run of S2 can add new CCF files to the stacks
+    without reading the former ones again (used in S2)
+    PARAMETERS:
+    ----------------------
+    ds:   pyasdf dataset of the stacks opened for writing
+    comp: cross-component of the accumulator
+    acc:  accumulator from stack_accum_init or stack_accum_restore
+    stack_method: stacking method of the accumulator (linear or pws)
+    '''
+    data,parameters = stack_accum_state(acc)
+    grp = ds._auxiliary_data_group.require_group('Stackstate_'+stack_method)
+    if comp in grp.keys(): del grp[comp]
+    sgrp = grp.create_group(comp)
+    sgrp.attrs['nsum'] = parameters['nsum']
+    sgrp.create_dataset('sum',data=data)
+    # the amplitude, time, ngood, location and status of each (sub-)stack can be long for long records
+    for key in ['ampmax','time','ngood','insum','index']:
+        if len(parameters[key]):
+            sgrp.create_dataset(key,data=parameters[key],compression='gzip',compression_opts=3)
+        else: sgrp.create_dataset(key,data=parameters[key])
+
+
+def read_stack_state(ds,comp,stack_method):
+    '''
+    this function reads the accumulator of a cross-component stored by write_stack_state (used in S2)
+    PARAMETERS:
+    ----------------------
+    ds:   pyasdf dataset of the stacks
+    comp: cross-component of the accumulator
+    stack_method: stacking method of the accumulator (linear or pws)
+    RETURNS:
+    ----------------------
+    acc: accumulator to add new data to (None if not stored)
+    '''
+    grp = ds._auxiliary_data_group
+    if 'Stackstate_'+stack_method not in grp.keys() or comp not in grp['Stackstate_'+stack_method].keys():
+        return None
+    sgrp = grp['Stackstate_'+stack_method][comp]
+    parameters = {key:sgrp[key][:] for key in ['ampmax','time','ngood','insum','index']}
+    parameters['nsum'] = sgrp.attrs['nsum']
+    return stack_accum_restore(sgrp['sum'][:],parameters)
+
+
+def write_substacks(ds,comp,data,times,ngood,parameters,matrix=False):
+    '''
+    this function writes the sub-stacks of a cross-component into the ASDF file of the stacks, either as one
+    auxiliary data of 'T'+timestamp each or, with matrix=True, as rows of one 2D dataset (data_type of
+    Substack) with their timestamps and ngood in Substack_time, which are extended if they exist (used in S2)
+    PARAMETERS:
+    ----------------------
+    ds:    pyasdf dataset of the stacks opened for writing
+    comp:  cross-component of the sub-stacks (path of the auxiliary data)
+    data:  2D matrix of the sub-stacks
+    times: timestamps of the sub-stacks
+    ngood: number of segments of each sub-stack
+    parameters: dict of the parameters of the station pair
+    matrix: store the sub-stacks as one 2D dataset
+    '''
+    data  = np.atleast_2d(data)
+    times = np.atleast_1d(times)
+    ngood = np.atleast_1d(ngood)
+    if not data.shape[0]: return
+    if not matrix:
+        for ii in range(data.shape[0]):
+            tparameters = dict(parameters)
+            tparameters['time']  = times[ii]
+            tparameters['ngood'] = ngood[ii]
+            ds.add_auxiliary_data(data=data[ii], data_type='T'+str(int(times[ii])), path=comp, parameters=tparameters)
+        return
+
+    # timestamps and ngood are kept in a separate dataset as they would not fit in the attributes
+    ttime = np.vstack((times,ngood)).T.astype(np.float64)
+    grp   = ds._auxiliary_data_group
+    if 'Substack' in grp.keys() and comp in grp['Substack'].keys():
+        for tname,tdata in zip(['Substack','Substack_time'],[data,ttime]):
+            dset = grp[tname][comp]
+            nrow = dset.shape[0]
+            dset.resize(nrow+tdata.shape[0],axis=0)
+            dset[nrow:] = tdata
+        return
+    for tname,tdata in zip(['Substack','Substack_time'],[data.astype(np.float32),ttime]):
+        tgrp = grp.require_group(tname)
+        dset = tgrp.create_dataset(comp,data=tdata,maxshape=(None,tdata.shape[1]),\
+            chunks=(max(min(tdata.shape[0],64),1),tdata.shape[1]),compression='gzip',compression_opts=3)
+        if tname == 'Substack':
+            for key,value in parameters.items():
+                if key in ['time','ngood']: continue
+                dset.attrs[key] = value
+
+
+def remove_substacks(ds,comp,times):
+    '''
+    this function deletes the sub-stacks written for a cross-component when they turn out not to be part
+    of the final stack, for both layouts of write_substacks (used in S2)
+    PARAMETERS:
+    ----------------------
+    ds:    pyasdf dataset of the stacks opened for writing
+    comp:  cross-component of the sub-stacks (path of the auxiliary data)
+    times: timestamps of the sub-stacks
+    '''
+    if not len(times): return
+    grp = ds._auxiliary_data_group
+    if 'Substack' in grp.keys() and comp in grp['Substack'].keys():
+        ttime = grp['Substack_time'][comp][:]
+        keep  = ~np.isin(ttime[:,0],np.asarray(times,dtype=np.float64))
+        for tname in ['Substack','Substack_time']:
+            dset = grp[tname][comp]
+            tdata = dset[:][keep]
+            dset.resize(tdata.shape[0],axis=0)
+            dset[:] = tdata
+
+    for ttime in times:
+        data_type = 'T'+str(int(ttime))
+        try:
+            del ds.auxiliary_data[data_type][comp]
+            if not len(ds.auxiliary_data[data_type].list()):
+                del ds.auxiliary_data[data_type]
+        except (KeyError,AttributeError): pass
+
+
+def read_substacks(ds,comp,tmin=None,tmax=None,lag=None):
+    '''
+    this function reads the sub-stacks of a cross-component from the ASDF file of S2 within a time range
+    and a lag window. the 2D layout of write_substacks (sorted in time) is read with a single slice while
+    the sub-stacks stored as T<timestamp> groups are read one by one (used in monitoring)
+    PARAMETERS:
+    ----------------------
+    ds:   pyasdf dataset of the stacks
+    comp: cross-component (e.g., 'ZZ')
+    tmin, tmax: time range of the sub-stacks (UTCDateTime or timestamps; None for no limit)
+    lag:  maximum lag (s) or [minlag,maxlag] of the lag window (None for all lags)
+    RETURNS:
+    ----------------------
+    data:  2D matrix of the sub-stacks (time x lag)
+    times: timestamps of the sub-stacks
+    ngood: number of segments of each sub-stack
+    tvec:  lag times (s) of the columns of data
+    '''
+    tmin = -np.inf if tmin is None else obspy.UTCDateTime(tmin).timestamp
+    tmax = np.inf if tmax is None else obspy.UTCDateTime(tmax).timestamp
+    grp  = ds._auxiliary_data_group
+
+    if 'Substack' in grp.keys() and comp in grp['Substack'].keys():
+        dset  = grp['Substack'][comp]
+        ttime = grp['Substack_time'][comp][:]
+        dt    = dset.attrs['dt']
+        npts  = dset.shape[1]
+    else:
+        # sub-stacks of one T<timestamp> group each
+        tlist = [tname for tname in grp.keys() if tname[0]=='T' and tname[1:].isdigit() and comp in grp[tname].keys()]
+        if not len(tlist):
+            raise ValueError('no sub-stacks of %s found'%comp)
+        ttime = np.array([[grp[tname][comp].attrs['time'],grp[tname][comp].attrs['ngood']] for tname in tlist],dtype=np.float64)
+        tindx = np.argsort(ttime[:,0],kind='stable')
+        tlist = [tlist[ii] for ii in tindx]
+        ttime = ttime[tindx]
+        dt    = grp[tlist[0]][comp].attrs['dt']
+        npts  = grp[tlist[0]][comp].shape[0]
+
+    # lag window
+    tvec = (np.arange(npts)-npts//2)*dt
+    if lag is None:
+        lag = [tvec[0],tvec[-1]]
+    elif np.isscalar(lag):
+        lag = [-lag,lag]
+    jindx = np.where((tvec>=lag[0]-dt/2)&(tvec<=lag[1]+dt/2))[0]
+    j0,j1 = (jindx[0],jindx[-1]+1) if len(jindx) else (0,0)
+
+    # time range: a single slice for sorted rows
+    if np.all(np.diff(ttime[:,0])>=0):
+        i0 = np.searchsorted(ttime[:,0],tmin,side='left')
+        i1 = np.searchsorted(ttime[:,0],tmax,side='right')
+        iindx = np.arange(i0,i1)
+    else:
+        iindx = np.where((ttime[:,0]>=tmin)&(ttime[:,0]<=tmax))[0]
+
+    if 'Substack' in grp.keys() and comp in grp['Substack'].keys():
+        if len(iindx) and iindx[-1]-iindx[0]+1 == len(iindx):
+            data = dset[iindx[0]:iindx[-1]+1,j0:j1]
+        elif len(iindx):
+            data = dset[iindx,j0:j1]
+        else: data = np.zeros((0,j1-j0),dtype=dset.dtype)
+    else:
+        data = np.zeros((len(iindx),j1-j0),dtype=np.float32)
+        for ii,irow in enumerate(iindx):
+            data[ii] = grp[tlist[irow]][comp][j0:j1]
+
+    # rows appended out of order (e.g., by an append run of S2) are returned in time order
+    tindx = np.argsort(ttime[iindx,0],kind='stable')
+    if np.any(np.diff(tindx)<0):
+        data,iindx = data[tindx],iindx[tindx]
+
+    return data,ttime[iindx,0],ttime[iindx,1],tvec[j0:j1]
+
+
+def rotation_lookup(locs):
+    '''
+    this function makes the lookup table of the mis-orientation angles of all stations, which is done
+    once before looping through the station-pairs (used in S2)
+    PARAMETERS:
+    -------------------
+    locs: dataframe (or dict) containing station and angle info for correction purpose (empty for no correction)
+    RETURNS:
+    -------------------
+    lookup: dict of the angle to be corrected for each station
+    '''
+    if not len(locs):
+        return {}
+    return dict(zip(list(locs['station']),list(locs['angle'])))
+
+
+def rotation_matrix(azi,baz,acorr=0.,bcorr=0.):
+    '''
+    this function makes the 9x9 matrix transferring the Green's tensor from a E-N-Z system into a R-T-Z one.
+    it is the kronecker product of the rotation of the source and of the receiver components
+
+    PARAMETERS:
+    -------------------
+    azi,baz:     azimuth and back-azimuth of the station-pair
+    acorr,bcorr: angles to be corrected for the source and receiver stations
+    RETURNS:
+    -------------------
+    rmat: 9x9 matrix from the components of enz_system to the ones of rtz_components
+    '''
+    cosa = np.cos((azi+acorr)*np.pi/180)
+    sina = np.sin((azi+acorr)*np.pi/180)
+    cosb = np.cos((baz+bcorr)*np.pi/180)
+    sinb = np.sin((baz+bcorr)*np.pi/180)
+
+    # source: Z-R-T from E-N-Z; receiver: R-T-Z from E-N-Z
+    rsrc = np.array([[0,0,1],[sina,cosa,0],[cosa,-sina,0]])
+    rrec = np.array([[-sinb,-cosb,0],[-cosb,sinb,0],[0,0,1]])
+    return np.kron(rsrc,rrec)
+
+
 def rotation(bigstack,parameters,locs,flag):
     '''
     this function transfers the Green's tensor from a E-N-Z system into a R-T-Z one
 
     PARAMETERS:
     -------------------
-    bigstack:   9 component Green's tensor in E-N-Z system
+    bigstack:   9 component Green's tensor in E-N-Z system, or a batch of them (e.g., all stacking methods
+                or all sub-stacks) of shape (nbatch,9,npts)
     parameters: dict containing all parameters saved in ASDF file
-    locs:       dict containing station angle info for correction purpose
+    locs:       dict containing station angle info for correction purpose (see rotation_lookup)
     RETURNS:
     -------------------
-    tcorr: 9 component Green's tensor in R-T-Z system
+    tcorr: 9 component Green's tensor in R-T-Z system of the same shape as bigstack
     '''
     # load parameter dic
-    pi = np.pi
     azi = parameters['azi']
     baz = parameters['baz']
-    ncomp,npts = bigstack.shape
+    ncomp = bigstack.shape[-2]
     if ncomp<9:
         print('crap did not get enough components')
         tcorr=[]
@@ -1027,42 +2678,57 @@ def rotation(bigstack,parameters,locs,flag):
     staS  = parameters['station_source']
     staR  = parameters['station_receiver']
 
-    if len(locs):
-        sta_list = list(locs['station'])
-        angles   = list(locs['angle'])
-        # get station info from the name of ASDF file
-        ind   = sta_list.index(staS)
-        acorr = angles[ind]
-        ind   = sta_list.index(staR)
-        bcorr = angles[ind]
-
     #---angles to be corrected----
+    acorr,bcorr = 0.,0.
     if len(locs):
-        cosa = np.cos((azi+acorr)*pi/180)
-        sina = np.sin((azi+acorr)*pi/180)
-        cosb = np.cos((baz+bcorr)*pi/180)
-        sinb = np.sin((baz+bcorr)*pi/180)
-    else:
-        cosa = np.cos(azi*pi/180)
-        sina = np.sin(azi*pi/180)
-        cosb = np.cos(baz*pi/180)
-        sinb = np.sin(baz*pi/180)
+        if not isinstance(locs,dict):locs = rotation_lookup(locs)
+        acorr = locs[staS]
+        bcorr = locs[staR]
 
     # rtz_components = ['ZR','ZT','ZZ','RR','RT','RZ','TR','TT','TZ']
-    tcorr = np.zeros(shape=(9,npts),dtype=np.float32)
-    tcorr[0] = -cosb*bigstack[7]-sinb*bigstack[6]
-    tcorr[1] = sinb*bigstack[7]-cosb*bigstack[6]
-    tcorr[2] = bigstack[8]
-    tcorr[3] = -cosa*cosb*bigstack[4]-cosa*sinb*bigstack[3]-sina*cosb*bigstack[1]-sina*sinb*bigstack[0]
-    tcorr[4] = cosa*sinb*bigstack[4]-cosa*cosb*bigstack[3]+sina*sinb*bigstack[1]-sina*cosb*bigstack[0]
-    tcorr[5] = cosa*bigstack[5]+sina*bigstack[2]
-    tcorr[6] = sina*cosb*bigstack[4]+sina*sinb*bigstack[3]-cosa*cosb*bigstack[1]-cosa*sinb*bigstack[0]
-    tcorr[7] = -sina*sinb*bigstack[4]+sina*cosb*bigstack[3]+cosa*sinb*bigstack[1]-cosa*cosb*bigstack[0]
-    tcorr[8] = -sina*bigstack[5]+cosa*bigstack[2]
+    rmat  = rotation_matrix(azi,baz,acorr,bcorr).astype(np.float32)
+    tcorr = np.einsum('ij,...jn->...in',rmat,bigstack.astype(np.float32,copy=False))
 
     return tcorr
 
 
+def rotate_substacks(subs,enz_system,rtz_components,parameters,locs):
+    '''
+    this function rotates the sub-stacks of the 9 E-N-Z components into R-T-Z at once, using the
+    timestamps shared by all components (used in S2)
+
+    PARAMETERS:
+    -------------------
+    subs:       dict of (data,times,ngood) of the sub-stacks of each component in enz_system
+    enz_system, rtz_components: lists of the E-N-Z and R-T-Z cross-components
+    parameters: dict containing all parameters saved in ASDF file
+    locs:       dict containing station angle info for correction purpose (see rotation_lookup)
+    RETURNS:
+    -------------------
+    rsubs: list of (comp,data,times,ngood) of the R-T-Z sub-stacks except ZZ, which is not changed
+    '''
+    if len(enz_system)<9 or any(comp not in subs for comp in enz_system):
+        return []
+    times = np.atleast_1d(subs[enz_system[0]][1])
+    for comp in enz_system[1:]:
+        times = np.intersect1d(times,subs[comp][1])
+    if not len(times):
+        return []
+
+    # (nsub,9,npts) tensor of the sub-stacks
+    npts  = np.atleast_2d(subs[enz_system[0]][0]).shape[1]
+    batch = np.zeros(shape=(len(times),9,npts),dtype=np.float32)
+    ngood = np.full(len(times),np.iinfo(np.int64).max,dtype=np.int64)
+    for icomp,comp in enumerate(enz_system):
+        tdata,ttime,tgood = subs[comp]
+        _,indx1,indx2 = np.intersect1d(np.atleast_1d(ttime),times,return_indices=True)
+        batch[indx2,icomp] = np.atleast_2d(tdata)[indx1]
+        ngood[indx2] = np.minimum(ngood[indx2],np.atleast_1d(tgood)[indx1])
+
+    rotated = rotation(batch,parameters,locs,False)
+    return [(comp,rotated[:,icomp],times,ngood) for icomp,comp in enumerate(rtz_components) if comp not in enz_system]
+
+
 ####################################################
 ############## UTILITY FUNCTIONS ###################
 ####################################################
@@ -1129,6 +2795,61 @@ def portion_gaps(stream,date_info):
     return pgaps
 
 
+def gap_mask(intervals,starttime,npts,sps):
+    '''
+    this function converts the time intervals covered by data into a run-length mask of the gaps
+    (including the zero-padding at the edges) of a trace
+    PARAMETERS:
+    -------------------
+    intervals: list of [starttime,endtime] of each data piece before merging
+    starttime: starting time of the final trace
+    npts:      number of points of the final trace
+    sps:       sampling rate of the final trace
+    RETURNS:
+    -----------------
+    gaps: 2D int array of [first sample, number of samples] of each gap
+    '''
+    # pieces abutting within one sample (e.g., adjacent files) are continuous once resampled
+    merged = []
+    for t1,t2 in sorted(intervals):
+        if len(merged) and t1-merged[-1][1] <= 1./sps+1E-6:
+            merged[-1][1] = max(merged[-1][1],t2)
+        else: merged.append([t1,t2])
+
+    gaps = [];indx = 0
+    for t1,t2 in merged:
+        i1 = max(int(np.ceil((t1-starttime)*sps-1E-3)),0)
+        i2 = min(int(np.floor((t2-starttime)*sps+1E-3))+1,npts)
+        if i1 > indx: gaps.append([indx,i1-indx])
+        indx = max(indx,i2)
+    if indx < npts: gaps.append([indx,npts-indx])
+    return np.array(gaps,dtype=np.int64).reshape(-1,2)
+
+
+def header_timestamps(sfile):
+    '''
+    this function reads only the header of a SAC/mseed file to get the time span and channel it covers.
+    it is called by the process pool in make_timestamps and thus needs to stay at module level.
+    PARAMETERS:
+    -------------------
+    sfile: path of the SAC/mseed file
+
+    RETURNS:
+    -----------------
+    [starttime,endtime,sid]: time span of all traces in the file in seconds since 1970 (zeros and an empty id if not readable)
+        and the 'network.station.channel' id of the first trace
+    '''
+    try:
+        tr = obspy.read(sfile,headonly=True)
+        t0 = obspy.UTCDateTime(1970,1,1)
+        stime = min([ttr.stats.starttime for ttr in tr])-t0
+        etime = max([ttr.stats.endtime for ttr in tr])-t0
+        sid   = '.'.join([tr[0].stats.network,tr[0].stats.station,tr[0].stats.channel])
+    except Exception as e:
+        print(e);return [0.,0.,'']
+    return [stime,etime,sid]
+
+
 @jit('float32[:](float32[:],float32)')
 def segment_interpolate(sig1,nfric):
     '''
@@ -1157,6 +2878,152 @@ def segment_interpolate(sig1,nfric):
 
     return sig2
 
+def resample_ratio(sps,samp_freq,max_factor=100):
+    '''
+    this function finds the integer up/down factors between two sampling rates
+    PARAMETERS:
+    ----------------------
+    sps: sampling rate of the data
+    samp_freq: targeted sampling rate
+    max_factor: largest up or down factor accepted
+    RETURNS:
+    ----------------------
+    (up,down): integer factors or None if the ratio is not a simple rational number
+    '''
+    ratio = fractions.Fraction(samp_freq/sps).limit_denominator(max_factor)
+    up,down = ratio.numerator,ratio.denominator
+    if up>max_factor or abs(sps*up/down-samp_freq) > 1E-6*samp_freq:
+        return None
+    return up,down
+
+
+def resample_poly_shift(data,up,down,shift):
+    '''
+    this function resamples the data by up/down with a polyphase FIR filter and delays the output samples by
+    a fraction of the output sampling interval in the same operation, so that the samples fall on integer
+    times of the new sampling rate. the filter (windowed sinc as in scipy resample_poly with its peak moved
+    by the shift) is cached for each set of (up,down,shift). (used in S0A & S0B)
+    PARAMETERS:
+    ----------------------
+    data:  1D array of the data
+    up,down: upsampling and downsampling factors
+    shift: time of the first output sample after the first input sample, in fraction of the output
+           sampling interval (0<=shift<1)
+    RETURNS:
+    ----------------------
+    data:  resampled data in float32
+    '''
+    key = (up,down,round(shift,6))
+    if key not in resample_cache.keys():
+        max_rate = max(up,down)
+        half_len = 10*max_rate
+        # shift of the peak of the filter in samples of the upsampled data
+        tshift = shift*down
+        xx = np.arange(2*half_len+1)-half_len+tshift
+        win = np.zeros(len(xx))
+        indx = np.where(np.abs(xx)<=half_len)[0]
+        win[indx] = np.i0(5.0*np.sqrt(1-(xx[indx]/half_len)**2))/np.i0(5.0)
+        h = np.sinc(xx/max_rate)*win
+        # unit gain: resample_poly applies the gain of up to the filter itself
+        resample_cache[key] = h/np.sum(h)
+    h = resample_cache[key]
+
+    return np.float32(scipy.signal.resample_poly(data,up,down,window=h))
+
+
+def inverse_resp_operator(tr,inv,pre_filt,output='VEL',water_level=60):
+    '''
+    this function returns the frequency-domain operator removing the instrument response of a trace, i.e.,
+    the water-leveled inverse response multiplied by the pre_filt taper, together with the time domain
+    taper of obspy remove_response. the operator only depends on the channel epoch, npts, sampling rate and
+    pre_filt, and is kept in the resp_cache of the process to be reused by the following chunks (used in S0A & S0B)
+    PARAMETERS:
+    ----------------------
+    tr:  obspy trace of the data
+    inv: obspy inventory containing the response of the trace
+    pre_filt: frequencies of the cosine taper applied in frequency domain
+    output: output unit of the response removal
+    water_level: water level (dB) used in inverting the response
+    RETURNS:
+    ----------------------
+    tmask: time domain taper (npts)
+    op:    inverse response operator (nfft//2+1)
+    '''
+    stats = tr.stats;npts = stats.npts
+    cha = inv.select(network=stats.network,station=stats.station,location=stats.location,\
+        channel=stats.channel,time=stats.starttime)[0][0][0]
+    key = (tr.id,str(cha.start_date),npts,stats.sampling_rate,tuple(pre_filt),output,water_level)
+
+    if key in resp_cache['ops'].keys():
+        resp_cache['ops'].move_to_end(key)
+        resp_cache['hits'] += 1
+        return resp_cache['ops'][key]
+    resp_cache['misses'] += 1
+
+    # same operations as obspy remove_response
+    nfft = _npts2nfft(npts)
+    op,freqs = cha.response.get_evalresp_response(stats.delta,nfft,output=output)
+    invert_spectrum(op,water_level)
+    op *= cosine_sac_taper(freqs,flimit=pre_filt)
+    tmask = cosine_taper(npts,0.05,sactaper=True,halfcosine=False)
+    resp_cache_add(key,tmask,op)
+
+    return tmask,op
+
+
+def resp_cache_add(key,tmask,op):
+    '''
+    this function adds an operator to the response cache and drops the least recently used ones when
+    the cache uses too much memory
+    PARAMETERS:
+    ----------------------
+    key:   key of the operator
+    tmask: time domain taper
+    op:    frequency domain operator
+    '''
+    resp_cache['ops'][key] = (tmask,op)
+    resp_cache['nbytes'] += tmask.nbytes+op.nbytes
+    while resp_cache['nbytes'] > resp_cache['max_bytes'] and len(resp_cache['ops'])>1:
+        tkey,(ttmask,top) = resp_cache['ops'].popitem(last=False)
+        resp_cache['nbytes'] -= ttmask.nbytes+top.nbytes
+
+
+def remove_resp_cached(tr,inv,pre_filt,output='VEL',water_level=60):
+    '''
+    this function removes the instrument response of a trace with one rfft multiply by the cached inverse
+    response operator. it is equivalent to obspy remove_response with the default tapers. (used in S0A & S0B)
+    PARAMETERS:
+    ----------------------
+    same as inverse_resp_operator
+    RETURNS:
+    ----------------------
+    tr: obspy trace with instrument response removed (modified in place)
+    '''
+    tmask,op = inverse_resp_operator(tr,inv,pre_filt,output,water_level)
+    npts = tr.stats.npts
+    data = np.float64(tr.data)
+    data -= np.mean(data)
+    data *= tmask
+    spec = np.fft.rfft(data,n=2*(len(op)-1))
+    spec *= op
+    spec[-1] = abs(spec[-1])+0.0j
+    tr.data = np.fft.irfft(spec)[0:npts]
+
+    return tr
+
+
+def resp_cache_info():
+    '''
+    this function returns the usage of the response operator cache in this process
+    RETURNS:
+    ----------------------
+    string of the number of hits and misses and the memory in use
+    '''
+    nuse = resp_cache['hits']+resp_cache['misses']
+    return 'response cache: %d hits and %d misses (hit rate %5.1f%%), %6.1f MB in use' % (resp_cache['hits'],\
+        resp_cache['misses'],100*resp_cache['hits']/max(nuse,1),resp_cache['nbytes']/1024**2)
+
+
 def resp_spectrum(source,resp_file,downsamp_freq,pre_filt=None):
     '''
     this function removes the instrument response using response spectrum from evalresp.
@@ -1173,22 +3040,31 @@ def resp_spectrum(source,resp_file,downsamp_freq,pre_filt=None):
     ----------------------
     source: obspy stream object of noise data with instrument response removed
     '''
-    #--------resp_file is the inverted spectrum response---------
-    respz = np.load(resp_file)
-    nrespz= respz[1][:]
-    spec_freq = max(respz[0])
-
     #-------on current trace----------
     nfft = _npts2nfft(source[0].stats.npts)
     sps  = int(source[0].stats.sampling_rate)
 
-    #---------do the interpolation if needed--------
-    if spec_freq < 0.5*sps:
-        raise ValueError('spectrum file has peak freq smaller than the data, abort!')
+    #---the interpolated spectrum is cached for the following chunks---
+    key = ('spectrum',resp_file,nfft,sps)
+    if key in resp_cache['ops'].keys():
+        resp_cache['ops'].move_to_end(key)
+        resp_cache['hits'] += 1
+        nrespz = resp_cache['ops'][key][1]
     else:
-        indx = np.where(respz[0]<=0.5*sps)
-        nfreq = np.linspace(0,0.5*sps,nfft//2+1)
-        nrespz= np.interp(nfreq,np.real(respz[0][indx]),respz[1][indx])
+        resp_cache['misses'] += 1
+
+        #--------resp_file is the inverted spectrum response---------
+        respz = np.load(resp_file)
+        spec_freq = max(respz[0])
+
+        #---------do the interpolation if needed--------
+        if spec_freq < 0.5*sps:
+            raise ValueError('spectrum file has peak freq smaller than the data, abort!')
+        else:
+            indx = np.where(respz[0]<=0.5*sps)
+            nfreq = np.linspace(0,0.5*sps,nfft//2+1)
+            nrespz= np.interp(nfreq,np.real(respz[0][indx]),respz[1][indx])
+        resp_cache_add(key,np.zeros(0),nrespz)
 
     #----do interpolation if necessary-----
     source_spect = np.fft.rfft(source[0].data,n=nfft)
@@ -1314,6 +3190,95 @@ def taper(data):
     return data
 
 
+@jit(nopython = True)
+def clean_detrend_taper(data,wlen):
+    '''
+    this Numba compiled function sets nan/inf to zero, removes the mean and linear trend and applies the
+    hann taper of obspy (half-length of wlen) in place with two passes over the data. it replaces the
+    separate scans, casting and scipy detrend calls in preprocess_raw and keeps the dtype of the data.
+    (used in S0A & S0B)
+    PARAMETERS:
+    ---------------------
+    data: 1D float32 array of the data (modified in place)
+    wlen: half-length of the taper in points (0 for no taper)
+    RETURNS:
+    ---------------------
+    data: the cleaned data
+    '''
+    npts = data.shape[0]
+    if npts < 2:
+        data[:] = 0
+        return data
+
+    # 1st pass: remove nan/inf and accumulate the sums of the least-square line
+    s0 = 0.;s1 = 0.
+    for ii in range(npts):
+        if not np.isfinite(data[ii]):
+            data[ii] = 0
+        s0 += data[ii]
+        s1 += ii*data[ii]
+    tm  = (npts-1)/2
+    slp = (s1-tm*s0)/(npts*(npts/12.*npts-1/12.))
+    off = s0/npts-slp*tm
+
+    # taper shape: same as obspy taper with type hann
+    if 2*wlen == npts:
+        nwin = 2*wlen
+    else:
+        nwin = 2*wlen+1
+
+    # 2nd pass: remove the trend and taper the edges
+    for ii in range(npts):
+        tmp = data[ii]-(off+slp*ii)
+        if ii < wlen:
+            tmp *= 0.5-0.5*np.cos(2*np.pi*ii/(nwin-1))
+        elif ii >= npts-wlen:
+            tmp *= 0.5-0.5*np.cos(2*np.pi*(nwin-npts+ii)/(nwin-1))
+        data[ii] = tmp
+
+    return data
+
+
+def taper_length(npts,sps,max_percentage=0.05,max_length=50):
+    '''
+    this function returns the half-length of the taper used by obspy taper for the given constraints
+    '''
+    return min(int(max_percentage*npts),int(max_length*sps),int(npts/2))
+
+
+def bandpass_sos(data,freqmin,freqmax,sps,corners=4):
+    '''
+    this function does the zero-phase butterworth bandpass of obspy with the second-order-section design
+    cached for each set of (freqmin,freqmax,sps,corners), so that the filter is not designed again for every
+    trace. the output is float32 as in preprocess_raw.
+    PARAMETERS:
+    ---------------------
+    data: 1D array of the data
+    freqmin,freqmax: corner frequencies of the filter
+    sps:  sampling rate of the data
+    corners: order of the filter
+    RETURNS:
+    ---------------------
+    data: filtered data in float32
+    '''
+    key = (freqmin,freqmax,sps,corners)
+    if key not in sos_cache.keys():
+        fe = 0.5*sps
+        # same as obspy: a highpass is used when freqmax is above Nyquist
+        if freqmax/fe-1.0 > -1E-6:
+            z,p,k = scipy.signal.iirfilter(corners,freqmin/fe,btype='highpass',ftype='butter',output='zpk')
+        else:
+            z,p,k = scipy.signal.iirfilter(corners,[freqmin/fe,freqmax/fe],btype='band',ftype='butter',output='zpk')
+        sos_cache[key] = scipy.signal.zpk2sos(z,p,k)
+    sos = sos_cache[key]
+
+    # forward and backward pass (float64 coefficients to keep low frequency bands stable)
+    data = scipy.signal.sosfilt(sos,data)
+    data = scipy.signal.sosfilt(sos,data[::-1])[::-1]
+
+    return np.float32(data)
+
+
 @jit(nopython = True)
 def moving_ave(A,N):
     '''
@@ -1344,69 +3309,89 @@ def moving_ave(A,N):
     return B[N:-N]
 
 
-def robust_stack(cc_array,epsilon):
+def robust_stack(cc_array,epsilon,maxstep=10,di_norm2=None):
     """
-    this is a robust stacking algorithm described in Palvis and Vernon 2010
+    this is a robust stacking algorithm described in Palvis and Vernon 2010. the weights of all the
+    traces (and of all the stacks of a batch) are updated at once in each iteration, and each stack of
+    a batch stops iterating once it has converged
 
     PARAMETERS:
     ----------------------
-    cc_array: numpy.ndarray contains the 2D cross correlation matrix
+    cc_array: numpy.ndarray contains the 2D cross correlation matrix (N,M) or a 3D batch of them (nbatch,N,M)
     epsilon: residual threhold to quit the iteration
+    maxstep: the iteration stops after maxstep+1 steps
+    di_norm2: (optional) squared norms of the traces if already known (see multi_stack)
     RETURNS:
     ----------------------
-    newstack: numpy vector contains the stacked cross correlation
+    newstack: numpy vector contains the stacked cross correlation (nbatch,M for a batch)
+    w: weights of each trace (nbatch,N for a batch)
+    nstep: number of iterations (of each stack for a batch)
 
     Written by Marine Denolle
     """
-    res  = 9E9  # residuals
-    w = np.ones(cc_array.shape[0])
-    nstep=0
-    newstack = np.median(cc_array,axis=0)
-    while res > epsilon:
-        stack = newstack
-        for i in range(cc_array.shape[0]):
-            crap = np.multiply(stack,cc_array[i,:].T)
-            crap_dot = np.sum(crap)
-            di_norm = np.linalg.norm(cc_array[i,:])
-            ri = cc_array[i,:] -  crap_dot*stack
-            ri_norm = np.linalg.norm(ri)
-            w[i]  = np.abs(crap_dot) /di_norm/ri_norm#/len(cc_array[:,1])
-        # print(w)
-        w =w /np.sum(w)
-        newstack =np.sum( (w*cc_array.T).T,axis=0)#/len(cc_array[:,1])
-        res = np.linalg.norm(newstack-stack,ord=1)/np.linalg.norm(newstack)/len(cc_array[:,1])
-        nstep +=1
-        if nstep>10:
-            return newstack, w, nstep
-    return newstack, w, nstep
-
-
-
-def selective_stack(cc_array,epsilon):
+    batch = (cc_array.ndim == 3)
+    if not batch: cc_array = cc_array[np.newaxis]
+    nbatch,N,M = cc_array.shape
+
+    w = np.ones((nbatch,N))
+    nstep  = np.zeros(nbatch,dtype=np.int64)
+    active = np.ones(nbatch,dtype=bool)
+    # the median is faster along contiguous memory (the copy is the one np.median makes anyway)
+    newstack = np.median(np.ascontiguousarray(np.swapaxes(cc_array,1,2)),axis=2,overwrite_input=True)
+    if di_norm2 is None:
+        di_norm2 = np.einsum('bnm,bnm->bn',cc_array,cc_array,dtype=np.float64)
+    else: di_norm2 = np.asarray(di_norm2).reshape(nbatch,N)
+    while np.any(active):
+        ib = np.where(active)[0]
+        if len(ib) == nbatch: tdata = cc_array
+        else: tdata = cc_array[ib]
+        stack = newstack[ib].astype(cc_array.dtype)
+
+        # |d_i-c_i*s|^2 = |d_i|^2-2c_i^2+c_i^2|s|^2 with c_i=d_i.s, computed directly if it cancels out
+        crap_dot = np.matmul(tdata,stack[:,:,np.newaxis])[:,:,0].astype(np.float64)
+        s_norm2  = np.sum(stack.astype(np.float64)**2,axis=1)[:,np.newaxis]
+        ri_norm2 = di_norm2[ib]-2*crap_dot**2+crap_dot**2*s_norm2
+        tb,tn = np.where(ri_norm2 < 1E-6*di_norm2[ib])
+        for jj in range(len(tb)):
+            ri_norm2[tb[jj],tn[jj]] = np.sum((tdata[tb[jj],tn[jj]]-crap_dot[tb[jj],tn[jj]]*stack[tb[jj]])**2,dtype=np.float64)
+        tw = np.abs(crap_dot)/np.sqrt(di_norm2[ib])/np.sqrt(ri_norm2)
+        tw = tw/np.sum(tw,axis=1,keepdims=True)
+        w[ib] = tw
+
+        # new stacks and their residuals
+        tstack = np.matmul(tw[:,np.newaxis,:].astype(cc_array.dtype),tdata)[:,0,:].astype(np.float64)
+        res = np.sum(np.abs(tstack-newstack[ib]),axis=1)/np.linalg.norm(tstack,axis=1)/N
+        if newstack.dtype != np.float64: newstack = newstack.astype(np.float64)
+        newstack[ib] = tstack
+        nstep[ib] += 1
+        active[ib] = (res > epsilon) & (nstep[ib] <= maxstep)
+
+    if not batch: return newstack[0],w[0],nstep[0]
+    return newstack,w,nstep
+
+
+def robust_stack_groups(arrays,epsilon):
     """
-    this is a selective stacking algorithm developed by Jared Bryan.
+    this function runs the batched robust_stack on a list of 2D cross correlation matrix (e.g., of all
+    the cross-components of a station pair), batching the ones with the same number of traces
 
     PARAMETERS:
     ----------------------
-    cc_array: numpy.ndarray contains the 2D cross correlation matrix
+    arrays: list of 2D numpy.ndarray of cross correlation matrix (with the same number of points)
     epsilon: residual threhold to quit the iteration
     RETURNS:
     ----------------------
-    newstack: numpy vector contains the stacked cross correlation
-
-    Written by Marine Denolle
+    stacks: list of the robust stacks of arrays
     """
-    res  = 9E9  # residuals
-    cc = np.ones(cc_array.shape[0])
-    nstep=0
-    newstack = np.mean(cc_array,axis=0)
-    for i in range(cc_array.shape[0]):
-    	CC[i] = np.sum(np.multiply(stack,cc_array[i,:].T))
-    ik = np.where(CC>=epsilon)
-    newstack = np.mean(cc_array[ik,:],axis=0)
-
-    return newstack, cc
-
+    stacks = [None for _ in range(len(arrays))]
+    groups = {}
+    for ii,tarray in enumerate(arrays):
+        groups.setdefault(tarray.shape,[]).append(ii)
+    for tshape,indx in groups.items():
+        newstack,w,nstep = robust_stack(np.stack([arrays[ii] for ii in indx]),epsilon)
+        for jj,ii in enumerate(indx):
+            stacks[ii] = newstack[jj]
+    return stacks
 
 
 def whiten(data, fft_para):
@@ -1507,46 +3492,39 @@ def adaptive_filter(arr,g):
     Nakata et al., 2015 (Appendix B)
 
     the filtered signal [x1] is given by x1 = ifft(P*x1(w)) where x1 is the ffted spectra
-    and P is the filter. P is constructed by using the temporal covariance matrix.
+    and P is the filter. P is constructed by using the temporal covariance matrix. the sums
+    over the cross-spectrum matrix it needs are computed directly: the sum over all pairs is
+    |sum(spec)|^2 and the sum over the diagonal is sum(|spec|^2), so that the memory and time
+    grow as N*M instead of N*N*M
 
     PARAMETERS:
     ----------------------
     arr: numpy.ndarray contains the 2D traces of daily/hourly cross-correlation functions
+        (N,M) or a 3D batch of them (nbatch,N,M)
     g: a positive number to adjust the filter harshness
     RETURNS:
     ----------------------
-    narr: numpy vector contains the stacked cross correlation function
+    narr: numpy vector contains the stacked cross correlation function (nbatch,M for a batch)
     '''
     if arr.ndim == 1:
         return arr
-    N,M = arr.shape
+    N,M = arr.shape[-2:]
     Nfft = next_fast_len(M)
 
     # fft the 2D array
-    spec = scipy.fftpack.fft(arr,axis=1,n=Nfft)[:,:M]
+    spec = scipy.fftpack.fft(arr,axis=-1,n=Nfft)[...,:M]
 
-    # make cross-spectrm matrix
-    cspec = np.zeros(shape=(N*N,M),dtype=np.complex64)
-    for ii in range(N):
-        for jj in range(N):
-            kk = ii*N+jj
-            cspec[kk] = spec[ii]*np.conjugate(spec[jj])
+    # sum of the cross-spectrum matrix (S1) and of its diagonal (S2)
+    sspec = np.sum(spec,axis=-2)
+    S1 = np.abs(sspec)**2
+    S2 = np.sum(np.abs(spec)**2,axis=-2)
 
-    S1 = np.zeros(M,dtype=np.complex64)
-    S2 = np.zeros(M,dtype=np.complex64)
     # construct the filter P
-    for ii in range(N):
-        mm = ii*N+ii
-        S2 += cspec[mm]
-        for jj in range(N):
-            kk = ii*N+jj
-            S1 += cspec[kk]
+    p = np.power(((S1-S2)/(S2*(N-1))).astype(np.complex128),g)
 
-    p = np.power((S1-S2)/(S2*(N-1)),g)
-
-    # make ifft
-    narr = np.real(scipy.fftpack.ifft(np.multiply(p,spec),Nfft,axis=1)[:,:M])
-    return np.mean(narr,axis=0)
+    # make ifft: the filter is the same for all traces so the mean is filtered directly
+    narr = np.real(scipy.fftpack.ifft(np.multiply(p,sspec/N),Nfft,axis=-1)[...,:M])
+    return narr
 
 def pws(arr,sampling_rate,power=2,pws_timegate=5.):
     '''
@@ -1574,11 +3552,7 @@ def pws(arr,sampling_rate,power=2,pws_timegate=5.):
 
     if arr.ndim == 1:
         return arr
-    N,M = arr.shape
-    analytic = hilbert(arr,axis=1, N=next_fast_len(M))[:,:M]
-    phase = np.angle(analytic)
-    phase_stack = np.mean(np.exp(1j*phase),axis=0)
-    phase_stack = np.abs(phase_stack)**(power)
+    phase_stack = pws_weights(arr,power)
 
     # smoothing
     #timegate_samples = int(pws_timegate * sampling_rate)
@@ -1587,6 +3561,18 @@ def pws(arr,sampling_rate,power=2,pws_timegate=5.):
     return np.mean(weighted,axis=0)
 
 
+def pws_weights(arr,power=2):
+    '''
+    this function returns the phase stack |1/N sum k = 1:N exp[i * phi_k(t)]|^v used as the weights of
+    the phase-weighted stack, so that pws(arr) is the linear stack of arr times these weights
+    '''
+    N,M = arr.shape
+    analytic = hilbert(arr,axis=1, N=next_fast_len(M))[:,:M]
+    phase = np.angle(analytic)
+    phase_stack = np.mean(np.exp(1j*phase),axis=0)
+    return np.abs(phase_stack)**(power)
+
+
 def nroot_stack(cc_array,power):
     '''
     this is nth-root stacking algorithm translated based on the matlab function
@@ -1607,14 +3593,8 @@ def nroot_stack(cc_array,power):
     if cc_array.ndim == 1:
         print('2D matrix is needed for nroot_stack')
         return cc_array
-    N,M = cc_array.shape 
-    dout = np.zeros(M,dtype=np.float32)
-
     # construct y
-    for ii in range(N):
-        dat = cc_array[ii,:]
-        dout += np.sign(dat)*np.abs(dat)**(1/power)
-    dout /= N
+    dout = np.mean(np.sign(cc_array)*np.abs(cc_array)**(1/power),axis=0)
 
     # the final stacked waveform
     nstack = dout*np.abs(dout)**(power-1)
@@ -1622,59 +3602,100 @@ def nroot_stack(cc_array,power):
     return nstack
 
 
-def selective_stack(cc_array,epsilon,cc_th):
+def selective_stack(cc_array,epsilon,cc_th,maxstep=100,rstats=None):
     ''' 
-    this is a selective stacking algorithm developed by Jared Bryan/Kurama Okubo.
+    this is a selective stacking algorithm developed by Jared Bryan/Kurama Okubo. the correlation
+    coefficients of all the traces to the current stack are computed as one matrix-vector product
+    (the means and norms of the traces are the same in all iterations), and each stack of a batch
+    stops iterating once it has converged
 
     PARAMETERS:
     ----------------------
-    cc_array: numpy.ndarray contains the 2D cross correlation matrix
+    cc_array: numpy.ndarray contains the 2D cross correlation matrix (N,M) or a 3D batch of them (nbatch,N,M)
     epsilon: residual threhold to quit the iteration
     cc_th: numpy.float, threshold of correlation coefficient to be selected
+    maxstep: maximum number of iterations
+    rstats: (optional) means and squared norms of the traces if already known (see multi_stack)
 
     RETURNS:
     ----------------------
-    newstack: numpy vector contains the stacked cross correlation
-    nstep: np.int, total number of iterations for the stacking
+    newstack: numpy vector contains the stacked cross correlation (nbatch,M for a batch)
+    nstep: np.int, total number of iterations for the stacking (of each stack for a batch)
 
     Originally ritten by Marine Denolle 
     Modified by Chengxin Jiang @Harvard (Oct2020)
     '''
     if cc_array.ndim == 1:
-        print('2D matrix is needed for nroot_stack')
+        print('2D matrix is needed for selective_stack')
         return cc_array
-    N,M = cc_array.shape 
-
-    res  = 9E9  # residuals
-    cof  = np.zeros(N,dtype=np.float32)
-    newstack = np.mean(cc_array,axis=0)
-
-    nstep = 0
+    batch = (cc_array.ndim == 3)
+    if not batch: cc_array = cc_array[np.newaxis]
+    nbatch,N,M = cc_array.shape 
+
+    # mean and norm (after demean) of each trace
+    if rstats is None:
+        rmean = np.mean(cc_array,axis=2,dtype=np.float64)
+        rnorm = np.einsum('bnm,bnm->bn',cc_array,cc_array,dtype=np.float64)
+    else:
+        rmean = np.asarray(rstats[0]).reshape(nbatch,N)
+        rnorm = np.asarray(rstats[1]).reshape(nbatch,N)
+    rnorm = rnorm-M*rmean**2
+    rnorm = np.sqrt(np.maximum(rnorm,0))
+
+    newstack = np.mean(cc_array,axis=1)
+    nstep  = np.zeros(nbatch,dtype=np.int64)
+    active = np.ones(nbatch,dtype=bool)
     # start iteration
-    while res>epsilon:
-        for ii in range(N):
-            cof[ii] = np.corrcoef(newstack, cc_array[ii,:])[0, 1]
+    while np.any(active):
+        ib = np.where(active)[0]
+        if len(ib) == nbatch: tdata = cc_array
+        else: tdata = cc_array[ib]
+        stack = newstack[ib]
+
+        # correlation coefficients of the traces to the stacks
+        smean = np.mean(stack,axis=1,dtype=np.float64)[:,np.newaxis]
+        snorm = np.linalg.norm(stack-smean,axis=1)[:,np.newaxis]
+        cof = (np.matmul(tdata,stack[:,:,np.newaxis])[:,:,0]-M*rmean[ib]*smean)/(rnorm[ib]*snorm)
         
         # find good waveforms
-        indx = np.where(cof>=cc_th)[0]
-        if not len(indx): raise ValueError('cannot find good waveforms inside selective stacking')
-        oldstack = newstack
-        newstack = np.mean(cc_array[indx],axis=0)
-        res = np.linalg.norm(newstack-oldstack)/(np.linalg.norm(newstack)*M)
-        nstep +=1
-
-    return newstack, nstep
-
-
-def get_cc(s1,s_ref):
-    # returns the correlation coefficient between waveforms in s1 against reference
-    # waveform s_ref.
-    #
-    cc=np.zeros(s1.shape[0])
-    s_ref_norm = np.linalg.norm(s_ref)
-    for i in range(s1.shape[0]):
-        cc[i]=np.sum(np.multiply(s1[i,:],s_ref))/np.linalg.norm(s1[i,:])/s_ref_norm
-    return cc
+        good  = (cof>=cc_th)
+        ngood = np.sum(good,axis=1)
+        if not np.all(ngood): raise ValueError('cannot find good waveforms inside selective stacking')
+        tstack = np.matmul(good[:,np.newaxis,:].astype(cc_array.dtype),tdata)[:,0,:]/ngood[:,np.newaxis]
+        res = np.linalg.norm(tstack-stack,axis=1)/(np.linalg.norm(tstack,axis=1)*M)
+        newstack[ib] = tstack
+        nstep[ib] += 1
+        active[ib] = (res > epsilon) & (nstep[ib] < maxstep)
+
+    if not batch: return newstack[0],nstep[0]
+    return newstack,nstep
+
+
+def get_cc(s1,s_ref,demean=False):
+    '''
+    this function returns the correlation coefficient between waveforms in s1 against reference
+    waveform s_ref, for all the waveforms at once
+
+    PARAMETERS:
+    ----------------------
+    s1: numpy.ndarray of waveforms (N,M), or of a batch of them (nbatch,N,M)
+    s_ref: reference waveform (M), or one for each batch (nbatch,M)
+    demean: remove the mean of the waveforms first (i.e., the same as np.corrcoef)
+    RETURNS:
+    ----------------------
+    cc: correlation coefficients (N), or (nbatch,N) for a batch
+    '''
+    M  = s1.shape[-1]
+    cc = np.matmul(s1,s_ref[...,:,np.newaxis])[...,0].astype(np.float64)
+    n1 = np.einsum('...m,...m->...',s1,s1,dtype=np.float64)
+    nr = np.sum(np.square(s_ref,dtype=np.float64),axis=-1)[...,np.newaxis]
+    if demean:
+        m1 = np.mean(s1,axis=-1,dtype=np.float64)
+        mr = np.mean(s_ref,axis=-1,dtype=np.float64)[...,np.newaxis]
+        cc = cc-M*m1*mr
+        n1 = n1-M*m1**2
+        nr = nr-M*mr**2
+    return cc/np.sqrt(n1)/np.sqrt(nr)
 
 
 ########################################################
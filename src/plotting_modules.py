@@ -9,6 +9,7 @@ import matplotlib
 import matplotlib.pyplot as plt
 from scipy.fftpack import next_fast_len
 from obspy.signal.filter import bandpass
+from noise_module import read_substacks
 
 '''
 Ensembles of plotting functions to display intermediate/final waveforms from the NoisePy package.
@@ -366,40 +367,26 @@ def plot_substack_all(sfile,freqmin,freqmax,ccomp,disp_lag=None,savefig=False,sd
     except Exception:
         print("exit! cannot open %s to read"%sfile);sys.exit()
 
-    if len(dtype_lists)==1:
-        raise ValueError('Abort! seems no substacks have been done')
-
     # lags for display   
     if not disp_lag:disp_lag=maxlag
     if disp_lag>maxlag:raise ValueError('lag excceds maxlag!')
     t = np.arange(-int(disp_lag),int(disp_lag)+dt,step=int(2*int(disp_lag)/4)) 
-    indx1 = int((maxlag-disp_lag)/dt)
-    indx2 = indx1+2*int(disp_lag/dt)+1
 
-    # other parameters to keep
-    nwin = len(dtype_lists)-1
-    data = np.zeros(shape=(nwin,indx2-indx1),dtype=np.float32)
-    ngood= np.zeros(nwin,dtype=np.int16)
-    ttime= np.zeros(nwin,dtype=np.int)
-    timestamp = np.empty(ttime.size,dtype='datetime64[s]')
+    # sub-stacks of either layout of S2 (the stack file also holds the stacks and accumulators)
+    try:
+        data,ttime,ngood,tvec = read_substacks(ds,paths,lag=disp_lag)
+    except ValueError:
+        raise ValueError('Abort! seems no substacks have been done')
+    nwin = data.shape[0]
+    if nwin<=1:
+        raise ValueError('seems no substacks have been done! not suitable for this plotting function')
+    timestamp = np.array([obspy.UTCDateTime(tt).datetime for tt in ttime],dtype='datetime64[s]')
     amax = np.zeros(nwin,dtype=np.float32)
 
-    for ii,itype in enumerate(dtype_lists[2:]):
-        timestamp[ii] = obspy.UTCDateTime(np.float(itype[1:]))
-        try:
-            ngood[ii] = ds.auxiliary_data[itype][paths].parameters['ngood']
-            ttime[ii] = ds.auxiliary_data[itype][paths].parameters['time']
-            #timestamp[ii] = obspy.UTCDateTime(ttime[ii])
-            # cc matrix
-            data[ii] = ds.auxiliary_data[itype][paths].data[indx1:indx2]
-            data[ii] = bandpass(data[ii],freqmin,freqmax,int(1/dt),corners=4, zerophase=True)
-            amax[ii] = np.max(data[ii])
-            data[ii] /= amax[ii]
-        except Exception as e:
-            print(e);continue
-
-        if len(ngood)==1:
-            raise ValueError('seems no substacks have been done! not suitable for this plotting function')
+    for ii in range(nwin):
+        data[ii] = bandpass(data[ii],freqmin,freqmax,int(1/dt),corners=4, zerophase=True)
+        amax[ii] = np.max(data[ii])
+        data[ii] /= amax[ii]
         
     # plotting
     if nwin>100:
@@ -420,7 +407,7 @@ def plot_substack_all(sfile,freqmin,freqmax,ccomp,disp_lag=None,savefig=False,sd
     ax[1].plot(amax/max(amax),'r-')
     ax[1].plot(ngood,'b-')
     ax[1].set_xlabel('waveform number')
-    ax[1].set_xticks(np.arange(0,nwin,nwin//5))
+    ax[1].set_xticks(np.arange(0,nwin,max(1,nwin//5)))
     ax[1].legend(['relative amp','ngood'],loc='upper right')
     # save figure or just show
     if savefig:
@@ -464,45 +451,32 @@ def plot_substack_all_spect(sfile,freqmin,freqmax,ccomp,disp_lag=None,savefig=Fa
     except Exception:
         print("exit! cannot open %s to read"%sfile);sys.exit()
 
-    if len(dtype_lists)==1:
-        raise ValueError('Abort! seems no substacks have been done')
-
     # lags for display   
     if not disp_lag:disp_lag=maxlag
     if disp_lag>maxlag:raise ValueError('lag excceds maxlag!')
     t = np.arange(-int(disp_lag),int(disp_lag)+dt,step=int(2*int(disp_lag)/4)) 
-    indx1 = int((maxlag-disp_lag)/dt)
-    indx2 = indx1+2*int(disp_lag/dt)+1
-    nfft  = int(next_fast_len(indx2-indx1))
-    freq  = scipy.fftpack.fftfreq(nfft,d=dt)[:nfft//2]
 
-    # other parameters to keep
-    nwin = len(dtype_lists)-1
-    data = np.zeros(shape=(nwin,indx2-indx1),dtype=np.float32)
+    # sub-stacks of either layout of S2 (the stack file also holds the stacks and accumulators)
+    try:
+        data,ttime,ngood,tvec = read_substacks(ds,paths,lag=disp_lag)
+    except ValueError:
+        raise ValueError('Abort! seems no substacks have been done')
+    nwin = data.shape[0]
+    if nwin<=1:
+        raise ValueError('seems no substacks have been done! not suitable for this plotting function')
+    timestamp = np.array([obspy.UTCDateTime(tt).datetime for tt in ttime],dtype='datetime64[s]')
+    nfft  = int(next_fast_len(data.shape[1]))
+    freq  = scipy.fftpack.fftfreq(nfft,d=dt)[:nfft//2]
     spec = np.zeros(shape=(nwin,nfft//2),dtype=np.complex64)
-    ngood= np.zeros(nwin,dtype=np.int16)
-    ttime= np.zeros(nwin,dtype=np.int)
-    timestamp = np.empty(ttime.size,dtype='datetime64[s]')
     amax = np.zeros(nwin,dtype=np.float32)
 
-    for ii,itype in enumerate(dtype_lists[1:]):
-        timestamp[ii] = obspy.UTCDateTime(np.float(itype[1:]))
-        try:
-            ngood[ii] = ds.auxiliary_data[itype][paths].parameters['ngood']
-            ttime[ii] = ds.auxiliary_data[itype][paths].parameters['time']
-            #timestamp[ii] = obspy.UTCDateTime(ttime[ii])
-            # cc matrix
-            tdata = ds.auxiliary_data[itype][paths].data[indx1:indx2]
-            spec[ii] = scipy.fftpack.fft(tdata,nfft,axis=0)[:nfft//2]
-            spec[ii] /= np.max(np.abs(spec[ii]))
-            data[ii] = bandpass(tdata,freqmin,freqmax,int(1/dt),corners=4, zerophase=True)
-            amax[ii] = np.max(data[ii])
-            data[ii] /= amax[ii]
-        except Exception as e:
-            print(e);continue
-
-        if len(ngood)==1:
-            raise ValueError('seems no substacks have been done! not suitable for this plotting function')
+    for ii in range(nwin):
+        tdata = data[ii].copy()
+        spec[ii] = scipy.fftpack.fft(tdata,nfft,axis=0)[:nfft//2]
+        spec[ii] /= np.max(np.abs(spec[ii]))
+        data[ii] = bandpass(tdata,freqmin,freqmax,int(1/dt),corners=4, zerophase=True)
+        amax[ii] = np.max(data[ii])
+        data[ii] /= amax[ii]
         
     # plotting
     tick_inc = 50
@@ -524,7 +498,7 @@ def plot_substack_all_spect(sfile,freqmin,freqmax,ccomp,disp_lag=None,savefig=Fa
     ax[2].plot(amax/max(amax),'r-')
     ax[2].plot(ngood,'b-')
     ax[2].set_xlabel('waveform number')
-    ax[2].set_xticks(np.arange(0,nwin,nwin//15))
+    ax[2].set_xticks(np.arange(0,nwin,max(1,nwin//15)))
     ax[2].legend(['relative amp','ngood'],loc='upper right')
     # save figure or just show
     if savefig:
@@ -0,0 +1,64 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import obspy
+import numpy as np
+from obspy.clients.fdsn import Client
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'../../src'))
+import noise_module
+import fdsn_standin_server
+
+'''
+compare the time of downloading one chunk of a station list serially and with concurrent
+requests (one per station or in bulk) against the local FDSN stand-in server, which has
+a fixed latency per request and fails a fraction of the requests to exercise the retries.
+'''
+
+nsta      = 24
+latency   = 0.2
+fail_rate = 0.1
+inc_hours = 1
+
+server = fdsn_standin_server.start_server(0,latency,fail_rate)
+client = Client(base_url='http://127.0.0.1:%d'%server.server_port,_discover_services=False,timeout=30)
+
+prepro_para = {'rm_resp':'no','respdir':'.','freqmin':0.05,'freqmax':2,'samp_freq':10,'inc_hours':inc_hours,\
+    'nretry':3,'backoff':0.05}
+s1 = obspy.UTCDateTime(2019,1,1);s2 = s1+inc_hours*3600
+date_info = {'starttime':s1,'endtime':s2}
+jobs = [(client,'CI','S%03d'%ii,'HHZ','*',prepro_para,date_info,'hhz_00') for ii in range(nsta)]
+
+for max_inflight,bulk_size in [(1,0),(4,0),(8,0),(16,0),(1,24),(2,12),(4,6)]:
+    t0 = time.time()
+    reqlogs = [];nsuc = 0
+    for res in noise_module.fetch_concurrent(jobs,max_inflight,bulk_size):
+        reqlogs.extend(res[3])
+        if res[0] is not None: nsuc += 1
+    t1 = time.time()
+    ntry = np.array([log['ntry'] for log in reqlogs])
+    print('%2d in-flight, bulk size %2d: %6.2f s for %d stations (%d downloaded), %d requests with %d retries' % (max_inflight,\
+        bulk_size,t1-t0,nsta,nsuc,len(reqlogs),np.sum(ntry-1)))
+
+# inventories are only requested for the first chunk when they are cached
+invdir = tempfile.mkdtemp()
+inv_cache = noise_module.make_inv_cache(invdir)
+for ick in range(3):
+    date_info = {'starttime':s1+ick*inc_hours*3600,'endtime':s2+ick*inc_hours*3600}
+    cjobs = [job[:6]+(date_info,job[7]) for job in jobs]
+    reqlogs = []
+    for res in noise_module.fetch_concurrent(cjobs,8,0,inv_cache):
+        reqlogs.extend(res[3])
+    print('chunk %d with inventory cache: %d station requests, %d waveform requests, %d hits/%d misses' % (ick,\
+        len([log for log in reqlogs if log['request']=='get_stations']),len([log for log in reqlogs if \
+        log['request']=='get_waveforms']),inv_cache['hits'],inv_cache['misses']))
+inv_cache = noise_module.make_inv_cache(invdir)
+res = noise_module.fetch_station(jobs[0],inv_cache)
+print('new cache from disk: %d requests, inventory of %s' % (len(res[3]),res[1].get_contents()['channels']))
+shutil.rmtree(invdir)
+
+# the pre-processing of the downloaded stream
+res = noise_module.preprocess_downloaded(next(noise_module.fetch_concurrent(jobs[:1],1)))
+print(res[0],res[2])
+server.shutdown()
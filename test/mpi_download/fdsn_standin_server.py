@@ -0,0 +1,141 @@
+import io
+import zlib
+import sys
+import time
+import random
+import threading
+import numpy as np
+from obspy import UTCDateTime, Trace, Stream
+from obspy.core.inventory import Inventory, Network, Station, Channel, Site
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+'''
+a small FDSN web service stand-in serving canned StationXML and miniSEED so that the
+concurrent downloading in S0A (throughput, retries) can be tested without internet.
+
+only the query method (GET and bulk POST) of the station and dataselect services is supported. waveforms are
+deterministic random noise seeded by the channel id and the requested start time. the
+latency of each request and the fraction of requests failing with a 503 can be set to
+mimic a busy data center.
+
+usage: python fdsn_standin_server.py [port] [latency] [fail_rate]
+and then use Client(base_url='http://127.0.0.1:port',_discover_services=False) in S0A
+'''
+
+SAMP_FREQ = 20
+
+def make_inventory(net,sta,chan,loc='00'):
+    '''
+    canned inventory of one channel without response
+    '''
+    cha = Channel(code=chan,location_code=loc,latitude=35.,longitude=-117.,elevation=100.,depth=0.,\
+        sample_rate=SAMP_FREQ,start_date=UTCDateTime(2000,1,1))
+    tsta = Station(code=sta,latitude=35.,longitude=-117.,elevation=100.,channels=[cha],\
+        site=Site(name=sta),creation_date=UTCDateTime(2000,1,1))
+    return Inventory(networks=[Network(code=net,stations=[tsta])],source='standin')
+
+def make_stream(net,sta,chan,loc,t1,t2):
+    '''
+    canned waveform of one channel between t1 and t2
+    '''
+    npts = int((t2-t1)*SAMP_FREQ)
+    seed = zlib.crc32(('%s.%s.%s.%s.%d' % (net,sta,loc,chan,int(t1.timestamp))).encode())
+    data = np.random.RandomState(seed).randn(npts).astype(np.float32)
+    tr = Trace(data=data,header={'network':net,'station':sta,'channel':chan,\
+        'location':loc,'starttime':t1,'sampling_rate':SAMP_FREQ})
+    return Stream([tr])
+
+def clean_code(code,default):
+    if code in ('*','','--'): return default
+    return code
+
+class FDSNHandler(BaseHTTPRequestHandler):
+    latency   = 0.
+    fail_rate = 0.
+    nrequest  = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with FDSNHandler.lock:
+            FDSNHandler.nrequest += 1
+        time.sleep(self.latency)
+        url  = urlparse(self.path)
+        para = {k:v[0] for k,v in parse_qs(url.query).items()}
+        if random.random() < self.fail_rate:
+            return self.reply(503,b'service temporarily unavailable','text/plain')
+
+        net  = clean_code(para.get('network','XX'),'XX')
+        sta  = clean_code(para.get('station','STA'),'STA')
+        chan = clean_code(para.get('channel','HHZ'),'HHZ')
+        loc  = clean_code(para.get('location','00'),'00')
+        if 'starttime' in para.keys():
+            t1 = UTCDateTime(para['starttime']);t2 = UTCDateTime(para['endtime'])
+        else: t1 = t2 = None
+        self.answer(url.path,[(net,sta,loc,chan,t1,t2)])
+
+    def do_POST(self):
+        with FDSNHandler.lock:
+            FDSNHandler.nrequest += 1
+        time.sleep(self.latency)
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+        if random.random() < self.fail_rate:
+            return self.reply(503,b'service temporarily unavailable','text/plain')
+
+        # bulk request: one "key=value" per line for options and one "NET STA LOC CHA START END" per channel
+        bulk = []
+        for line in body.splitlines():
+            tmp = line.split()
+            if len(tmp) != 6: continue
+            bulk.append((clean_code(tmp[0],'XX'),clean_code(tmp[1],'STA'),clean_code(tmp[2],'00'),\
+                clean_code(tmp[3],'HHZ'),UTCDateTime(tmp[4]),UTCDateTime(tmp[5])))
+        self.answer(urlparse(self.path).path,bulk)
+
+    def answer(self,path,bulk):
+        buf = io.BytesIO()
+        if path == '/fdsnws/station/1/query':
+            inv = Inventory(networks=[],source='standin')
+            for net,sta,loc,chan,t1,t2 in bulk:
+                inv += make_inventory(net,sta,chan,loc)
+            inv.write(buf,format='STATIONXML')
+            self.reply(200,buf.getvalue(),'application/xml')
+        elif path == '/fdsnws/dataselect/1/query':
+            st = Stream()
+            for net,sta,loc,chan,t1,t2 in bulk:
+                st += make_stream(net,sta,chan,loc,t1,t2)
+            st.write(buf,format='MSEED')
+            self.reply(200,buf.getvalue(),'application/vnd.fdsn.mseed')
+        else:
+            self.reply(404,b'not found','text/plain')
+
+    def reply(self,code,body,ctype):
+        self.send_response(code)
+        self.send_header('Content-Type',ctype)
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self,format,*args):
+        pass
+
+def start_server(port=0,latency=0.,fail_rate=0.):
+    '''
+    start the server in a background thread and return it (server.server_port gives the port)
+    '''
+    FDSNHandler.latency   = latency
+    FDSNHandler.fail_rate = fail_rate
+    server = ThreadingHTTPServer(('127.0.0.1',port),FDSNHandler)
+    thread = threading.Thread(target=server.serve_forever,daemon=True)
+    thread.start()
+    return server
+
+if __name__ == '__main__':
+    port      = int(sys.argv[1]) if len(sys.argv)>1 else 8080
+    latency   = float(sys.argv[2]) if len(sys.argv)>2 else 0.2
+    fail_rate = float(sys.argv[3]) if len(sys.argv)>3 else 0.
+    server = start_server(port,latency,fail_rate)
+    print('FDSN stand-in server running at http://127.0.0.1:%d' % server.server_port)
+    try:
+        while True: time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,81 @@
+import os
+import sys
+import time
+import obspy
+import scipy
+import numpy as np
+from scipy import signal
+from obspy.signal.filter import bandpass
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'../../src'))
+import noise_module
+
+'''
+compare the efficiency of the fused cleaning kernel (nan/inf, demean, detrend and taper in one
+Numba pass + bandpass with cached filter design) used in preprocess_raw with the previous
+sequence of numpy/scipy/obspy calls on day-long 100 Hz traces
+'''
+
+sps   = 100
+npts  = sps*86400
+ntest = 5
+freqmin,freqmax = 0.045,2.2
+
+def old_clean(tr):
+    '''
+    previous steps of preprocess_raw before downsampling
+    '''
+    tttindx = np.where(np.isnan(tr.data))
+    if len(tttindx) >0:tr.data[tttindx]=0
+    tttindx = np.where(np.isinf(tr.data))
+    if len(tttindx) >0:tr.data[tttindx]=0
+
+    tr.data = np.float32(tr.data)
+    tr.data = scipy.signal.detrend(tr.data,type='constant')
+    tr.data = scipy.signal.detrend(tr.data,type='linear')
+    tr.taper(max_percentage=0.05,max_length=50)
+    tr.data = np.float32(bandpass(tr.data,freqmin,freqmax,df=sps,corners=4,zerophase=True))
+    return tr
+
+def new_clean(tr):
+    '''
+    fused kernel used now in preprocess_raw
+    '''
+    tr.data = np.require(tr.data,dtype=np.float32,requirements=['C','W'])
+    noise_module.clean_detrend_taper(tr.data,noise_module.taper_length(tr.stats.npts,sps))
+    tr.data = noise_module.bandpass_sos(tr.data,freqmin,freqmax,sps,corners=4)
+    return tr
+
+# synthetic day-long trace with a trend, an offset and some bad values
+data = np.random.randn(npts).astype(np.float32)+np.linspace(0,5,npts,dtype=np.float32)+10
+data[np.random.randint(0,npts,100)] = np.nan
+data[np.random.randint(0,npts,100)] = np.inf
+tr0 = obspy.Trace(data=data,header={'sampling_rate':sps})
+
+# compile the kernel first
+new_clean(tr0.copy())
+
+for name,func in [('previous',old_clean),('fused',new_clean)]:
+    t0 = time.time()
+    for ii in range(ntest):
+        tr = func(tr0.copy())
+    t1 = time.time()
+    print('%10s: %6.3f s per day-long trace (output %s)' % (name,(t1-t0)/ntest,tr.data.dtype))
+
+# the two should give the same results
+tr1 = old_clean(tr0.copy())
+tr2 = new_clean(tr0.copy())
+print('max relative difference %e' % (np.max(np.abs(tr1.data-tr2.data))/np.max(np.abs(tr1.data))))
+
+# only the steps before filtering
+tr1 = tr0.copy();tr2 = tr0.copy()
+t0 = time.time()
+for ii in range(ntest):
+    tr1.data = np.float32(np.nan_to_num(tr0.data,nan=0,posinf=0,neginf=0))
+    tr1.data = scipy.signal.detrend(scipy.signal.detrend(tr1.data,type='constant'),type='linear')
+    tr1.taper(max_percentage=0.05,max_length=50)
+t1 = time.time()
+for ii in range(ntest):
+    tr2.data = tr0.data.copy()
+    noise_module.clean_detrend_taper(tr2.data,noise_module.taper_length(npts,sps))
+t2 = time.time()
+print('cleaning only: %6.3f s vs %6.3f s (max difference %e)' % ((t1-t0)/ntest,(t2-t1)/ntest,np.max(np.abs(tr1.data-tr2.data))))
@@ -0,0 +1,23 @@
+import os
+import sys
+import numpy as np
+from scipy import signal
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'../../src'))
+import noise_module
+
+'''
+check that the polyphase resampling with a sub-sample shift used in preprocess_raw (resample_poly_shift)
+keeps the amplitude of scipy resample_poly, in particular for ratios with up>1 (e.g., 40->25 Hz)
+'''
+
+npts = 40*3600
+data = np.random.randn(npts).astype(np.float32)
+
+for sps,samp_freq in [(40,25),(50,20),(100,20),(200,40)]:
+    up,down = noise_module.resample_ratio(sps,samp_freq)
+    new = noise_module.resample_poly_shift(data,up,down,0.)
+    ref = signal.resample_poly(data,up,down)
+    rms_ratio = np.sqrt(np.mean(new**2))/np.sqrt(np.mean(ref**2))
+    print('%3d -> %3d Hz (up=%d,down=%d): rms ratio %6.4f, max relative difference %e' % \
+        (sps,samp_freq,up,down,rms_ratio,np.max(np.abs(new-ref))/np.max(np.abs(ref))))
+    assert abs(rms_ratio-1) < 1E-3, 'resample_poly_shift changes the amplitude'